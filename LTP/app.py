@@ -1,7 +1,48 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-import pymysql
-from pymysql.err import InternalError
-from datetime import datetime
+import os
+
+# Socket.IO chạy trên eventlet (mặc định): "green" hoá socket, thread, time... trước khi
+# import các thư viện khác, để một truy vấn MySQL/Redis chậm chỉ bắt green thread của nó
+# chờ thay vì chặn cả event loop (đặt NETCAFE_GREEN_IO=0 để tắt)
+ASYNC_MODE = os.environ.get("NETCAFE_ASYNC_MODE") or None
+if ASYNC_MODE in (None, "eventlet") and os.environ.get("NETCAFE_GREEN_IO", "1") == "1":
+    try:
+        import eventlet
+    except ImportError:
+        eventlet = None
+    if eventlet is not None:
+        eventlet.monkey_patch()
+        ASYNC_MODE = "eventlet"
+
+import atexit
+import functools
+import signal
+import threading
+import time
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g
+from datetime import datetime, timedelta
+
+from config import DB_CONFIG, DB_URL, SHARED_STORE_URL, SOCKETIO_MESSAGE_QUEUE
+from cluster import Cluster, SharedSessionTable, make_store
+from db_pool import ConnectionPool
+from dedup import DedupCache, PENDING
+from chat_janitor import ChatJanitor
+from directory import UserDirectory
+from message_writer import IdAllocator, MessageWriter, QueueFull
+from delivery import Delivery
+from loop_monitor import LoopMonitor
+from metrics import Registry
+from query_hooks import QueryHooks
+from query_profiler import QueryProfiler
+from migrate import MigrationRunner
+from presence import PresenceRegistry
+from reports import UsageRollups
+from repositories import MessageRepository, SessionRepository, TopupRepository, UserRepository
+from seat_grid import SeatGrid
+from storage import make_backend
+from usage import UsageLedger
+import wire
+from ledger import SessionLedger
+from expiry import ExpiryScheduler
 
 # Socket.IO for realtime
 from flask_socketio import SocketIO, join_room, leave_room, emit
@@ -9,8 +50,165 @@ from flask_socketio import SocketIO, join_room, leave_room, emit
 app = Flask(__name__)
 app.secret_key = "secret_key_cua_ban"
 
-# initialize SocketIO (will choose best async mode available)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# initialize SocketIO (will choose best async mode available); with several workers
+# the message queue relays emits to sockets connected to the other processes
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE,
+                    async_mode=ASYNC_MODE)
+
+# state every worker must agree on (presence, sessions, counters, billing leader);
+# kept in the process unless NETCAFE_SHARED_STORE_URL points at a shared store
+store = make_store(SHARED_STORE_URL)
+cluster = Cluster(store, lease_ttl=float(os.environ.get("NETCAFE_LEADER_LEASE_SECONDS", "10")))
+
+# every server-initiated event goes through one delivery path: distinct recipients,
+# one serialization, and events for the same rooms in the same tick batched together
+SOCKET_COALESCE = os.environ.get("NETCAFE_SOCKET_COALESCE", "1") == "1"
+# Bật định dạng gọn (mảng theo vị trí, xem wire.py): các trang sẽ yêu cầu nó khi join.
+# Mặc định tắt: mọi client nhận JSON như cũ
+COMPACT_WIRE = os.environ.get("NETCAFE_COMPACT_WIRE", "0") == "1"
+delivery = Delivery(
+    socketio, coalesce=SOCKET_COALESCE, compact=COMPACT_WIRE,
+    # room membership is only known locally when there is no message queue between workers
+    has_members=None if SOCKETIO_MESSAGE_QUEUE else (lambda room: room in socketio.server.manager.rooms.get('/', {}))
+)
+
+
+@app.context_processor
+def _socket_wire():
+    # the wire format pages ask for when they join (netcafe_socket.js)
+    return {'socket_wire': wire.COMPACT if COMPACT_WIRE else wire.JSON}
+
+
+# ============================
+# SỐ LIỆU GIÁM SÁT (METRICS)
+# ============================
+# hot-path series (routes, socket events, queries, billing ticks) are recorded into
+# preallocated buckets without locks; the rest is read from the existing stats()
+# when /metrics is scraped
+metrics = Registry()
+http_request_seconds = metrics.histogram(
+    "netcafe_http_request_duration_seconds", "Time spent in a Flask route.", ("route", "method", "status"))
+socket_event_seconds = metrics.histogram(
+    "netcafe_socket_event_duration_seconds", "Time spent in a Socket.IO event handler.", ("event",))
+db_queries = metrics.counter(
+    "netcafe_db_queries_total", "Statements executed, by normalized query shape.", ("shape",))
+db_query_seconds = metrics.counter(
+    "netcafe_db_query_seconds_total", "Time spent executing statements, by query shape.", ("shape",))
+db_query_rows = metrics.counter(
+    "netcafe_db_query_rows_total", "Rows returned or affected, by query shape.", ("shape",))
+billing_tick_seconds = metrics.histogram(
+    "netcafe_billing_tick_duration_seconds", "Time spent in one billing loop tick.")
+billing_tick_lag_seconds = metrics.histogram(
+    "netcafe_billing_tick_lag_seconds", "How late a billing tick finished after its scheduled time.")
+
+# every statement run through a pooled connection is reported to these hooks
+query_hooks = QueryHooks()
+
+
+@query_hooks.add
+def _count_query(shape, seconds, rows):
+    db_queries.labels(shape).inc()
+    db_query_seconds.labels(shape).inc(seconds)
+    if rows and rows > 0:
+        db_query_rows.labels(shape).inc(rows)
+
+
+# Bật profiler truy vấn theo từng request/sự kiện socket (1 = bật); ngưỡng truy vấn chậm (ms),
+# số lần cùng một truy vấn trong 1 request thì coi là N+1, file ghi truy vấn chậm (JSONL)
+QUERY_PROFILER = os.environ.get("NETCAFE_QUERY_PROFILER", "0") == "1"
+SLOW_QUERY_MS = float(os.environ.get("NETCAFE_SLOW_QUERY_MS", "100"))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("NETCAFE_N_PLUS_ONE_THRESHOLD", "3"))
+SLOW_QUERY_LOG = os.environ.get("NETCAFE_SLOW_QUERY_LOG") or None
+query_profiler = QueryProfiler(slow_query_seconds=SLOW_QUERY_MS / 1000,
+                               n_plus_one_threshold=N_PLUS_ONE_THRESHOLD,
+                               slow_log_path=SLOW_QUERY_LOG)
+if QUERY_PROFILER:
+    query_hooks.add(query_profiler.record)
+
+
+def _request_rule():
+    # label by URL rule, not path, so /admin/topup/<int:user_id> is one series
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    if QUERY_PROFILER:
+        g.query_profile = query_profiler.begin(f"{request.method} {_request_rule()}")
+
+
+@app.after_request
+def _observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        http_request_seconds.labels(_request_rule(), request.method, str(response.status_code)).observe(
+            time.perf_counter() - started)
+    token = g.pop('query_profile', None)
+    if token is not None:
+        profile = query_profiler.end(token)
+        # per-request breakdown: /admin/query_profile
+        response.headers['X-Query-Count'] = str(profile['queries'])
+        response.headers['X-Query-Time-Ms'] = str(profile['db_ms'])
+        if profile['n_plus_one']:
+            response.headers['X-Query-N-Plus-One'] = str(len(profile['n_plus_one']))
+    return response
+
+
+@app.teardown_request
+def _observe_failed_request(exc):
+    # after_request does not run when the view raised
+    started = g.pop('request_started', None)
+    if started is not None:
+        http_request_seconds.labels(_request_rule(), request.method, "500").observe(time.perf_counter() - started)
+    token = g.pop('query_profile', None)
+    if token is not None:
+        query_profiler.end(token)
+
+
+def timed_event(event):
+    """Record a Socket.IO handler's run time (and its queries, when profiling); goes under @socketio.on(event)."""
+    def decorator(handler):
+        hist = socket_event_seconds.labels(event)
+
+        @functools.wraps(handler)
+        def wrapper(*args):
+            token = query_profiler.begin(f"socket {event}") if QUERY_PROFILER else None
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                hist.observe(time.perf_counter() - started)
+                if token is not None:
+                    query_profiler.end(token)
+        return wrapper
+    return decorator
+
+
+# ============================
+# GIÁM SÁT ĐỘ TRỄ EVENT LOOP
+# ============================
+# Bật đo độ trễ event loop (1 = bật); chu kỳ đo (giây); event loop bị chặn quá ngưỡng (giây)
+# thì chụp stack của green thread đang chặn (xem /admin/loop_lag)
+LOOP_MONITOR = os.environ.get("NETCAFE_LOOP_MONITOR", "1") == "1"
+LOOP_MONITOR_INTERVAL = float(os.environ.get("NETCAFE_LOOP_MONITOR_INTERVAL", "0.1"))
+LOOP_STALL_THRESHOLD = float(os.environ.get("NETCAFE_LOOP_STALL_THRESHOLD", "0.25"))
+loop_lag_seconds = metrics.histogram(
+    "netcafe_event_loop_lag_seconds", "How late the event loop ran a task that asked to wake up.")
+if socketio.async_mode == 'eventlet':
+    # the watchdog must be a real OS thread to look at the hub while it is blocked
+    from eventlet import patcher
+    _os_threading, _os_sleep = patcher.original('threading'), patcher.original('time').sleep
+else:
+    _os_threading, _os_sleep = threading, time.sleep
+loop_monitor = LoopMonitor(socketio.sleep, socketio.start_background_task,
+                           interval=LOOP_MONITOR_INTERVAL, threshold=LOOP_STALL_THRESHOLD,
+                           watchdog=socketio.async_mode == 'eventlet',
+                           os_threading=_os_threading, os_sleep=_os_sleep,
+                           observe=loop_lag_seconds.observe)
+if LOOP_MONITOR:
+    loop_monitor.start()
+
 
 # Giá tiền 5k / 1 giờ
 COST_PER_HOUR = 5000
@@ -33,132 +231,520 @@ def seconds_to_hms(sec):
 # ============================
 # KẾT NỐI DATABASE
 # ============================
-def get_db_connection():
-    conn = pymysql.connect(
-        host="localhost",
-        user="root",
-        password="123456",
-        database="netcafe",
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=True
-    )
-    return conn
+# MySQL, or embedded SQLite (a WAL file or in memory), depending on NETCAFE_DB_URL
+backend = make_backend(DB_URL, DB_CONFIG)
+
+# Pool kết nối: số kết nối tối đa, thời gian giữ kết nối rảnh (giây), thời gian chờ lấy kết nối
+DB_POOL_SIZE = int(os.environ.get("NETCAFE_DB_POOL_SIZE", "10"))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get("NETCAFE_DB_POOL_IDLE_TIMEOUT", "300"))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get("NETCAFE_DB_POOL_CHECKOUT_TIMEOUT", "5"))
+# Chỉ ping kiểm tra kết nối đã rảnh lâu hơn số giây này trước khi dùng lại
+DB_POOL_PING_AFTER = float(os.environ.get("NETCAFE_DB_POOL_PING_AFTER", "30"))
+# Thời gian tối đa (giây) cho mỗi lần gửi/nhận của 1 truy vấn; quá hạn thì truy vấn lỗi
+# và kết nối bị bỏ khỏi pool. Số truy vấn chạy cùng lúc bị giới hạn bởi DB_POOL_SIZE.
+DB_QUERY_TIMEOUT = float(os.environ.get("NETCAFE_DB_QUERY_TIMEOUT", "30"))
+DB_CONNECT_TIMEOUT = float(os.environ.get("NETCAFE_DB_CONNECT_TIMEOUT", "5"))
+
+
+DB_CURSOR_CLASS = query_hooks.cursor_class(backend.cursor_class)
+
+
+def _connect_db(query_timeout=DB_QUERY_TIMEOUT):
+    return backend.connect(DB_CURSOR_CLASS, query_timeout=query_timeout, connect_timeout=DB_CONNECT_TIMEOUT)
 
 
-# Ensure DB schema has expected columns (run-once safe)
+db_pool = ConnectionPool(
+    _connect_db,
+    max_size=DB_POOL_SIZE,
+    idle_timeout=DB_POOL_IDLE_TIMEOUT,
+    checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT,
+    ping_after=DB_POOL_PING_AFTER,
+)
+
+
+def db_connection():
+    """Check a connection out of the pool; it is returned when the with-block exits."""
+    return db_pool.connection()
+
+
+def _migration_connection():
+    # schema changes on a big table may take longer than any query should
+    return backend.connection(DB_CURSOR_CLASS, query_timeout=None)
+
+
+# Bring the DB schema up to date (versioned migrations in migrations/, run-once safe)
 def ensure_db_schema():
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        # Ensure topup_requests has user_notified column
-        try:
-            cur.execute("SELECT user_notified FROM topup_requests LIMIT 1")
-        except InternalError:
-            cur.execute("ALTER TABLE topup_requests ADD COLUMN user_notified TINYINT(1) DEFAULT 0")
+    MigrationRunner(_migration_connection, dialect=backend.dialect).run()
 
 
 # call schema ensure at startup
 ensure_db_schema()
 
-# map user_id -> set of socket ids for connected clients
-active_user_sids = {}
-# map admin socket id -> current target user id
-admin_targets = {}
-# map user_id -> background task handle (to avoid multiple tasks per user)
-user_time_tasks = {}
+# the SQL of the routes and socket handlers, per table group
+user_repo = UserRepository(db_connection)
+session_repo = SessionRepository(db_connection)
+topup_repo = TopupRepository(db_connection)
+message_repo = MessageRepository(db_connection)
+
+# id -> (username, role), username -> id and the admin ids, cached in memory;
+# anything that creates or changes a user must call directory.invalidate()
+directory = UserDirectory(db_connection, store=store)
+
+# which sockets belong to which user (both directions) and each admin's chat target
+presence = PresenceRegistry(store, worker_id=cluster.worker_id)
+# Thời gian chờ (giây) sau khi user mất socket cuối cùng rồi mới chốt phiên; kết nối lại
+# trong khoảng này (chuyển trang, rớt Wi-Fi) thì phiên vẫn chạy tiếp
+PRESENCE_GRACE_SECONDS = float(os.environ.get("NETCAFE_PRESENCE_GRACE_SECONDS", "10"))
+# users whose last socket went away, waiting out the grace period: user_id -> offline since
+offline_pending = {'users': {}, 'scheduled': False, 'lock': threading.Lock()}
+
+
+# Chu kỳ tính tiền (giây) cho vòng lặp billing trung tâm
+BILLING_TICK_SECONDS = float(os.environ.get("NETCAFE_BILLING_TICK_SECONDS", "1"))
+# Chu kỳ ghi mốc last_active của các phiên đang chạy xuống DB (checkpoint, giây)
+BILLING_CHECKPOINT_SECONDS = float(os.environ.get("NETCAFE_BILLING_CHECKPOINT_SECONDS", "30"))
+# Cách đồng bộ đồng hồ cho client:
+#   "deadline": gửi 1 lần thời điểm hết giờ, client tự đếm ngược (chỉ gửi lại khi số dư thay đổi)
+#   "tick": gửi time_update mỗi giây như trước
+TIME_UPDATE_MODE = os.environ.get("NETCAFE_TIME_UPDATE_MODE", "deadline")
+
+# authoritative record of running sessions; balances are derived on demand and
+# only written back to the database as usage events when a session stops or is topped up
+# (usage_events, with users.balance as their materialized sum). With a shared store
+# the sessions live there so any worker can start, credit or stop them.
+session_table = SharedSessionTable(store) if store.shared else None
+ledger = SessionLedger(COST_PER_SECOND, sessions=session_table,
+                       lock=store.lock("netcafe:ledger") if store.shared else None)
+# hourly / daily report rows, updated in the same transaction as the usage events
+rollups = UsageRollups(db_connection, dialect=backend.dialect)
+usage_ledger = UsageLedger(db_connection, on_record=rollups.apply, dialect=backend.dialect)
+# zero-balance time of every session; the expiry task sleeps until the earliest one
+expiry = ExpiryScheduler()
+expiry_wakeup = socketio.server.eio.create_event()
+# running seats as the admins room last saw them; the billing leader sends what changed each tick
+seat_grid = SeatGrid()
+
+# state of the single billing scheduler (one task for all online users); the loops
+# run on every worker but only the holder of the leader lease does the work
+billing_state = {
+    'task': None,
+    'ticks': 0,
+    'last_lag': 0.0,
+    'last_duration': 0.0,
+    'last_seats': 0,
+    'last_checkpoint': 0.0,
+    'expiry_task': None,
+    'cutoffs': 0,
+    'sessions_version': None,
+    'next_reap': 0.0,
+}
+
+
+# ============================
+# CHECKPOINT PHIÊN ĐANG CHẠY
+# ============================
+def _persist_sessions(user_ids=None, now=None):
+    """Mark the given users (or every session) online, with ``last_active`` = now, in one UPDATE.
+
+    Balances are not written here: they only change through usage events. After a
+    restart, ``last_active`` tells how far a session had been billed.
+    """
+    # last_active is a second-precision TIMESTAMP: checkpoint on a whole second
+    now = int(now if now is not None else ledger.now())
+    session_repo.checkpoint([uid for uid, _ in ledger.snapshot(user_ids, now)], datetime.fromtimestamp(now))
+
+
+def _deadline_payload(user_id):
+    """Authoritative "session expires at T" message for a running session (times in epoch ms)."""
+    now = ledger.now()
+    s = ledger.get(user_id)
+    if s is None:
+        return None
+    expires_at = s.expires_at()
+    return {
+        'user_id': user_id,
+        'balance': s.balance(now),
+        # đồng per hour: the client derives the balance from the deadline as it counts down
+        'hourly_rate': s.rate * 3600,
+        'expires_at': int(expires_at * 1000) if expires_at is not None else None,
+        'server_time': int(now * 1000),
+        'status': 'OK'
+    }
+
+
+def _push_deadline(user_id, to=None):
+    """Send the session deadline to a user's clients; only called when it changes."""
+    payload = _deadline_payload(user_id)
+    if payload is None:
+        return
+    try:
+        delivery.send('session_deadline', payload, to or f"user_{user_id}")
+    except Exception:
+        pass
+
+
+def _schedule_expiry(user_id):
+    """(Re)schedule the cutoff of a session at its computed zero-balance time."""
+    s = ledger.get(user_id)
+    if s is None or s.expires_at() is None:
+        expiry.cancel(user_id)
+        return
+    expiry.schedule(user_id, s.expires_at())
+    # the expiry task may be sleeping towards a later deadline
+    expiry_wakeup.set()
+
+
+def _start_session(user_id, balance):
+    """Open a billed session for a user and persist the starting point."""
+    if user_id not in ledger:
+        ledger.start(user_id, balance)
+        _schedule_expiry(user_id)
+        usage_ledger.record([UsageLedger.event(user_id, 'start')])
+    _persist_sessions([user_id])
+    _ensure_billing_loop()
+    _push_deadline(user_id)
+    _send_admin_delta(users={'changed': [_user_row(user_id, is_online=1)]})
+
 
-def _start_user_time_task(user_id):
-    """Start a background task that updates a user's time every second and emits updates.
-    Uses socketio.start_background_task to avoid raw threads.
+def _end_session(user_ids, now=None, at=None):
+    """Close sessions, record their charges as stop events and mark the users offline.
+
+    Returns {user_id: final balance}.
+
+    ``at`` optionally maps user ids to the time their session really ended (e.g. when
+    their last socket went away); everyone else is closed at ``now``.
+    """
+    now = now if now is not None else ledger.now()
+    at = at or {}
+    final = {}
+    ended = {}
+    events = []
+    for uid in user_ids:
+        expiry.cancel(uid)
+        t = at.get(uid, now)
+        # settle at the exact time; only the stored timestamps are whole seconds
+        stopped = ledger.stop(uid, t)
+        if stopped is not None:
+            final[uid], seconds, charge = stopped
+            ended[uid] = datetime.fromtimestamp(int(t))
+            events.append(UsageLedger.event(uid, 'stop', -charge, seconds, at=ended[uid]))
+    usage_ledger.record(events)
+    session_repo.close(ended, [uid for uid in user_ids if uid not in final])
+    if final:
+        _send_admin_delta(users={'changed': [_user_row(uid, is_online=0, balance=bal)
+                                             for uid, bal in final.items()]})
+    return final
+
+
+def _credit_user(user_id, amount, ref_id=None):
+    """Add money to a user, going through the ledger when the user is in session.
+
+    ``ref_id`` is the approved topup request, if any, kept on the topup event.
     """
-    if user_id in user_time_tasks:
+    settled = ledger.credit(user_id, amount)
+    if settled is not None:
+        # charge the time used so far, then the topup, so every event's balance is exact
+        _, seconds, charge = settled
+        events = [UsageLedger.event(user_id, 'topup', amount, ref_id=ref_id)]
+        if charge or seconds:
+            events.insert(0, UsageLedger.event(user_id, 'usage', -charge, seconds))
+        usage_ledger.record(events)
+        _schedule_expiry(user_id)
+        _push_deadline(user_id)
+        _send_admin_delta(users={'changed': [_user_row(user_id)]})
         return
+    balances = usage_ledger.record([UsageLedger.event(user_id, 'topup', amount, ref_id=ref_id)])
+    if user_id in balances:
+        _send_admin_delta(users={'changed': [_user_row(user_id, balance=balances[user_id])]})
+
+
+def _recover_sessions():
+    """Rebuild the ledger after a restart from the last usage event and checkpoint.
 
-    def task():
-        # run until user is offline or removed from tracking
+    users.balance is the balance at the user's latest usage event, and the session
+    had been billed from that event up to ``last_active``. The time the server was
+    down is not charged: the session resumes now as if it had started that much later.
+    """
+    rows = session_repo.running()
+    now = ledger.now()
+    for r in rows:
+        checkpoint = r['last_active'].timestamp() if r['last_active'] else now
+        started_at = r['since'].timestamp() if r['since'] else checkpoint
+        ledger.start(r['id'], r['balance'], started_at=started_at + max(0.0, now - checkpoint))
+        _schedule_expiry(r['id'])
+    if rows:
+        _ensure_billing_loop()
+    # a user whose page never reconnects has no socket left to disconnect: close
+    # them like any lost socket, unless one joins within the grace period
+    offline = [r['id'] for r in rows if not presence.is_online(r['id'])]
+    if offline:
+        _mark_offline(offline, since=now)
+
+
+# ============================
+# VÒNG LẶP TÍNH TIỀN TRUNG TÂM
+# ============================
+def _billing_tick():
+    """Periodic work for all sessions in one pass.
+
+    Cutoffs are handled by the expiry task, so a normal tick makes no queries: it
+    only builds per-second time_update payloads in "tick" mode and checkpoints every
+    session's last_active in one UPDATE every BILLING_CHECKPOINT_SECONDS.
+    """
+    now = ledger.now()
+    payloads = []
+    if TIME_UPDATE_MODE == 'tick':
+        for uid, bal in ledger.snapshot(now=now):
+            payloads.append({
+                'user_id': uid,
+                'balance': bal,
+                'seconds_left': int(bal / COST_PER_SECOND) if COST_PER_SECOND else 0,
+                'status': 'OK',
+                'server_time': int(now * 1000)
+            })
+
+    if now - billing_state['last_checkpoint'] >= BILLING_CHECKPOINT_SECONDS:
+        _persist_sessions(now=now)
+        billing_state['last_checkpoint'] = now
+    return payloads
+
+
+def _reconcile_expiry(now=None):
+    """Rebuild this worker's expiry schedule from the (shared) session table.
+
+    Used by the billing leader when it takes over and whenever another worker has
+    changed a session, since those changes only reached the shared table.
+    """
+    now = now if now is not None else ledger.now()
+    live = set()
+    for uid, bal in ledger.snapshot(now=now):
+        live.add(uid)
+        expiry.schedule(uid, now + bal / COST_PER_SECOND)
+    for uid in expiry.keys():
+        if uid not in live:
+            expiry.cancel(uid)
+    expiry_wakeup.set()
+
+
+def _billing_loop():
+    next_tick = time.monotonic()
+    while True:
+        next_tick += BILLING_TICK_SECONDS
+        started = time.monotonic()
+        payloads = []
+        grid_frame = None
+        leader, became_leader = cluster.heartbeat()
+        if leader:
+            try:
+                sessions_changed = True
+                if session_table is not None:
+                    version = session_table.version()
+                    sessions_changed = became_leader or version != billing_state['sessions_version']
+                    if sessions_changed:
+                        billing_state['sessions_version'] = version
+                        _reconcile_expiry()
+                elif became_leader:
+                    expiry_wakeup.set()
+                payloads = _billing_tick()
+                if started >= billing_state['next_reap']:
+                    billing_state['next_reap'] = started + cluster.lease_ttl
+                    _reap_dead_workers()
+                # peak concurrent seats for the reports; only writes when a new peak is reached
+                rollups.note_seats(len(ledger))
+                # seats started, topped up or stopped since the last tick, in one frame for the admins
+                if sessions_changed:
+                    grid_frame = seat_grid.delta(ledger.deadlines(), ledger.now())
+            except Exception as e:
+                print('[billing] tick failed', e)
+
+        if grid_frame is not None:
+            try:
+                delivery.send('seat_grid', grid_frame, 'admins')
+            except Exception:
+                pass
+
+        # fan out all time_update payloads for this tick in one pass
+        for payload in payloads:
+            try:
+                delivery.send('time_update', payload, f"user_{payload['user_id']}")
+            except Exception:
+                pass
+
+        finished = time.monotonic()
+        billing_state['ticks'] += 1
+        billing_state['last_duration'] = finished - started
+        billing_state['last_seats'] = len(payloads)
+        # ticks are scheduled on a fixed grid so they do not drift; if a tick overran
+        # skip ahead instead of bursting to catch up
+        if finished > next_tick:
+            billing_state['last_lag'] = finished - next_tick
+            next_tick = finished
+        else:
+            billing_state['last_lag'] = 0.0
+        billing_tick_seconds.observe(billing_state['last_duration'])
+        billing_tick_lag_seconds.observe(billing_state['last_lag'])
+        socketio.sleep(max(0.0, next_tick - finished))
+
+
+def _reap_dead_workers():
+    """Forget the sockets of workers that stopped renewing their lease (crashed, killed)."""
+    offline = presence.reap(cluster.is_alive)
+    if offline:
+        print('[cluster] reaped the sockets of stopped workers, users now offline:', offline)
+        _mark_offline(offline)
+
+
+def _cut_off(user_ids):
+    """Close sessions whose balance reached zero and tell their clients."""
+    now = ledger.now()
+    out_ids = []
+    for uid in user_ids:
+        bal = ledger.balance(uid, now)
+        if bal is None:
+            continue
+        # allow for float rounding right at the deadline
+        if bal < 0.01:
+            out_ids.append(uid)
+        else:
+            _schedule_expiry(uid)
+    if not out_ids:
+        return
+    _end_session(out_ids, now)
+    billing_state['cutoffs'] += len(out_ids)
+    for uid in out_ids:
         try:
-            while True:
-                # check if user still has connected sids or is online
-                conn = get_db_connection()
-                with conn.cursor() as cur:
-                    cur.execute("SELECT is_online, balance, last_active FROM users WHERE id=%s", (user_id,))
-                    row = cur.fetchone()
-                if not row or row.get('is_online') == 0:
-                    break
-
-                # update time and balance
-                res = update_user_time(user_id)
-
-                # fetch latest balance and compute seconds left
-                conn = get_db_connection()
-                with conn.cursor() as cur:
-                    cur.execute("SELECT balance FROM users WHERE id=%s", (user_id,))
-                    r = cur.fetchone()
-                bal = float(r.get('balance') or 0)
-                seconds_left = int(bal / COST_PER_SECOND) if COST_PER_SECOND else 0
-
-                payload = {
-                    'user_id': user_id,
-                    'balance': bal,
-                    'seconds_left': seconds_left,
-                    'status': res
-                }
-                try:
-                    socketio.emit('time_update', payload, room=f"user_{user_id}")
-                except Exception:
-                    pass
+            delivery.send('time_update', {'user_id': uid, 'balance': 0, 'seconds_left': 0, 'status': 'OUT'},
+                          f"user_{uid}")
+        except Exception:
+            pass
 
-                if res == 'OUT':
-                    # user ran out of money; stop task
-                    break
 
-                socketio.sleep(1)
-        finally:
-            # cleanup
-            user_time_tasks.pop(user_id, None)
+def _expiry_loop():
+    """Sleep until the earliest zero-balance deadline and cut off exactly the sessions due."""
+    while True:
+        expiry_wakeup.clear()
+        if not cluster.is_leader():
+            # the billing loop wakes us up when this worker takes over
+            expiry_wakeup.wait(cluster.lease_ttl / 3)
+            continue
+        due = expiry.pop_due(ledger.now())
+        if due:
+            try:
+                _cut_off(due)
+            except Exception as e:
+                print('[billing] cutoff failed', e)
+        nxt = expiry.next_deadline()
+        timeout = None if nxt is None else max(0.0, nxt - ledger.now())
+        expiry_wakeup.wait(timeout)
+
+
+def _ensure_billing_loop():
+    """Start the billing scheduler and the expiry task once; they serve every online user.
+
+    Every worker runs both tasks so that one of them can take over the leader lease.
+    """
+    if billing_state['task'] is None:
+        billing_state['task'] = socketio.start_background_task(_billing_loop)
+    if billing_state['expiry_task'] is None:
+        billing_state['expiry_task'] = socketio.start_background_task(_expiry_loop)
+
 
-    # start and store a handle (not required by flask-socketio but keep presence)
-    th = socketio.start_background_task(task)
-    user_time_tasks[user_id] = th
 # ============================
 # HÀM UPDATE THỜI GIAN - TRỪ TIỀN
 # ============================
 def update_user_time(user_id):
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT balance, last_active, is_online FROM users WHERE id=%s", (user_id,))
-        u = cur.fetchone()
+    """Return the user's billing status: "OK", "OUT" (session closed) or None."""
+    bal = ledger.balance(user_id)
+    if bal is None:
+        return "OK"  # không online → không trừ tiền
+    if bal <= 0:
+        _end_session([user_id])
+        return "OUT"
+    return "OK"
+
+
+
+# ============================
+# ĐỒNG BỘ ADMIN DASHBOARD (SNAPSHOT + DELTA)
+# ============================
+# Số yêu cầu nạp tiền mỗi trang trên admin dashboard
+ADMIN_REQUESTS_PAGE_SIZE = int(os.environ.get("NETCAFE_ADMIN_REQUESTS_PAGE_SIZE", "50"))
 
-        if not u:
-            return None
+# version of the admin dashboard state (a shared counter, so it is the same on every
+# worker); every delta sent to the admins room bumps it
+ADMIN_VERSION_KEY = "netcafe:admin_version"
 
-        if u["is_online"] == 0:
-            return "OK"  # không online → không trừ tiền
 
-        now = datetime.now()
+def _admin_version():
+    return store.get_int(ADMIN_VERSION_KEY)
 
-        if u["last_active"] is None:
-            cur.execute("UPDATE users SET last_active=%s WHERE id=%s", (now, user_id))
-            return "OK"
 
+def _user_row(user_id, **fields):
+    """Admin dashboard view of (part of) a user row; live balance comes from the ledger."""
+    row = {'id': user_id}
+    row.update(fields)
+    bal = ledger.balance(user_id)
+    if bal is None and 'balance' in fields:
+        bal = float(fields['balance'] or 0)
+    if bal is not None:
+        row['balance'] = bal
+        row['seconds_left'] = int(bal / COST_PER_SECOND)
+    return row
 
-        
 
-        elapsed = (now - u["last_active"]).total_seconds()
+def _request_row(req):
+    if isinstance(req.get('created_at'), datetime):
+        req['created_at'] = str(req['created_at'])
+    return req
 
-        if elapsed <= 0:
-            return "OK"
 
-        money_lost = elapsed * COST_PER_SECOND
-        new_balance = u["balance"] - money_lost
+def _send_admin_delta(users=None, requests=None):
+    """Bump the dashboard version and push only the changed rows to the admins room.
+
+    ``users`` / ``requests`` are dicts with optional 'added' and 'changed' (lists of
+    rows) and 'removed' (list of ids). Clients that see a gap in versions re-fetch
+    the snapshot.
+    """
+    version = store.incr(ADMIN_VERSION_KEY)
+    delta = {'version': version, 'users': users or {}, 'requests': requests or {}}
+    try:
+        delivery.send('admin_delta', delta, 'admins')
+    except Exception:
+        pass
 
-        if new_balance <= 0:
-            cur.execute("UPDATE users SET balance=0, is_online=0 WHERE id=%s", (user_id,))
-            return "OUT"
 
-        cur.execute("UPDATE users SET balance=%s, last_active=%s WHERE id=%s",
-                    (new_balance, now, user_id))
+def fetch_admin_users():
+    return [_user_row(u['id'], username=u['username'], is_online=u['is_online'], balance=u['balance'])
+            for u in user_repo.list()]
 
-        return "OK"
+
+def fetch_topup_page(status=None, before_id=None, since=None, until=None, limit=None):
+    """Return (requests, has_more): newest topup requests first, keyset-paginated by id."""
+    rows, has_more = topup_repo.page(limit or ADMIN_REQUESTS_PAGE_SIZE, status=status, before_id=before_id,
+                                 since=since, until=until)
+    return [_request_row(r) for r in rows], has_more
+
+
+def _topup_page_args():
+    """Filters for fetch_topup_page from the query string (status, before, since, until)."""
+    return {
+        'status': request.args.get('status') or None,
+        'before_id': request.args.get('before', type=int),
+        'since': request.args.get('since') or None,
+        'until': request.args.get('until') or None,
+    }
+
+
+def _wants_json():
+    return request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+
+
+def _admin_result(ok, message):
+    """Finish an admin action: JSON for dashboard fetch() calls, flash + redirect otherwise."""
+    if _wants_json():
+        return jsonify({'ok': ok, 'message': message, 'version': _admin_version()}), (200 if ok else 400)
+    flash(message, "success" if ok else "danger")
+    return redirect(url_for("admin_dashboard"))
 
 
 # ============================
@@ -170,34 +756,20 @@ def login():
         username = request.form.get("username")
         password = request.form.get("password")
 
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE username=%s AND password=%s",
-                        (username, password))
-            user = cur.fetchone()
+        user = user_repo.authenticate(username, password)
 
         if user:
             session["user_id"] = user["id"]
             session["username"] = user["username"]
             session["role"] = user["role"]
 
-            with conn.cursor() as cur:
-                # QUAN TRỌNG: Reset last_active = NOW() để bắt đầu đếm giờ lại từ đầu
-                # Bỏ qua khoảng thời gian offline trước đó
-                cur.execute(
-                    "UPDATE users SET is_online=1, last_active=%s WHERE id=%s",
-                    (datetime.now(), user["id"])
-                )
-
-                # Báo cho admin biết user online
-                try:
-                    socketio.emit('user_status', {'user_id': user['id'], 'is_online': 1}, room='admins')
-                except Exception:
-                    pass
-            
-            # Kích hoạt task đếm giờ ngay lập tức
+            # QUAN TRỌNG: Bắt đầu phiên tính giờ từ NOW()
+            # Bỏ qua khoảng thời gian offline trước đó
+            # (admins see the seat start in the next seat_grid frame)
             if user["role"] == "user":
-                 _start_user_time_task(user["id"])
+                _start_session(user["id"], user["balance"])
+            else:
+                user_repo.mark_online(user["id"], datetime.now())
 
             if user["role"] == "admin":
                 return redirect(url_for("admin_dashboard"))
@@ -217,34 +789,20 @@ def logout():
     user_id = session.get("user_id")
 
     if user_id:
-        # 1. Cập nhật tiền lần cuối cùng trước khi logout
-        update_user_time(user_id)
-
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            # 2. Set trạng thái về Offline
-            cur.execute("UPDATE users SET is_online=0 WHERE id=%s", (user_id,))
-        
-        # ... (Phần code xóa chat và dọn dẹp giữ nguyên như cũ) ...
-        try:
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM messages WHERE from_user_id=%s OR to_user_id=%s", (user_id, user_id))
-        except Exception:
-            pass
+        # 1. Chốt số dư lần cuối và 2. set trạng thái về Offline
+        _end_session([user_id])
 
+        # Xoá chat: chỉ ghi yêu cầu, janitor xoá (và lưu trữ) ở nền
         try:
-            socketio.emit('user_status', {'user_id': user_id, 'is_online': 0}, room='admins')
-            socketio.emit('clear_chat', {'user_id': user_id}, room='admins')
-            socketio.emit('clear_chat', {'user_id': user_id}, room=f"user_{user_id}")
-            
-            # Gửi tín hiệu PAUSE về client để đồng hồ dừng ngay lập tức
-            socketio.emit('time_update', {'user_id': user_id, 'status': 'PAUSED'}, room=f"user_{user_id}")
-        except Exception:
-            pass
+            _request_chat_purge(user_id)
+        except Exception as e:
+            print('[janitor] purge request failed', e)
 
-        # Dừng background task
         try:
-            user_time_tasks.pop(user_id, None)
+            delivery.send('clear_chat', {'user_id': user_id}, ['admins', f"user_{user_id}"])
+
+            # Gửi tín hiệu PAUSE về client để đồng hồ dừng ngay lập tức
+            delivery.send('time_update', {'user_id': user_id, 'status': 'PAUSED'}, f"user_{user_id}")
         except Exception:
             pass
 
@@ -261,21 +819,15 @@ def user_dashboard():
         return redirect(url_for("login"))
 
     user_id = session["user_id"]
-    conn = get_db_connection()
 
     # XỬ LÝ TRƯỜNG HỢP RELOAD TRANG:
-    # Nếu DB đang ghi nhận là offline (do socket disconnect khi reload), ta phải set lại Online
-    # và reset last_active để tránh trừ tiền oan trong tích tắc reload.
-    with conn.cursor() as cur:
-        cur.execute("SELECT is_online, last_active FROM users WHERE id=%s", (user_id,))
-        u_status = cur.fetchone()
-        
-        if u_status and u_status['is_online'] == 0:
+    # Nếu user không còn phiên tính giờ (do socket disconnect khi reload), ta phải mở lại phiên
+    # từ NOW() để tránh trừ tiền oan trong tích tắc reload.
+    if user_id not in ledger:
+        balance = user_repo.balance(user_id)
+        if balance is not None:
             # User đang reload trang -> Set lại Online và Resume thời gian
-            cur.execute("UPDATE users SET is_online=1, last_active=%s WHERE id=%s", 
-                        (datetime.now(), user_id))
-            # Khởi động lại task đếm giờ
-            _start_user_time_task(user_id)
+            _start_session(user_id, balance)
 
     # Auto trừ tiền (Bình thường)
     result = update_user_time(user_id)
@@ -285,17 +837,15 @@ def user_dashboard():
         return redirect(url_for("login"))
 
     # ... (Phần còn lại giữ nguyên) ...
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM users WHERE id=%s", (user_id,))
-        user = cur.fetchone()
-        
-        # ... code lấy requests_list ...
-        cur.execute("SELECT * FROM topup_requests WHERE user_id=%s ORDER BY created_at DESC", (user_id,))
-        requests_list = cur.fetchall()
-        
-        # Compute seconds left
+    user = user_repo.get(user_id)
+    requests_list = topup_repo.for_user(user_id)
+
+    # Compute seconds left (số dư hiện tại lấy từ phiên đang chạy)
+    bal = ledger.balance(user_id)
+    if bal is None:
         bal = float(user['balance'] or 0)
-        seconds_left = int(bal / COST_PER_SECOND)
+    user['balance'] = bal
+    seconds_left = int(bal / COST_PER_SECOND)
 
     return render_template("user_dashboard.html", user=user, requests_list=requests_list, seconds_left=seconds_left)
 
@@ -320,20 +870,13 @@ def user_request_topup():
         return redirect(url_for("user_dashboard"))
     user_id = session["user_id"]
 
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("INSERT INTO topup_requests (user_id, amount, status, user_notified) "
-                    "VALUES (%s, %s, 'pending', 0)", (user_id, amount))
-        # notify admin clients in real-time about new topup request
-        try:
-            req_id = cur.lastrowid
-            cur.execute("SELECT tr.id, tr.user_id, tr.amount, tr.status, tr.created_at, u.username FROM topup_requests tr JOIN users u ON tr.user_id=u.id WHERE tr.id=%s", (req_id,))
-            new_req = cur.fetchone()
-            if new_req and isinstance(new_req.get('created_at'), datetime):
-                new_req['created_at'] = str(new_req['created_at'])
-            socketio.emit('new_topup_request', new_req, room='admins')
-        except Exception:
-            pass
+    new_req = topup_repo.create(user_id, amount)
+    # notify admin clients in real-time about new topup request
+    try:
+        if new_req:
+            _send_admin_delta(requests={'added': [_request_row(new_req)]})
+    except Exception:
+        pass
 
     flash("Đã gửi yêu cầu nạp tiền!", "success")
     return redirect(url_for("user_dashboard"))
@@ -347,27 +890,224 @@ def admin_dashboard():
     if "user_id" not in session or session["role"] != "admin":
         return redirect(url_for("login"))
 
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT id, username, balance, is_online, last_active FROM users WHERE role='user'")
-        users = cur.fetchall()
-        # compute seconds_left for each user (balance -> seconds)
-        for u in users:
-            try:
-                bal = float(u.get('balance') or 0)
-            except Exception:
-                bal = 0.0
-            u['seconds_left'] = int(bal / COST_PER_SECOND)
+    # initial render only: afterwards the page is kept up to date by admin_delta events
+    version = _admin_version()
+    users = fetch_admin_users()
+    requests_list, has_more = fetch_topup_page()
+
+    return render_template("admin_dashboard.html", users=users, requests_list=requests_list,
+                           has_more=has_more, version=version, rate=COST_PER_SECOND)
+
+
+# ============================
+# ADMIN API: SNAPSHOT + PHÂN TRANG YÊU CẦU NẠP TIỀN
+# ============================
+@app.route("/admin/api/snapshot")
+def admin_api_snapshot():
+    if "user_id" not in session or session["role"] != "admin":
+        return jsonify({'error': 'forbidden'}), 403
+    version = _admin_version()
+    users = fetch_admin_users()
+    requests_list, has_more = fetch_topup_page(**_topup_page_args())
+    return jsonify({'version': version, 'users': users,
+                    'requests': {'items': requests_list, 'has_more': has_more}})
+
+
+@app.route("/admin/api/requests")
+def admin_api_requests():
+    if "user_id" not in session or session["role"] != "admin":
+        return jsonify({'error': 'forbidden'}), 403
+    requests_list, has_more = fetch_topup_page(**_topup_page_args())
+    return jsonify({'items': requests_list, 'has_more': has_more})
+
+
+# ============================
+# ADMIN XEM THỐNG KÊ POOL KẾT NỐI DB
+# ============================
+@app.route("/admin/db_pool")
+def admin_db_pool_stats():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(dict(db_pool.stats(), backend=backend.describe()))
+
+
+# ============================
+# ADMIN XEM THỐNG KÊ GỬI SỰ KIỆN SOCKET
+# ============================
+@app.route("/admin/delivery")
+def admin_delivery_stats():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(delivery.stats())
+
+
+# ============================
+# ADMIN XEM THỐNG KÊ LƯỚI MÁY (SEAT GRID)
+# ============================
+@app.route("/admin/seat_grid")
+def admin_seat_grid_stats():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(seat_grid.stats())
+
+
+# ============================
+# ADMIN XEM THỐNG KÊ CACHE DANH BẠ USER
+# ============================
+@app.route("/admin/directory")
+def admin_directory_stats():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(directory.stats())
 
-        cur.execute("""
-            SELECT tr.*, u.username
-            FROM topup_requests tr
-            JOIN users u ON tr.user_id = u.id
-            ORDER BY tr.created_at DESC
-        """)
-        requests_list = cur.fetchall()
 
-    return render_template("admin_dashboard.html", users=users, requests_list=requests_list)
+# ============================
+# ADMIN XEM THỐNG KÊ HÀNG ĐỢI GHI TIN NHẮN
+# ============================
+@app.route("/admin/chat_writer")
+def admin_chat_writer_stats():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(chat_writer.stats())
+
+
+# ============================
+# ADMIN XEM THỐNG KÊ DỌN CHAT
+# ============================
+@app.route("/admin/chat_janitor")
+def admin_chat_janitor_stats():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(chat_janitor.stats())
+
+
+# ============================
+# ADMIN XEM TRẠNG THÁI CÁC WORKER
+# ============================
+@app.route("/admin/cluster")
+def admin_cluster_stats():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify({
+        'worker_id': cluster.worker_id,
+        'shared_store': store.shared,
+        'message_queue': bool(SOCKETIO_MESSAGE_QUEUE),
+        'billing_leader': cluster.is_leader(),
+        'elections': cluster.elections,
+        'sessions': len(ledger),
+        'online_users': presence.online_count(),
+    })
+
+
+# ============================
+# ADMIN XEM SỔ CÁI SỬ DỤNG CỦA 1 USER
+# ============================
+@app.route("/admin/usage/<int:user_id>")
+def admin_usage_history(user_id):
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    before_id = request.args.get("before_id", type=int)
+    events = usage_ledger.history(user_id, before_id=before_id)
+    for e in events:
+        e['created_at'] = str(e['created_at'])
+    return jsonify({'user_id': user_id, 'events': events})
+
+
+# ============================
+# ADMIN KIỂM TRA SỐ DƯ KHỚP SỔ CÁI
+# ============================
+@app.route("/admin/usage_audit")
+def admin_usage_audit():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify({'stats': usage_ledger.stats(), 'mismatches': usage_ledger.audit()})
+
+
+# ============================
+# ADMIN XEM ĐỘ TRỄ EVENT LOOP VÀ CÁC LẦN BỊ CHẶN
+# ============================
+@app.route("/admin/loop_lag")
+def admin_loop_lag():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(dict(loop_monitor.stats(), enabled=LOOP_MONITOR))
+
+
+# ============================
+# ADMIN XEM BÁO CÁO DOANH THU / SỬ DỤNG
+# ============================
+# Số mốc (giờ/ngày) tối đa trong 1 báo cáo
+REPORT_MAX_BUCKETS = int(os.environ.get("NETCAFE_REPORT_MAX_BUCKETS", "1000"))
+
+
+@app.route("/admin/reports")
+def admin_reports():
+    # ?period=hour|day&start=2024-06-01[T08:00]&end=...; defaults: last 24 hours / last 30 days
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    period = request.args.get("period", "hour")
+    if period not in ('hour', 'day'):
+        return jsonify({'error': 'period must be hour or day'}), 400
+    try:
+        end = datetime.fromisoformat(request.args["end"]) if request.args.get("end") else datetime.now()
+        start = (datetime.fromisoformat(request.args["start"]) if request.args.get("start")
+                 else end - timedelta(hours=24 if period == 'hour' else 24 * 30))
+    except ValueError:
+        return jsonify({'error': 'start / end must be ISO dates'}), 400
+    span = timedelta(hours=1) if period == 'hour' else timedelta(days=1)
+    if (end - start) / span > REPORT_MAX_BUCKETS:
+        return jsonify({'error': f'at most {REPORT_MAX_BUCKETS} buckets per report'}), 400
+    return jsonify(rollups.range(period, start, end))
+
+
+# ============================
+# ADMIN XEM PROFILE TRUY VẤN THEO REQUEST
+# ============================
+@app.route("/admin/query_profile")
+def admin_query_profile():
+    if "user_id" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify({
+        'enabled': QUERY_PROFILER,
+        'stats': query_profiler.stats(),
+        'profiles': query_profiler.recent(n_plus_one_only=request.args.get('n_plus_one') == '1'),
+    })
+
+
+# ============================
+# PROMETHEUS LẤY SỐ LIỆU (/metrics)
+# ============================
+# Prometheus cannot log in; if set, scrapes must send "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("NETCAFE_METRICS_TOKEN") or None
+
+
+def _delivery_counts(key):
+    return [((event,), s[key]) for event, s in delivery.stats()['events'].items()]
+
+
+metrics.gauge_callback("netcafe_connected_sockets", "Engine.IO sockets connected to this worker.",
+                       lambda: len(socketio.server.eio.sockets))
+metrics.gauge_callback("netcafe_online_seats", "Seats with a running billed session.", lambda: len(ledger))
+metrics.gauge_callback("netcafe_online_users", "Users with at least one connected socket.",
+                       lambda: presence.online_count())
+metrics.gauge_callback("netcafe_billing_leader", "1 if this worker holds the billing leader lease.",
+                       lambda: int(cluster.is_leader()))
+metrics.counter_callback("netcafe_socket_events_total", "Server-initiated events sent, by event.",
+                         lambda: _delivery_counts('events'), ("event",))
+metrics.counter_callback("netcafe_socket_emits_total", "Socket.IO emits made (after batching), by event.",
+                         lambda: _delivery_counts('emits'), ("event",))
+metrics.gauge_callback("netcafe_db_pool_connections", "DB pool connections by state.",
+                       lambda: [((k,), v) for k, v in db_pool.stats().items() if k in ('in_use', 'idle')],
+                       ("state",))
+metrics.gauge_callback("netcafe_chat_write_queue", "Chat messages waiting to be written.",
+                       lambda: chat_writer.stats()['pending'])
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "unauthorized", 401
+    return app.response_class(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 # ============================
@@ -375,20 +1115,15 @@ def admin_dashboard():
 # ============================
 @app.route("/admin/topup/<int:user_id>", methods=["POST"])
 def admin_topup(user_id):
-    amount = request.form.get("amount")
+    amount = request.form.get("amount") or ""
     if not amount.isdigit():
-        flash("Số tiền không hợp lệ!", "danger")
-        return redirect(url_for("admin_dashboard"))
+        return _admin_result(False, "Số tiền không hợp lệ!")
 
     amount = int(amount)
 
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("UPDATE users SET balance = balance + %s, last_active=%s WHERE id=%s",
-                    (amount, datetime.now(), user_id))
+    _credit_user(user_id, amount)
 
-    flash("Đã nạp tiền cho user!", "success")
-    return redirect(url_for("admin_dashboard"))
+    return _admin_result(True, "Đã nạp tiền cho user!")
 
 
 # ============================
@@ -396,46 +1131,34 @@ def admin_topup(user_id):
 # ============================
 @app.route("/admin/approve_request/<int:req_id>")
 def admin_approve_request(req_id):
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM topup_requests WHERE id=%s", (req_id,))
-        req = cur.fetchone()
-
-        if not req or req["status"] != "pending":
-            flash("Yêu cầu không hợp lệ!", "danger")
-            return redirect(url_for("admin_dashboard"))
-
-        cur.execute("UPDATE users SET balance = balance + %s, last_active=%s WHERE id=%s",
-                    (req["amount"], datetime.now(), req["user_id"]))
-
-        # mark request approved and ensure user_notified is 0 so user will be notified on next dashboard load
-        cur.execute("UPDATE topup_requests SET status='approved', user_notified=0 WHERE id=%s", (req_id,))
-
-        # insert a message from admin to the user to notify them immediately in chat
-        cur.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
-        admin_row = cur.fetchone()
-        admin_id = admin_row['id'] if admin_row else None
-        if admin_id:
-            content = f"Yêu cầu nạp {int(req['amount'])} đ của bạn đã được duyệt và nạp vào tài khoản."
-            cur.execute("INSERT INTO messages (from_user_id, to_user_id, content) VALUES (%s, %s, %s)",
-                        (admin_id, req['user_id'], content))
-            # emit real-time notification to the user's room
-            try:
-                socketio.emit('new_message', {
-                    'from_user_id': admin_id,
-                    'to_user_id': req['user_id'],
-                    'content': content
-                }, room=f"user_{req['user_id']}")
-            except Exception:
-                pass
-        # notify admin dashboards that this request was updated
+    # mark request approved and ensure user_notified is 0 so user will be notified on next dashboard load
+    # (only the first approval of a pending request credits the user)
+    req = topup_repo.approve(req_id)
+    if not req:
+        return _admin_result(False, "Yêu cầu không hợp lệ!")
+
+    _credit_user(req["user_id"], req["amount"], ref_id=req_id)
+
+    # insert a message from admin to the user to notify them immediately in chat
+    admin_id = directory.admin_id()
+    if admin_id:
+        content = f"Yêu cầu nạp {int(req['amount'])} đ của bạn đã được duyệt và nạp vào tài khoản."
+        # emit real-time notification to the user's room
         try:
-            socketio.emit('topup_request_updated', {'id': req_id, 'status': 'approved'}, room='admins')
+            msg = chat_writer.submit(admin_id, req['user_id'], content)
+            delivery.send('new_message', {
+                'id': msg['id'],
+                'from_user_id': admin_id,
+                'to_user_id': req['user_id'],
+                'content': content,
+                'created_at': msg['created_at']
+            }, f"user_{req['user_id']}")
         except Exception:
             pass
+    # notify admin dashboards that this request was updated
+    _send_admin_delta(requests={'changed': [{'id': req_id, 'status': 'approved'}]})
 
-    flash("Đã duyệt yêu cầu và nạp tiền!", "success")
-    return redirect(url_for("admin_dashboard"))
+    return _admin_result(True, "Đã duyệt yêu cầu và nạp tiền!")
 
 
 # ============================
@@ -447,26 +1170,159 @@ def admin_create_user():
     password = request.form.get("password")
 
     if not username or not password:
-        flash("Không được bỏ trống!", "danger")
-        return redirect(url_for("admin_dashboard"))
+        return _admin_result(False, "Không được bỏ trống!")
 
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT id FROM users WHERE username=%s", (username,))
-        exists = cur.fetchone()
+    # Fix: user mới tạo luôn offline
+    new_id = user_repo.create(username, password)
+    if new_id is None:
+        return _admin_result(False, "User đã tồn tại!")
 
-        if exists:
-            flash("User đã tồn tại!", "danger")
-            return redirect(url_for("admin_dashboard"))
+    directory.invalidate()
+    _send_admin_delta(users={'added': [_user_row(new_id, username=username, is_online=0, balance=0)]})
+    return _admin_result(True, "Tạo user thành công!")
 
-        # Fix: user mới tạo luôn offline
-        cur.execute("""
-            INSERT INTO users (username, password, role, balance, is_online, last_active)
-            VALUES (%s, %s, 'user', 0, 0, NULL)
-        """, (username, password))
 
-    flash("Tạo user thành công!", "success")
-    return redirect(url_for("admin_dashboard"))
+# ============================
+# LỊCH SỬ CHAT (PHÂN TRANG THEO id)
+# ============================
+# Số tin nhắn mỗi trang khi mở chat / tải tin cũ hơn
+CHAT_PAGE_SIZE = int(os.environ.get("NETCAFE_CHAT_PAGE_SIZE", "50"))
+# Ghi tin nhắn theo lô (group commit): số tin mỗi lệnh INSERT, chu kỳ ghi (giây),
+# số tin tối đa được chờ ghi trước khi người gửi phải đợi
+CHAT_WRITE_BATCH = int(os.environ.get("NETCAFE_CHAT_WRITE_BATCH", "200"))
+CHAT_WRITE_INTERVAL = float(os.environ.get("NETCAFE_CHAT_WRITE_INTERVAL", "0.05"))
+CHAT_WRITE_MAX_PENDING = int(os.environ.get("NETCAFE_CHAT_WRITE_MAX_PENDING", "10000"))
+# Độ dài tối đa của một tin nhắn (ký tự); cột TEXT chỉ chứa 64 KB
+MESSAGE_MAX_CHARS = int(os.environ.get("NETCAFE_MESSAGE_MAX_CHARS", "2000"))
+
+# message ids come from a shared counter so a message can be broadcast with its id
+# before it is written; chat_writer then stores messages in batches
+message_ids = IdAllocator(store)
+chat_writer = MessageWriter(
+    db_connection,
+    message_ids.next,
+    max_batch=CHAT_WRITE_BATCH,
+    flush_interval=CHAT_WRITE_INTERVAL,
+    max_pending=CHAT_WRITE_MAX_PENDING,
+    sleep=socketio.sleep,
+    create_event=socketio.server.eio.create_event,
+    start_task=socketio.start_background_task,
+    dialect=backend.dialect,
+)
+
+
+def _seed_message_ids():
+    message_ids.seed(message_repo.max_id())
+
+
+_seed_message_ids()
+# write whatever is still queued when the server stops; SIGTERM (service stop, a
+# process manager recycling the worker) ends the process without running atexit
+atexit.register(chat_writer.close)
+
+
+def _flush_on_sigterm(previous):
+    def handler(signum, frame):
+        try:
+            chat_writer.close()
+        except Exception as e:
+            print('[chat] flush on shutdown failed', e)
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            raise SystemExit(0)
+    return handler
+
+
+try:
+    signal.signal(signal.SIGTERM, _flush_on_sigterm(signal.getsignal(signal.SIGTERM)))
+except ValueError:
+    # not the main thread (imported by a tool): nothing to install
+    pass
+
+# Dọn chat sau khi logout (chạy nền): số tin xoá mỗi lô, chu kỳ kiểm tra (giây) và
+# thư mục lưu bản sao .jsonl.gz trước khi xoá (bỏ trống = không lưu)
+CHAT_PURGE_BATCH = int(os.environ.get("NETCAFE_CHAT_PURGE_BATCH", "500"))
+CHAT_PURGE_POLL_SECONDS = float(os.environ.get("NETCAFE_CHAT_PURGE_POLL_SECONDS", "5"))
+CHAT_ARCHIVE_DIR = os.environ.get("NETCAFE_CHAT_ARCHIVE_DIR") or None
+
+chat_janitor = ChatJanitor(
+    db_connection,
+    batch_size=CHAT_PURGE_BATCH,
+    archive_dir=CHAT_ARCHIVE_DIR,
+    before_purge=chat_writer.flush,
+    sleep=socketio.sleep,
+)
+janitor_state = {'task': None, 'wakeup': socketio.server.eio.create_event()}
+
+
+def _janitor_loop():
+    """Work through requested chat purges; like billing, only the leader does it."""
+    while True:
+        janitor_state['wakeup'].wait(CHAT_PURGE_POLL_SECONDS)
+        janitor_state['wakeup'].clear()
+        if not cluster.is_leader():
+            continue
+        try:
+            chat_janitor.run_pending()
+        except Exception as e:
+            print('[janitor] run failed', e)
+
+
+def _ensure_janitor_loop():
+    if janitor_state['task'] is None:
+        janitor_state['task'] = socketio.start_background_task(_janitor_loop)
+        # the billing loop is what keeps the leader lease
+        _ensure_billing_loop()
+
+
+def _request_chat_purge(user_id):
+    """Mark everything the user has said or been sent so far for deletion."""
+    chat_janitor.request(user_id, message_ids.current())
+    _ensure_janitor_loop()
+    janitor_state['wakeup'].set()
+
+
+# purges left over from before a restart are picked up right away
+_ensure_janitor_loop()
+
+
+def fetch_conversation(a, b, before_id=None, limit=None):
+    """Return (messages, has_more): the newest ``limit`` messages between a and b older than before_id.
+
+    Messages come back oldest first; the page read from the database costs the
+    same whatever the size of the table (see MessageRepository.latest).
+    """
+    limit = limit or CHAT_PAGE_SIZE
+    rows = message_repo.latest(a, b, limit + 1, before_id=before_id)
+    # messages still in the write queue are the newest of the conversation
+    stored = {r['id'] for r in rows}
+    queued = [m for m in chat_writer.pending_between(a, b)
+              if m['id'] not in stored and (not before_id or m['id'] < before_id)]
+    if queued:
+        for m in queued:
+            m.pop('client_msg_id', None)
+            m['sender_name'], m['sender_role'] = directory.get(m['from_user_id']) or ('', '')
+        rows = sorted(rows + queued, key=lambda r: r['id'], reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+
+def _serialize_messages(msgs):
+    # convert datetime to string for JSON serialization
+    for m in msgs:
+        if isinstance(m.get('created_at'), datetime):
+            m['created_at'] = str(m['created_at'])
+    return msgs
+
+
+def _encode_messages(event, msgs, has_more, other_id, fmt):
+    """A page of a conversation as a socket in wire format ``fmt`` receives it."""
+    if fmt == wire.JSON:
+        msgs = _serialize_messages(msgs)
+    return wire.encode(event, {'messages': msgs, 'has_more': has_more, 'other_id': other_id}, fmt)
 
 
 # ============================
@@ -489,12 +1345,8 @@ def chat():
     username = session["username"]
     role = session["role"]
 
-    conn = get_db_connection()
     # Prepare participants
-    with conn.cursor() as cur:
-        cur.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
-        admin_row = cur.fetchone()
-        admin_id = admin_row['id'] if admin_row else None
+    admin_id = directory.admin_id()
 
     # ADMIN: optionally choose a user to chat with via query param or form
     target_user_id = None
@@ -519,253 +1371,224 @@ def chat():
             from_id = user_id
             to_id = target_user_id
 
-        if from_id and to_id and content:
-            with conn.cursor() as cur:
-                    # if to_id not provided (user sending), find an admin id
-                    if not to_id:
-                        cur.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
-                        arow = cur.fetchone()
-                        to_id = arow['id'] if arow else None
-                    if not to_id:
-                        # try to find an admin if sender is a user
-                        cur.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
-                        arow = cur.fetchone()
-                        to_id = arow['id'] if arow else None
-                    if not to_id:
-                        # reject sending messages with no recipient (admin forgot to select user)
-                        try:
-                            emit('error', {'message': 'No recipient selected'}, room=request.sid)
-                        except Exception:
-                            pass
-                        print(f"[socket] message rejected: from={from_id} to=None content={content}")
-                        return
-                    # log resolved recipient
-                    print(f"[socket] resolved to_id={to_id}")
-                    cur.execute("INSERT INTO messages (from_user_id, to_user_id, content) VALUES (%s, %s, %s)",
-                                (from_id, to_id, content))
+        if not to_id or directory.get(to_id) is None:
+            # admin chưa chọn user để chat
+            flash("Chưa chọn user để chat", "danger")
+            return redirect(url_for("chat"))
+        if content and len(content) > MESSAGE_MAX_CHARS:
+            flash(f"Tin nhắn dài quá {MESSAGE_MAX_CHARS} ký tự.", "danger")
+        elif from_id and content:
+            try:
+                chat_writer.submit(from_id, to_id, content)
+            except QueueFull:
+                flash("Hệ thống đang bận, vui lòng gửi lại tin nhắn.", "danger")
+        # post/redirect/get: a refresh must not resend the form
+        if session['role'] == 'admin':
+            return redirect(url_for("chat", user_id=to_id))
+        return redirect(url_for("chat"))
 
     # Fetch messages for display
-    with conn.cursor() as cur:
-        if session['role'] == 'user':
-            # show conversation between this user and admin
-            cur.execute(
-                "SELECT m.*, u.username AS sender_name, u.role AS sender_role "
-                "FROM messages m JOIN users u ON m.from_user_id = u.id "
-                "WHERE (m.from_user_id=%s AND m.to_user_id=%s) OR (m.from_user_id=%s AND m.to_user_id=%s) "
-                "ORDER BY m.created_at ASC",
-                (user_id, admin_id, admin_id, user_id)
-            )
-            messages = cur.fetchall()
-            # no user list needed for normal user
-            users = []
+    has_more = False
+    if session['role'] == 'user':
+        # show the latest page of the conversation between this user and admin
+        messages, has_more = fetch_conversation(user_id, admin_id)
+        # no user list needed for normal user
+        users = []
+    else:
+        # admin: show either conversation with selected user or an empty list
+        # get list of all users for dropdown
+        users = directory.users(role='user')
+
+        if not target_user_id and users:
+            # default to first user in list
+            target_user_id = users[0]['id']
+
+        if target_user_id:
+            messages, has_more = fetch_conversation(user_id, target_user_id)
         else:
-            # admin: show either conversation with selected user or an empty list
-            # get list of all users for dropdown
-            cur.execute("SELECT id, username FROM users WHERE role='user'")
-            users = cur.fetchall()
-
-            if not target_user_id and users:
-                # default to first user in list
-                target_user_id = users[0]['id']
-
-            if target_user_id:
-                cur.execute(
-                    "SELECT m.*, u.username AS sender_name, u.role AS sender_role "
-                    "FROM messages m JOIN users u ON m.from_user_id = u.id "
-                    "WHERE (m.from_user_id=%s AND m.to_user_id=%s) OR (m.from_user_id=%s AND m.to_user_id=%s) "
-                    "ORDER BY m.created_at ASC",
-                    (user_id, target_user_id, target_user_id, user_id)
-                )
-                messages = cur.fetchall()
-            else:
-                messages = []
+            messages = []
 
-    return render_template("chat.html", messages=messages, username=username, role=role, users=users, target_user_id=target_user_id, user_id=user_id)
+    return render_template("chat.html", messages=messages, username=username, role=role, users=users,
+                           target_user_id=target_user_id, user_id=user_id, admin_id=admin_id, has_more=has_more)
 
 
 # ============================
 # RUN
 # ============================
 @socketio.on('join')
+@timed_event('join')
 def on_join(data):
     # data: {user_id, role, target_user_id (optional)}
     user_id = data.get('user_id')
     role = data.get('role')
     target = data.get('target_user_id')
-    print(f"[socket] join request: sid={request.sid} user_id={user_id} role={role} target={target}")
+    # wire format for this socket's server-initiated events, chosen before anything is pushed
+    fmt = data.get('wire') if COMPACT_WIRE and data.get('wire') in wire.FORMATS else wire.JSON
+    delivery.set_format(request.sid, fmt)
+    print(f"[socket] join request: sid={request.sid} user_id={user_id} role={role} target={target} wire={fmt}")
     # Always join the per-user room when a user_id is provided
     if user_id:
         room = f"user_{user_id}"
         try:
-            join_room(room)
+            join_room(wire.room(room, fmt))
         except Exception:
             pass
         # track this sid for direct emits
         try:
-            s = active_user_sids.get(user_id)
-            if not s:
-                active_user_sids[user_id] = set()
-            active_user_sids[user_id].add(request.sid)
-        except Exception:
-            pass
-        # start background time updater for this user if they're online
-        try:
-            # check DB online flag before starting
-            conn = get_db_connection()
-            with conn.cursor() as cur:
-                cur.execute("SELECT is_online FROM users WHERE id=%s", (user_id,))
-                r = cur.fetchone()
-            if r and r.get('is_online') == 1:
-                _start_user_time_task(user_id)
-        except Exception:
-            pass
+            previous, went_offline = presence.connect(request.sid, user_id)
+        except Exception as e:
+            print('[socket] presence update failed', e)
+        else:
+            # the socket belonged to someone else, and was their last one
+            if went_offline:
+                _mark_offline([previous])
+        # the billing loop's heartbeat keeps this worker's sockets from being reaped
+        _ensure_billing_loop()
+        # give the new client the current deadline to count down from
+        if user_id in ledger:
+            _push_deadline(user_id, to=request.sid)
+        elif session.get('user_id') == user_id and session.get('role') == 'user':
+            # the session was closed while no page was open (e.g. the user opened the
+            # chat after the grace period): resume billing from now
+            balance = user_repo.balance(user_id)
+            if (balance or 0) > 0:
+                _start_session(user_id, balance)
         # notify this client it joined its room
         try:
-            emit('joined', {'room': room, 'user_id': user_id}, room=request.sid)
+            emit('joined', {'room': room, 'user_id': user_id, 'wire': fmt}, room=request.sid)
         except Exception:
             pass
 
     # If role indicates admin, also join admin room and optionally the target user's room
     if role == 'admin':
         try:
-            join_room('admins')
+            join_room(wire.room('admins', fmt))
+        except Exception:
+            pass
+        # every running seat, to count down from until the next seat_grid delta
+        try:
+            delivery.send('seat_grid', seat_grid.full(ledger.deadlines(), ledger.now()), request.sid)
         except Exception:
             pass
         # Do NOT auto-join admin to a user's room on connect — admin should explicitly switch users.
         # Only track the admin's current target if provided, but don't join the user room here.
         try:
             if target:
-                admin_targets[request.sid] = target
+                presence.set_admin_target(request.sid, target)
         except Exception:
             pass
         try:
-            emit('joined', {'room': 'admins', 'target': target, 'user_id': user_id}, room=request.sid)
+            emit('joined', {'room': 'admins', 'target': target, 'user_id': user_id, 'wire': fmt},
+                 room=request.sid)
         except Exception:
             pass
 
 
 @socketio.on('switch_user')
+@timed_event('switch_user')
 def on_switch_user(data):
     # admin switches selected user to chat with
     prev = data.get('prev_user_id')
     new = data.get('new_user_id')
     sid = request.sid
+    fmt = delivery.client_format(sid)
     if prev:
         try:
-            leave_room(f"user_{prev}")
+            leave_room(wire.room(f"user_{prev}", fmt))
         except Exception:
             pass
     if new:
-        join_room(f"user_{new}")
+        join_room(wire.room(f"user_{new}", fmt))
         # remember this admin's current target
         try:
-            admin_targets[sid] = new
-        except Exception:
-            pass
-        # load conversation and emit back to this admin socket only
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, from_user_id, to_user_id, content, created_at FROM messages WHERE (from_user_id=%s AND to_user_id=%s) OR (from_user_id=%s AND to_user_id=%s) ORDER BY created_at ASC",
-                        (session.get('user_id'), new, new, session.get('user_id')))
-            msgs = cur.fetchall()
-        # convert datetime to string for JSON serialization
-        try:
-            for m in msgs:
-                if isinstance(m.get('created_at'), datetime):
-                    m['created_at'] = str(m['created_at'])
+            presence.set_admin_target(sid, new)
         except Exception:
             pass
-        emit('messages', {'messages': msgs}, room=sid)
+        # load the latest page of the conversation and emit back to this admin socket only
+        msgs, has_more = fetch_conversation(session.get('user_id'), new)
+        emit('messages', _encode_messages('messages', msgs, has_more, new, fmt), room=sid)
+
+
+# Chống gửi trùng tin nhắn: nhớ các khoá idempotency gần đây (số khoá tối đa, thời gian nhớ - giây)
+MESSAGE_DEDUP_SIZE = int(os.environ.get("NETCAFE_MESSAGE_DEDUP_SIZE", "10000"))
+MESSAGE_DEDUP_TTL = float(os.environ.get("NETCAFE_MESSAGE_DEDUP_TTL", "120"))
+message_dedup = DedupCache(max_size=MESSAGE_DEDUP_SIZE, ttl=MESSAGE_DEDUP_TTL)
 
 
 @socketio.on('send_message')
+@timed_event('send_message')
 def on_send_message(data):
-    # data: {from_user_id, to_user_id, content}
+    # data: {from_user_id, to_user_id, content, client_msg_id}
+    # acked (Socket.IO callback) with the stored message, also for a retried duplicate
     from_id = data.get('from_user_id')
     to_id = data.get('to_user_id')
     content = data.get('content')
     if not from_id or not content:
         return
-    print(f"[socket] send_message from={from_id} to={to_id} content={content}")
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        # if to_id not provided, decide based on sender role
-        if not to_id:
-            cur.execute("SELECT role FROM users WHERE id=%s", (from_id,))
-            srow = cur.fetchone()
-            sender_role = srow['role'] if srow else None
-            print(f"[socket] sender_role={sender_role}")
-            if sender_role == 'user':
-                # user sending -> deliver to admin
-                cur.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
-                arow = cur.fetchone()
-                to_id = arow['id'] if arow else None
+    # only as the logged-in user, and only what the messages table can store
+    if from_id != session.get('user_id') or not isinstance(content, str):
+        return {'error': 'Not allowed'}
+    if len(content) > MESSAGE_MAX_CHARS:
+        return {'error': f'Message is longer than {MESSAGE_MAX_CHARS} characters'}
+    if to_id is not None:
+        recipient = directory.get(to_id) if isinstance(to_id, int) else None
+        # users only write to the admin
+        if recipient is None or (session.get('role') != 'admin' and recipient[1] != 'admin'):
+            return {'error': 'No recipient available'}
+    # if to_id not provided, decide based on sender role
+    if not to_id:
+        sender_role = directory.role(from_id)
+        if sender_role == 'user':
+            # user sending -> deliver to admin
+            to_id = directory.admin_id()
+        else:
+            # admin must specify recipient explicitly; try to use admin_targets mapping
+            try:
+                tgt = presence.admin_target(request.sid)
+            except Exception:
+                tgt = None
+            if tgt:
+                to_id = tgt
             else:
-                # admin must specify recipient explicitly; try to use admin_targets mapping
                 try:
-                    tgt = admin_targets.get(request.sid)
+                    emit('error', {'message': 'Admin must select a recipient'}, room=request.sid)
                 except Exception:
-                    tgt = None
-                if tgt:
-                    to_id = tgt
-                else:
-                    try:
-                        emit('error', {'message': 'Admin must select a recipient'}, room=request.sid)
-                    except Exception:
-                        pass
-                    print(f"[socket] message rejected: from={from_id} to=None content={content}")
-                    return
-        if not to_id:
-            try:
-                emit('error', {'message': 'No recipient available'}, room=request.sid)
-            except Exception:
-                pass
-            print(f"[socket] message rejected: from={from_id} to=None content={content}")
-            return
-        # log resolved recipient
-        print(f"[socket] resolved to_id={to_id}")
-        # prevent rapid duplicate inserts: check for an existing identical message in last 2 seconds
-        msg_id = None
-        created_at = ''
+                    pass
+                return {'error': 'Admin must select a recipient'}
+    if not to_id:
         try:
-            cur.execute(
-                "SELECT id, created_at FROM messages WHERE from_user_id=%s AND to_user_id=%s AND content=%s AND created_at >= (NOW() - INTERVAL 2 SECOND) LIMIT 1",
-                (from_id, to_id, content)
-            )
-            existing = cur.fetchone()
-            if existing:
-                msg_id = existing['id']
-                created_at = existing['created_at']
-                print(f"[socket] duplicate detected, reusing message id={msg_id}")
-            else:
-                cur.execute("INSERT INTO messages (from_user_id, to_user_id, content) VALUES (%s, %s, %s)",
-                            (from_id, to_id, content))
-                msg_id = cur.lastrowid
-                cur.execute("SELECT created_at FROM messages WHERE id=%s", (msg_id,))
-                crow = cur.fetchone()
-                created_at = crow['created_at'] if crow else ''
-            # get sender info for payload
-            cur.execute("SELECT username, role FROM users WHERE id=%s", (from_id,))
-            srow = cur.fetchone()
-            sender_name = srow['username'] if srow else ''
-            sender_role = srow['role'] if srow else ''
-        except Exception as e:
-            print('[socket] duplicate-check/insert error', e)
-            # fallback: insert normally
-            try:
-                cur.execute("INSERT INTO messages (from_user_id, to_user_id, content) VALUES (%s, %s, %s)",
-                            (from_id, to_id, content))
-                msg_id = cur.lastrowid
-                cur.execute("SELECT created_at FROM messages WHERE id=%s", (msg_id,))
-                crow = cur.fetchone()
-                created_at = crow['created_at'] if crow else ''
-                cur.execute("SELECT username, role FROM users WHERE id=%s", (from_id,))
-                srow = cur.fetchone()
-                sender_name = srow['username'] if srow else ''
-                sender_role = srow['role'] if srow else ''
-            except Exception:
-                msg_id = None
-                created_at = ''
+            emit('error', {'message': 'No recipient available'}, room=request.sid)
+        except Exception:
+            pass
+        return {'error': 'No recipient available'}
+    # idempotency key sent by the client: double-clicks and retries carry the same
+    # key, so only the first one is stored and broadcast
+    client_msg_id = str(data.get('client_msg_id') or '')[:64] or None
+    dedup_key = (from_id, client_msg_id) if client_msg_id else None
+    if dedup_key:
+        first, previous = message_dedup.claim(dedup_key)
+        if not first:
+            print(f"[socket] duplicate message key={client_msg_id} ignored")
+            # ack with the original so the sender's UI settles; a send still in
+            # flight acks its own emit
+            return None if previous is PENDING else wire.encode('new_message', previous, wire.JSON)
+    try:
+        # id and created_at are assigned now; the row is written by the next group commit
+        row = chat_writer.submit(from_id, to_id, content, client_msg_id)
+    except Exception as e:
+        print('[socket] insert error', e)
+        # let the client retry with the same key
+        if dedup_key:
+            message_dedup.discard(dedup_key)
+        try:
+            emit('error', {'message': 'Message could not be saved'}, room=request.sid)
+        except Exception:
+            pass
+        return
+    msg_id = row['id']
+    created_at = row['created_at']
+    # get sender info for payload
+    sender_name, sender_role = directory.get(from_id) or ('', '')
 
     payload = {
         'id': msg_id,
@@ -774,40 +1597,15 @@ def on_send_message(data):
         'content': content,
         'sender_name': sender_name,
         'sender_role': sender_role,
-        'created_at': str(created_at)
+        # a datetime: delivery encodes it per wire format
+        'created_at': created_at
     }
-    # emit to both participants' room so both see it
-    try:
-        socketio.emit('new_message', payload, room=f"user_{to_id}")
-        socketio.emit('new_message', payload, room=f"user_{from_id}")
-    except Exception:
-        print('[socket] emit new_message failed', Exception)
-        pass
-    # ack back to sender socket if available
-    try:
-        emit('sent', payload, room=request.sid)
-    except Exception:
-        pass
-    # also try direct emits to tracked socket ids for reliability
-    try:
-        sids = active_user_sids.get(to_id) or set()
-        print(f"[socket] tracked sids for to_id={to_id}: {len(sids)}")
-        for sid in sids:
-            try:
-                socketio.emit('new_message', payload, room=sid)
-            except Exception:
-                pass
-    except Exception:
-        pass
-    try:
-        sids = active_user_sids.get(from_id) or set()
-        for sid in sids:
-            try:
-                socketio.emit('new_message', payload, room=sid)
-            except Exception:
-                pass
-    except Exception:
-        pass
+    if dedup_key:
+        message_dedup.put(dedup_key, payload)
+    # one logical event for both participants: the rooms are resolved to the distinct
+    # set of sockets (including the sender's and any admin viewing this user) and the
+    # payload is serialized once
+    delivery.send('new_message', payload, [f"user_{to_id}", f"user_{from_id}"])
 
     # notify admins (lightweight) that a user sent a message so admin can see who's active
     try:
@@ -819,84 +1617,84 @@ def on_send_message(data):
                 'snippet': (content[:80] + '...') if len(content) > 80 else content,
                 'created_at': str(created_at)
             }
-            socketio.emit('user_active', notice, room='admins')
+            delivery.send('user_active', notice, 'admins')
     except Exception:
         pass
+    return wire.encode('new_message', payload, wire.JSON)
 
 
 @socketio.on('load_messages')
+@timed_event('load_messages')
 def on_load_messages(data):
-    # data: {user_id, other_id}
+    # data: {user_id, other_id, before_id (optional)}
+    # without before_id: latest page ("messages"); with before_id: the page before it ("older_messages")
     a = data.get('user_id')
     b = data.get('other_id')
+    before_id = data.get('before_id')
     if not a or not b:
         return
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT id, from_user_id, to_user_id, content, created_at FROM messages WHERE (from_user_id=%s AND to_user_id=%s) OR (from_user_id=%s AND to_user_id=%s) ORDER BY created_at ASC",
-                    (a, b, b, a))
-        msgs = cur.fetchall()
-    try:
-        for m in msgs:
-            if isinstance(m.get('created_at'), datetime):
-                m['created_at'] = str(m['created_at'])
-    except Exception:
-        pass
-    emit('messages', {'messages': msgs})
+    msgs, has_more = fetch_conversation(a, b, before_id=before_id)
+    event = 'older_messages' if before_id else 'messages'
+    emit(event, _encode_messages(event, msgs, has_more, b, delivery.client_format(request.sid)))
 
 
-@socketio.on('disconnect')
-def on_disconnect():
-    sid = request.sid
-    # ... (Phần code xóa sid giữ nguyên) ...
-    try:
-        to_remove = []
-        for uid, sids in active_user_sids.items():
-            if sid in sids:
-                sids.discard(sid)
-                if not sids:
-                    to_remove.append(uid)
-        for uid in to_remove:
-            active_user_sids.pop(uid, None)
-    except Exception:
-        pass
+def _mark_offline(user_ids, since=None):
+    """Queue users whose last socket is gone; their sessions close after the grace period.
 
+    Disconnects arriving together (a reconnect storm, an access point dropping) end
+    up in the same batch and are closed with one UPDATE.
+    """
+    since = since if since is not None else ledger.now()
+    with offline_pending['lock']:
+        pending = offline_pending['users']
+        for uid in user_ids:
+            pending.setdefault(uid, since)
+        start = bool(pending) and not offline_pending['scheduled']
+        offline_pending['scheduled'] = offline_pending['scheduled'] or start
+    if start:
+        socketio.start_background_task(_close_offline_sessions)
+
+
+def _close_offline_sessions():
+    socketio.sleep(PRESENCE_GRACE_SECONDS)
+    with offline_pending['lock']:
+        batch, offline_pending['users'] = offline_pending['users'], {}
+        offline_pending['scheduled'] = False
+    # users who came back in the meantime keep their session
+    gone = {uid: since for uid, since in batch.items() if not presence.is_online(uid)}
+    if not gone:
+        return
     try:
-        if sid in admin_targets:
-            admin_targets.pop(sid, None)
-    except Exception:
-        pass
+        # CHỐT SỔ LẦN CUỐI tại thời điểm mất kết nối và set Offline
+        # (admins see the seats stop in the next seat_grid frame)
+        _end_session(list(gone), at=gone)
+    except Exception as e:
+        print('[socket] closing offline sessions failed', e)
 
-    # XỬ LÝ KHI USER MẤT KẾT NỐI HOÀN TOÀN
+
+@socketio.on('disconnect')
+@timed_event('disconnect')
+def on_disconnect(reason=None):
+    # python-socketio passes the disconnect reason; without the parameter the call
+    # raises TypeError and is retried, timing every disconnect twice
+    delivery.forget(request.sid)
+    # sid -> user is indexed, so this does not depend on how many users are online
     try:
-        to_stop = []
-        for uid, sids in list(active_user_sids.items()):
-            if not sids:
-                to_stop.append(uid)
-        for uid in to_stop:
-            active_user_sids.pop(uid, None)
-            
-            # CHỐT SỔ LẦN CUỐI
-            update_user_time(uid)
+        uid = presence.disconnect(request.sid)
+    except Exception as e:
+        print('[socket] presence update failed', e)
+        return
+    # XỬ LÝ KHI USER MẤT KẾT NỐI HOÀN TOÀN
+    if uid is not None:
+        _mark_offline([uid])
 
-            try:
-                conn = get_db_connection()
-                with conn.cursor() as cur:
-                    cur.execute("UPDATE users SET is_online=0 WHERE id=%s", (uid,))
-                
-                # Báo admin biết user này đã offline
-                try:
-                    socketio.emit('user_status', {'user_id': uid, 'is_online': 0}, room='admins')
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            
-            user_time_tasks.pop(uid, None)
-    except Exception:
-        pass
+
+# after the socket handlers: recovery queues users without a socket like a disconnect
+_recover_sessions()
 
 
 if __name__ == "__main__":
-    # run with socketio to enable realtime features
-    socketio.run(app, debug=True)
+    # run with socketio to enable realtime features; give each worker its own port
+    # when running several of them behind a load balancer (see cluster.py)
+    socketio.run(app, host=os.environ.get("NETCAFE_HOST", "127.0.0.1"),
+                 port=int(os.environ.get("NETCAFE_PORT", "5000")), debug=True)
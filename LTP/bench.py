@@ -0,0 +1,543 @@
+"""Load generator and benchmark for billing and chat.
+
+Simulates N seats against a throw-away database (MySQL, an SQLite file or SQLite in
+memory, see ``--backend``): every seat logs in through ``/``,
+holds a Socket.IO connection that ``join``s, chats with the admin through
+``send_message`` and now and then asks for a topup that an admin approves. The app
+runs in this process (Flask and Socket.IO test clients), so nothing but the
+database has to be running; the database is created for the run and dropped
+afterwards.
+
+Reported: billing tick lag and duration, time_update delivery latency, chat and
+approve latency, DB queries/s, socket emits/s, bytes/s (seats and admin) and memory
+per connection.
+Clients join with ``--wire`` (json or compact, see wire.py). With
+``--slow-query N`` a background task keeps running ``SELECT SLEEP(N)`` during the
+load; billing ticks and chat must keep flowing meanwhile (the tick lag shows it
+when a query blocks the event loop; MySQL only). Results
+are written as JSON to bench_results/ (named after the commit) so runs can be
+compared between commits.
+
+Usage:
+    python bench.py                              # 20 seats for 30 s
+    python bench.py --seats 200 --duration 60
+    python bench.py --backend sqlite             # embedded SQLite (WAL file), no server needed
+    python bench.py --wire json                  # clients that did not negotiate the compact format
+    python bench.py --slow-query 2               # a 2 s query every 5 s must not stall the others
+    python bench.py --compare bench_results/<earlier run>.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import wire
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, "bench_results")
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    v = sorted(values)
+
+    def pct(p):
+        return round(v[min(len(v) - 1, max(0, int(round(p / 100.0 * len(v))) - 1))], 3)
+
+    return {'count': len(v), 'p50': pct(50), 'p95': pct(95), 'p99': pct(99), 'max': round(v[-1], 3),
+            'mean': round(sum(v) / len(v), 3)}
+
+
+class _Inbox(list):
+    """Socket.IO test client queue that remembers when each packet arrived."""
+
+    def append(self, pkt):
+        super().append((time.time(), pkt))
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                             cwd=BASE_DIR, stderr=subprocess.DEVNULL).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+# ============================
+# DATABASE DÙNG MỘT LẦN
+# ============================
+class MySQLScratchDatabase:
+    """A fresh database on the configured MySQL server, loaded from netcafe.sql."""
+
+    def __init__(self, keep=False):
+        from config import DB_CONFIG
+
+        self.keep = keep
+        self.config = dict(DB_CONFIG)
+        self.name = f"netcafe_bench_{os.getpid()}"
+
+    def _server(self):
+        import pymysql
+
+        cfg = {k: v for k, v in self.config.items() if k != "database"}
+        return pymysql.connect(cursorclass=pymysql.cursors.DictCursor, autocommit=True, **cfg)
+
+    def create(self):
+        from migrate import split_statements
+
+        with open(os.path.join(BASE_DIR, "netcafe.sql"), encoding="utf-8") as f:
+            statements = split_statements(f.read())
+        conn = self._server()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"CREATE DATABASE `{self.name}` CHARACTER SET utf8mb4")
+                cur.execute(f"USE `{self.name}`")
+                for st in statements:
+                    cur.execute(st)
+                cur.execute("UPDATE users SET is_online=0")
+        finally:
+            conn.close()
+        # the app reads its DB settings from the environment when it is imported
+        os.environ.pop("NETCAFE_DB_URL", None)
+        os.environ["NETCAFE_DB_NAME"] = self.name
+        return self
+
+    def drop(self):
+        if self.keep:
+            print(f"[bench] keeping database {self.name}")
+            return
+        conn = self._server()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP DATABASE IF EXISTS `{self.name}`")
+        finally:
+            conn.close()
+
+
+class SQLiteScratchDatabase:
+    """An SQLite database for the run: a WAL file in a temporary directory, or in memory.
+
+    The app creates the schema (migrations/sqlite) when it is imported.
+    """
+
+    def __init__(self, memory=False, keep=False):
+        self.memory = memory
+        self.keep = keep
+        self.dir = None
+
+    def create(self):
+        if self.memory:
+            os.environ["NETCAFE_DB_URL"] = "sqlite://"
+        else:
+            self.dir = tempfile.mkdtemp(prefix="netcafe_bench_")
+            os.environ["NETCAFE_DB_URL"] = "sqlite:///" + os.path.join(self.dir, "netcafe.db")
+        return self
+
+    def drop(self):
+        if self.dir is None:
+            return
+        if self.keep:
+            print(f"[bench] keeping database {self.dir}")
+            return
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+SCRATCH_DATABASES = {
+    'mysql': lambda keep: MySQLScratchDatabase(keep=keep),
+    'sqlite': lambda keep: SQLiteScratchDatabase(keep=keep),
+    'sqlite-memory': lambda keep: SQLiteScratchDatabase(memory=True, keep=keep),
+}
+
+
+def _count_queries(netcafe, counter):
+    """Count every statement the app sends (every pooled connection reports to query_hooks)."""
+
+    @netcafe.query_hooks.add
+    def count(shape, seconds, rows):
+        counter['queries'] += 1
+
+
+# ============================
+# KỊCH BẢN TẢI
+# ============================
+class Seat:
+    def __init__(self, user_id, username, http, sock):
+        self.user_id = user_id
+        self.username = username
+        self.http = http
+        self.sock = sock
+        self.sent = 0
+
+
+def run(args):
+    os.environ.setdefault("NETCAFE_TIME_UPDATE_MODE", args.mode)
+    # the compact format is opt-in on the server too
+    if args.wire != wire.JSON:
+        os.environ["NETCAFE_COMPACT_WIRE"] = "1"
+    # the Socket.IO test client cannot work through a message queue
+    os.environ.pop("NETCAFE_SHARED_STORE_URL", None)
+    os.environ.pop("NETCAFE_SOCKETIO_MESSAGE_QUEUE", None)
+
+    db = SCRATCH_DATABASES[args.backend](args.keep_db).create()
+    counter = {'queries': 0}
+    try:
+        import app as netcafe
+
+        _count_queries(netcafe, counter)
+        return _run_scenario(netcafe, args, counter, backend=args.backend)
+    finally:
+        try:
+            import app as netcafe
+
+            netcafe.chat_writer.close()
+        except Exception:
+            pass
+        db.drop()
+
+
+def _seed_users(netcafe, seats, balance):
+    users = []
+    for i in range(seats):
+        username = f"bench{i:04d}"
+        users.append((netcafe.user_repo.create(username, "bench"), username))
+    # starting balances go through the usage ledger like any other topup
+    netcafe.usage_ledger.record([netcafe.UsageLedger.event(uid, 'opening', balance) for uid, _ in users])
+    netcafe.directory.invalidate()
+    return users
+
+
+def _login(netcafe, username, password):
+    http = netcafe.app.test_client()
+    started = time.perf_counter()
+    resp = http.post("/", data={'username': username, 'password': password})
+    elapsed = (time.perf_counter() - started) * 1000
+    if resp.status_code != 302:
+        raise RuntimeError(f"login failed for {username}: {resp.status_code}")
+    return http, elapsed
+
+
+def _connect(netcafe, http, payload):
+    sock = netcafe.socketio.test_client(netcafe.app, flask_test_client=http)
+    sock.queue = _Inbox()
+    sock.emit('join', payload)
+    return sock
+
+
+def _slow_queries(netcafe, seconds, interval, state):
+    """Keep a deliberately slow query running now and then until state['running'] is cleared."""
+    while state['running']:
+        netcafe.socketio.sleep(interval)
+        if not state['running']:
+            break
+        started = time.monotonic()
+        with netcafe.db_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT SLEEP(%s)", (seconds,))
+        state['count'] += 1
+        state['ms'].append((time.monotonic() - started) * 1000)
+
+
+def _drain(sock):
+    packets, sock.queue = list(sock.queue), _Inbox()
+    return packets
+
+
+def _events(pkt, received):
+    """The [event, decoded payload] pairs of a packet; adds its JSON size to received['bytes']."""
+    received['bytes'] += len(json.dumps(pkt['args'], separators=(',', ':'), ensure_ascii=False).encode())
+    name = pkt['name']
+    if name == 'batch':
+        events = pkt['args'][0]
+    else:
+        events = [[name, pkt['args'][0] if pkt['args'] else None]]
+    return [[event, wire.decode(event, payload)] for event, payload in events]
+
+
+def _run_scenario(netcafe, args, counter, backend):
+    rng = random.Random(args.seed)
+    socketio = netcafe.socketio
+    users = _seed_users(netcafe, args.seats, args.balance)
+
+    login_ms = []
+    admin_http, elapsed = _login(netcafe, "admin", "123456")
+    login_ms.append(elapsed)
+    admin_sock = _connect(netcafe, admin_http, {'user_id': netcafe.directory.admin_id(), 'role': 'admin',
+                                                'wire': args.wire})
+
+    logged_in = []
+    for user_id, username in users:
+        http, elapsed = _login(netcafe, username, "bench")
+        login_ms.append(elapsed)
+        logged_in.append((user_id, username, http))
+
+    # memory per connection: Python allocations made while connecting and joining
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    rss_before = _rss_mb()
+    seats = []
+    for user_id, username, http in logged_in:
+        seats.append(Seat(user_id, username, http,
+                          _connect(netcafe, http, {'user_id': user_id, 'role': 'user', 'wire': args.wire})))
+    mem_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rss_after = _rss_mb()
+    print(f"[bench] {len(seats)} seats logged in and joined")
+
+    for s in seats:
+        _drain(s.sock)
+    _drain(admin_sock)
+
+    tick_lag_ms = []
+    tick_duration_ms = []
+    time_update_ms = []
+    chat_ms = []
+    approve_ms = []
+    chat_sent_at = {}
+    pending_topups = []
+    received = {'bytes': 0}
+    admin_received = {'bytes': 0}
+    counts = {'time_update': 0, 'session_deadline': 0, 'new_message': 0, 'admin_delta': 0, 'seat_grid': 0,
+              'seat_grid_seats': 0, 'chat_sent': 0,
+              'topups_requested': 0, 'topups_approved': 0, 'send_errors': 0}
+
+    chat_interval = 60.0 / args.chat_per_minute if args.chat_per_minute else None
+    next_chat = {s.user_id: time.monotonic() + rng.uniform(0, chat_interval or 1) for s in seats}
+    topup_interval = args.duration / args.topups if args.topups else None
+    next_topup = time.monotonic() + (topup_interval or 0)
+
+    slow = {'running': True, 'count': 0, 'ms': []}
+    if args.slow_query:
+        socketio.start_background_task(_slow_queries, netcafe, args.slow_query, args.slow_query_every, slow)
+
+    queries_start = counter['queries']
+    delivery_start = netcafe.delivery.stats()
+    ticks_seen = netcafe.billing_state['ticks']
+    started = time.monotonic()
+    deadline = started + args.duration
+    while time.monotonic() < deadline:
+        now = time.monotonic()
+        # chat: every seat talks to the admin at roughly chat_per_minute
+        if chat_interval:
+            for s in seats:
+                if now >= next_chat[s.user_id]:
+                    next_chat[s.user_id] = now + rng.expovariate(1.0 / chat_interval)
+                    s.sent += 1
+                    content = f"bench {s.user_id} {s.sent}"
+                    chat_sent_at[content] = time.time()
+                    s.sock.emit('send_message', {'from_user_id': s.user_id, 'content': content,
+                                                 'client_msg_id': f"bench-{s.user_id}-{s.sent}"})
+                    counts['chat_sent'] += 1
+        # topups: a random seat asks, the admin approves when the request shows up
+        if topup_interval and now >= next_topup:
+            next_topup = now + topup_interval
+            s = rng.choice(seats)
+            s.http.post("/user/request_topup", data={'amount': "5000"})
+            counts['topups_requested'] += 1
+        for req_id in pending_topups:
+            t0 = time.perf_counter()
+            resp = admin_http.get(f"/admin/approve_request/{req_id}", headers={'Accept': 'application/json'})
+            approve_ms.append((time.perf_counter() - t0) * 1000)
+            if resp.status_code == 200:
+                counts['topups_approved'] += 1
+        pending_topups = []
+
+        # let the billing loop, delivery flushes and the write queue run
+        socketio.sleep(args.step)
+
+        ticks = netcafe.billing_state['ticks']
+        if ticks != ticks_seen:
+            ticks_seen = ticks
+            tick_lag_ms.append(netcafe.billing_state['last_lag'] * 1000)
+            tick_duration_ms.append(netcafe.billing_state['last_duration'] * 1000)
+
+        for s in seats:
+            for received_at, pkt in _drain(s.sock):
+                for event, payload in _events(pkt, received):
+                    if event in counts:
+                        counts[event] += 1
+                    if event == 'time_update' and payload and payload.get('server_time'):
+                        time_update_ms.append(received_at * 1000 - payload['server_time'])
+                    elif event == 'error':
+                        counts['send_errors'] += 1
+        for received_at, pkt in _drain(admin_sock):
+            for event, payload in _events(pkt, admin_received):
+                if event in counts:
+                    counts[event] += 1
+                if event == 'seat_grid' and payload:
+                    counts['seat_grid_seats'] += len(payload['seats']) + len(payload['stopped'])
+                elif event == 'new_message' and payload:
+                    sent_at = chat_sent_at.pop(payload.get('content'), None)
+                    if sent_at is not None:
+                        chat_ms.append((received_at - sent_at) * 1000)
+                elif event == 'admin_delta' and payload:
+                    for req in (payload.get('requests') or {}).get('added', []):
+                        if req.get('status') == 'pending':
+                            pending_topups.append(req['id'])
+
+    elapsed = time.monotonic() - started
+    slow['running'] = False
+    delivery_end = netcafe.delivery.stats()
+    emits = sum(delivery_end['frames'][k] - delivery_start['frames'][k] for k in ('single', 'batch'))
+    events = sum(e['events'] for e in delivery_end['events'].values()) \
+        - sum(e['events'] for e in delivery_start['events'].values())
+
+    for s in seats:
+        s.sock.disconnect()
+    admin_sock.disconnect()
+
+    commit, dirty = _git_commit()
+    return {
+        'schema': 1,
+        'commit': commit,
+        'dirty': dirty,
+        'started_at': datetime.now().isoformat(timespec="seconds"),
+        'params': {k: getattr(args, k) for k in ('seats', 'duration', 'chat_per_minute', 'topups', 'mode',
+                                                'step', 'seed', 'balance', 'slow_query', 'wire')},
+        'env': {
+            'backend': backend,
+            'python': sys.version.split()[0],
+            'async_mode': socketio.async_mode,
+            'coalesce': netcafe.SOCKET_COALESCE,
+        },
+        'metrics': {
+            'login_ms': percentiles(login_ms),
+            'billing_tick_lag_ms': percentiles(tick_lag_ms),
+            'billing_tick_duration_ms': percentiles(tick_duration_ms),
+            'event_loop_lag_ms': netcafe.loop_monitor.stats()['lag_ms'],
+            'time_update_latency_ms': percentiles(time_update_ms),
+            'chat_latency_ms': percentiles(chat_ms),
+            'approve_ms': percentiles(approve_ms),
+            'db_queries_per_sec': round((counter['queries'] - queries_start) / elapsed, 1),
+            'emits_per_sec': round(emits / elapsed, 1),
+            'events_per_sec': round(events / elapsed, 1),
+            'socket_bytes_per_sec': round(received['bytes'] / elapsed, 1),
+            'admin_socket_bytes_per_sec': round(admin_received['bytes'] / elapsed, 1),
+            'memory_per_connection_kb': round((mem_after - mem_before) / 1024.0 / max(1, len(seats)), 1),
+            'rss_per_connection_kb': round((rss_after - rss_before) * 1024 / max(1, len(seats)), 1)
+            if rss_before is not None and rss_after is not None else None,
+            'slow_query_ms': percentiles(slow['ms']),
+            'counts': counts,
+        },
+    }
+
+
+# ============================
+# SO SÁNH KẾT QUẢ
+# ============================
+def _flatten(metrics, prefix=""):
+    flat = {}
+    for key, value in metrics.items():
+        if key == 'counts':
+            continue
+        if isinstance(value, dict):
+            for stat in ('p50', 'p95', 'p99'):
+                if stat in value:
+                    flat[f"{prefix}{key}.{stat}"] = value[stat]
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old, new, threshold):
+    """Print old vs new for every metric; returns the names of metrics that got worse than threshold."""
+    a, b = _flatten(old['metrics']), _flatten(new['metrics'])
+    if old.get('params') != new.get('params'):
+        print("[bench] warning: runs used different parameters, numbers are not directly comparable")
+    regressions = []
+    print(f"{'metric':40} {old.get('commit', '?'):>12} {new.get('commit', '?'):>12} {'change':>9}")
+    for key in sorted(set(a) | set(b)):
+        va, vb = a.get(key), b.get(key)
+        if va is None or vb is None:
+            print(f"{key:40} {str(va):>12} {str(vb):>12}")
+            continue
+        # every metric is a cost (latency, work per second, memory): up is worse
+        change = (vb - va) / va * 100 if va else 0.0
+        flag = "  <-- worse" if change > threshold else ""
+        if flag:
+            regressions.append(key)
+        print(f"{key:40} {va:>12} {vb:>12} {change:>+8.1f}%{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the netcafe app with simulated seats.")
+    parser.add_argument("--seats", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load after everyone joined")
+    parser.add_argument("--chat-per-minute", type=float, default=6.0, help="messages per seat per minute")
+    parser.add_argument("--topups", type=int, default=10, help="topup requests (approved by the admin) per run")
+    parser.add_argument("--mode", choices=("tick", "deadline"), default="tick",
+                        help="time update mode; 'tick' exercises the 1 Hz time_update path")
+    parser.add_argument("--balance", type=int, default=1000000, help="starting balance of every seat")
+    parser.add_argument("--step", type=float, default=0.01, help="driver loop step (seconds)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--slow-query", type=float, default=0.0,
+                        help="seconds of a SELECT SLEEP() run in the background during the load (0 = off)")
+    parser.add_argument("--slow-query-every", type=float, default=5.0, help="pause between slow queries")
+    parser.add_argument("--backend", choices=sorted(SCRATCH_DATABASES), default="mysql",
+                        help="database to run against (sqlite = WAL file in a temporary directory)")
+    parser.add_argument("--wire", choices=wire.FORMATS, default=wire.COMPACT,
+                        help="wire format the clients negotiate on join")
+    parser.add_argument("--keep-db", action="store_true", help="do not drop the scratch database")
+    parser.add_argument("--out", help="result file (default: bench_results/<time>_<commit>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare this run with")
+    parser.add_argument("--threshold", type=float, default=20.0, help="percent change reported as a regression")
+    args = parser.parse_args(argv)
+    if args.slow_query and args.backend != "mysql":
+        parser.error("--slow-query needs the mysql backend (SELECT SLEEP)")
+
+    result = run(args)
+
+    out = args.out
+    if not out:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"{stamp}_{result['commit']}{'-dirty' if result['dirty'] else ''}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print(json.dumps(result['metrics'], indent=2, sort_keys=True))
+    print(f"[bench] results written to {out}")
+
+    if args.slow_query:
+        lag = result['metrics']['billing_tick_lag_ms'].get('max', 0.0)
+        slow_count = result['metrics']['slow_query_ms']['count']
+        # a blocked event loop shows up as billing ticks as late as the slow query
+        if slow_count and lag < args.slow_query * 1000 / 2:
+            print(f"[bench] {slow_count} slow queries did not block the event loop (max tick lag {lag} ms)")
+        else:
+            print(f"[bench] event loop blocked: max tick lag {lag} ms with {slow_count} "
+                  f"{args.slow_query}s queries")
+            return 1
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        regressions = compare(previous, result, args.threshold)
+        if regressions:
+            print(f"[bench] {len(regressions)} metric(s) worse than {args.threshold:.0f}%: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
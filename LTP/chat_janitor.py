@@ -0,0 +1,119 @@
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+
+
+class ChatJanitor:
+    """Deletes (and optionally archives) a user's chat in the background after logout.
+
+    ``request`` only records a row in ``chat_purges``; ``run_pending`` works through
+    those rows. Each purge walks the user's messages in id order, at most
+    ``batch_size`` ids at a time found through the (from_user_id, ...) and
+    (to_user_id, id) indexes, and deletes each batch by primary key, so no statement
+    scans or locks more than one batch. Only messages up to ``upto_id`` (the last id
+    handed out at logout) are removed; a new session's chat is left alone.
+
+    With ``archive_dir`` set, every batch is first appended to a gzip'd JSONL file,
+    so the archive is streamed and never held in memory. A purge interrupted between
+    archiving and deleting a batch archives that batch again when it is resumed.
+    """
+
+    def __init__(self, connection, batch_size=500, archive_dir=None, before_purge=None,
+                 sleep=time.sleep):
+        # connection: callable returning a context manager that yields a DB connection
+        self._connection = connection
+        self.batch_size = batch_size
+        self.archive_dir = archive_dir
+        # e.g. flush the message write queue so queued rows are stored before deleting
+        self._before_purge = before_purge
+        self._sleep = sleep
+        self._stats = {
+            'requested': 0,
+            'purges': 0,
+            'deleted': 0,
+            'archived': 0,
+            'batches': 0,
+            'failures': 0,
+            'last_purge_ms': 0.0,
+        }
+
+    def request(self, user_id, upto_id):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("INSERT INTO chat_purges (user_id, upto_id) VALUES (%s, %s)", (user_id, upto_id))
+        self._stats['requested'] += 1
+
+    def run_pending(self, limit=20):
+        """Carry out up to ``limit`` outstanding purges, oldest first; returns how many finished."""
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id, user_id, upto_id FROM chat_purges WHERE finished_at IS NULL "
+                        "ORDER BY id LIMIT %s", (limit,))
+            jobs = cur.fetchall()
+        if not jobs:
+            return 0
+        if self._before_purge is not None:
+            self._before_purge()
+        done = 0
+        for job in jobs:
+            try:
+                self.purge(job)
+                done += 1
+            except Exception as e:
+                # left unfinished; picked up again on the next run
+                self._stats['failures'] += 1
+                print(f"[janitor] purge {job['id']} of user {job['user_id']} failed", e)
+        return done
+
+    def purge(self, job):
+        started = time.monotonic()
+        archive_path = self._archive_path(job) if self.archive_dir else None
+        deleted = 0
+        while True:
+            with self._connection() as conn, conn.cursor() as cur:
+                ids = self._next_batch(cur, job['user_id'], job['upto_id'])
+                if not ids:
+                    break
+                placeholders = ", ".join(["%s"] * len(ids))
+                if archive_path:
+                    cur.execute("SELECT id, from_user_id, to_user_id, content, created_at FROM messages "
+                                f"WHERE id IN ({placeholders}) ORDER BY id", ids)
+                    self._append_archive(archive_path, cur.fetchall())
+                cur.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", ids)
+                deleted += cur.rowcount
+            self._stats['batches'] += 1
+            # let sockets and billing run between batches
+            self._sleep(0)
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("UPDATE chat_purges SET finished_at=%s, deleted=deleted+%s, archive_path=%s WHERE id=%s",
+                        (datetime.now(), deleted, archive_path, job['id']))
+        self._stats['purges'] += 1
+        self._stats['deleted'] += deleted
+        self._stats['last_purge_ms'] = round((time.monotonic() - started) * 1000, 3)
+        return deleted
+
+    def stats(self):
+        return dict(self._stats)
+
+    def _next_batch(self, cur, user_id, upto_id):
+        """Lowest ``batch_size`` ids of messages sent by or to the user, up to upto_id."""
+        branch = "SELECT id FROM (SELECT id FROM messages WHERE {col}=%s AND id <= %s ORDER BY id LIMIT %s) {alias}"
+        cur.execute(
+            f"{branch.format(col='from_user_id', alias='f')} UNION {branch.format(col='to_user_id', alias='t')} "
+            "ORDER BY id LIMIT %s",
+            (user_id, upto_id, self.batch_size, user_id, upto_id, self.batch_size, self.batch_size)
+        )
+        return [r['id'] for r in cur.fetchall()]
+
+    def _archive_path(self, job):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        return os.path.join(self.archive_dir, f"chat_user{job['user_id']}_purge{job['id']}.jsonl.gz")
+
+    def _append_archive(self, path, rows):
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for r in rows:
+                if isinstance(r.get('created_at'), datetime):
+                    r['created_at'] = str(r['created_at'])
+                f.write(json.dumps(r, ensure_ascii=False))
+                f.write("\n")
+        self._stats['archived'] += len(rows)
@@ -0,0 +1,353 @@
+"""Shared state for running several app workers side by side.
+
+Everything that has to be the same on every worker lives behind a small store
+interface: presence (which sockets belong to which user), the admins' current
+chat targets, the running billing sessions, counters, and a lease that elects the
+one worker allowed to run the billing and expiry loops.
+
+``MemoryStore`` keeps that state in the process. It is the default for a single
+worker. ``NETCAFE_SHARED_STORE_URL=memory://`` gives a MemoryStore that says it is
+shared: the app then takes every multi-worker code path (session table in the
+store, store locks, leader lease) without a Redis server, and tests can put two
+``Cluster`` / ledger pairs on one store to act as two workers. ``RedisStore`` is
+what separate worker processes share; it needs the ``redis`` package.
+
+Running several workers:
+    NETCAFE_SHARED_STORE_URL=redis://localhost:6379/0 NETCAFE_PORT=5001 python app.py
+    NETCAFE_SHARED_STORE_URL=redis://localhost:6379/0 NETCAFE_PORT=5002 python app.py
+Cross-worker emits go through the Socket.IO message queue (the same Redis by
+default) and the load balancer in front must use sticky sessions.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from ledger import Session
+
+
+class MemoryStore:
+    """In-process store with the same (string valued) semantics as RedisStore.
+
+    With ``shared=True`` the app treats it like a store other workers use too.
+    """
+
+    def __init__(self, clock=time.monotonic, shared=False):
+        self.shared = shared
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sets = defaultdict(set)
+        self._hashes = defaultdict(dict)
+        self._counters = defaultdict(int)
+        self._leases = {}  # name -> (owner, expires_at)
+        self._locks = {}
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+            return self._counters[key]
+
+    def get_int(self, key):
+        return self._counters.get(key, 0)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self._sets[key].update(str(m) for m in members)
+
+    def srem(self, key, *members):
+        with self._lock:
+            s = self._sets.get(key)
+            if not s:
+                return 0
+            before = len(s)
+            s.difference_update(str(m) for m in members)
+            if not s:
+                del self._sets[key]
+            return before - len(s)
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self._sets.get(key, ()))
+
+    def scard(self, key):
+        return len(self._sets.get(key, ()))
+
+    def hset(self, key, field, value):
+        with self._lock:
+            self._hashes[key][str(field)] = str(value)
+
+    def hget(self, key, field):
+        return self._hashes.get(key, {}).get(str(field))
+
+    def hexists(self, key, field):
+        return str(field) in self._hashes.get(key, {})
+
+    def hlen(self, key):
+        return len(self._hashes.get(key, {}))
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            h = self._hashes.get(key)
+            if not h:
+                return 0
+            return sum(1 for f in fields if h.pop(str(f), None) is not None)
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._hashes.get(key, {}))
+
+    def acquire_lease(self, name, owner, ttl):
+        """Take or renew the lease ``name`` for ``owner``; True while owner holds it."""
+        now = self._clock()
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is None or holder[0] == owner or holder[1] <= now:
+                self._leases[name] = (owner, now + ttl)
+                return True
+            return False
+
+    def lease_holder(self, name):
+        holder = self._leases.get(name)
+        return holder[0] if holder is not None and holder[1] > self._clock() else None
+
+    def release_lease(self, name, owner):
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is not None and holder[0] == owner:
+                del self._leases[name]
+
+    def lock(self, name, timeout=5.0):
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+
+# renew / release a lease only if this worker still owns it
+_RENEW_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisStore:
+    """Store shared by all workers, backed by Redis."""
+
+    shared = True
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(f"NETCAFE_SHARED_STORE_URL={url} needs the redis package "
+                               "(pip install redis)") from None
+
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._renew = self._redis.register_script(_RENEW_LEASE)
+        self._release = self._redis.register_script(_RELEASE_LEASE)
+
+    def incr(self, key, amount=1):
+        return self._redis.incrby(key, amount)
+
+    def get_int(self, key):
+        return int(self._redis.get(key) or 0)
+
+    def sadd(self, key, *members):
+        self._redis.sadd(key, *members)
+
+    def srem(self, key, *members):
+        return self._redis.srem(key, *members)
+
+    def smembers(self, key):
+        return self._redis.smembers(key)
+
+    def scard(self, key):
+        return self._redis.scard(key)
+
+    def hset(self, key, field, value):
+        self._redis.hset(key, field, value)
+
+    def hget(self, key, field):
+        return self._redis.hget(key, field)
+
+    def hexists(self, key, field):
+        return bool(self._redis.hexists(key, field))
+
+    def hlen(self, key):
+        return self._redis.hlen(key)
+
+    def hdel(self, key, *fields):
+        return self._redis.hdel(key, *fields)
+
+    def hgetall(self, key):
+        return self._redis.hgetall(key)
+
+    def acquire_lease(self, name, owner, ttl):
+        ttl_ms = int(ttl * 1000)
+        if self._redis.set(name, owner, nx=True, px=ttl_ms):
+            return True
+        return bool(self._renew(keys=[name], args=[owner, ttl_ms]))
+
+    def lease_holder(self, name):
+        return self._redis.get(name)
+
+    def release_lease(self, name, owner):
+        self._release(keys=[name], args=[owner])
+
+    def lock(self, name, timeout=5.0):
+        return _SharedLock(self._redis.lock(name, timeout=timeout, blocking_timeout=timeout,
+                                            thread_local=False))
+
+
+class _SharedLock:
+    """Redis lock behind a process-local one, so this process only ever has one token in flight."""
+
+    def __init__(self, redis_lock):
+        self._local = threading.Lock()
+        self._redis_lock = redis_lock
+
+    def __enter__(self):
+        self._local.acquire()
+        try:
+            if not self._redis_lock.acquire():
+                raise RuntimeError(f"timed out waiting for lock {self._redis_lock.name}")
+        except Exception:
+            self._local.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._redis_lock.release()
+        finally:
+            self._local.release()
+
+
+def make_store(url=None):
+    if not url:
+        return MemoryStore()
+    if url.startswith("memory:"):
+        # the shared-store code paths in a single process, no Redis needed
+        return MemoryStore(shared=True)
+    return RedisStore(url)
+
+
+class SharedSessionTable:
+    """Mapping of user_id -> Session kept in a store hash, for SessionLedger.
+
+    Every change bumps a version counter so the billing leader can tell when
+    another worker started, credited or stopped a session.
+    """
+
+    def __init__(self, store, key="netcafe:sessions"):
+        self._store = store
+        self.key = key
+        self.version_key = key + ":version"
+
+    def version(self):
+        return self._store.get_int(self.version_key)
+
+    def __contains__(self, user_id):
+        return self._store.hexists(self.key, user_id)
+
+    def __len__(self):
+        return self._store.hlen(self.key)
+
+    def __setitem__(self, user_id, s):
+        self._store.hset(self.key, user_id, f"{s.started_at!r} {s.balance_at_start!r} {s.rate!r}")
+        self._store.incr(self.version_key)
+
+    def get(self, user_id):
+        raw = self._store.hget(self.key, user_id)
+        return self._decode(user_id, raw) if raw is not None else None
+
+    def pop(self, user_id, default=None):
+        s = self.get(user_id)
+        if s is None:
+            return default
+        self._store.hdel(self.key, user_id)
+        self._store.incr(self.version_key)
+        return s
+
+    def values(self):
+        return [self._decode(uid, raw) for uid, raw in self._store.hgetall(self.key).items()]
+
+    @staticmethod
+    def _decode(user_id, raw):
+        started_at, balance, rate = raw.split()
+        return Session(int(user_id), float(started_at), float(balance), float(rate))
+
+
+class Cluster:
+    """This worker's identity and its view of the billing leader lease.
+
+    Every heartbeat also renews the worker's own liveness lease (three times as long
+    as the leader lease); once it has run out the worker counts as gone and the
+    leader reaps its sockets (PresenceRegistry.reap).
+    """
+
+    LEASE_NAME = "netcafe:billing-leader"
+    WORKER_LEASE_PREFIX = "netcafe:worker:"
+
+    def __init__(self, store, worker_id=None, lease_ttl=10.0, clock=time.monotonic):
+        self.store = store
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.lease_ttl = lease_ttl
+        self._clock = clock
+        self._leader_until = 0.0
+        self._next_heartbeat = 0.0
+        self.elections = 0
+
+    def is_leader(self):
+        # stop acting as leader once our own copy of the lease runs out, even if the
+        # renewal could not reach the store
+        return self._clock() < self._leader_until
+
+    def heartbeat(self, force=False):
+        """Acquire or renew the leader lease (at most every lease_ttl / 3 seconds).
+
+        Returns (is_leader, became_leader).
+        """
+        now = self._clock()
+        if not force and now < self._next_heartbeat:
+            return self.is_leader(), False
+        self._next_heartbeat = now + self.lease_ttl / 3
+        try:
+            self.store.acquire_lease(self.WORKER_LEASE_PREFIX + self.worker_id, self.worker_id,
+                                     self.lease_ttl * 3)
+        except Exception as e:
+            print('[cluster] worker lease renewal failed', e)
+        was_leader = self.is_leader()
+        try:
+            held = self.store.acquire_lease(self.LEASE_NAME, self.worker_id, self.lease_ttl)
+        except Exception as e:
+            print('[cluster] lease renewal failed', e)
+            held = False
+        if held:
+            self._leader_until = now + self.lease_ttl
+        elif was_leader:
+            self._leader_until = 0.0
+        became = held and not was_leader
+        if became:
+            self.elections += 1
+            print(f"[cluster] {self.worker_id} is now the billing leader")
+        elif was_leader and not held:
+            print(f"[cluster] {self.worker_id} lost the billing lease")
+        return held, became
+
+    def is_alive(self, worker_id):
+        """False once ``worker_id`` stopped renewing its liveness lease."""
+        return self.store.lease_holder(self.WORKER_LEASE_PREFIX + worker_id) is not None
+
+    def resign(self):
+        if self.is_leader():
+            self.store.release_lease(self.LEASE_NAME, self.worker_id)
+        self._leader_until = 0.0
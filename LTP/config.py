@@ -0,0 +1,21 @@
+import os
+
+# Cấu hình kết nối DB (có thể ghi đè bằng biến môi trường)
+DB_CONFIG = {
+    "host": os.environ.get("NETCAFE_DB_HOST", "localhost"),
+    "port": int(os.environ.get("NETCAFE_DB_PORT", "3306")),
+    "user": os.environ.get("NETCAFE_DB_USER", "root"),
+    "password": os.environ.get("NETCAFE_DB_PASSWORD", "123456"),
+    "database": os.environ.get("NETCAFE_DB_NAME", "netcafe"),
+}
+
+# Chọn CSDL (xem storage.py): bỏ trống = MySQL theo DB_CONFIG; "sqlite:///netcafe.db" = file SQLite
+# nhúng (WAL, không cần máy chủ CSDL); "sqlite://" = SQLite trong bộ nhớ (test, benchmark)
+DB_URL = os.environ.get("NETCAFE_DB_URL") or None
+
+# Chạy nhiều worker: kho trạng thái dùng chung (vd. redis://localhost:6379/0) và hàng đợi
+# Socket.IO để emit giữa các process (mặc định dùng chung Redis đó). Bỏ trống = 1 worker.
+SHARED_STORE_URL = os.environ.get("NETCAFE_SHARED_STORE_URL") or None
+# (memory:// = kho dùng chung giả lập trong 1 process, để chạy thử; không cần hàng đợi)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("NETCAFE_SOCKETIO_MESSAGE_QUEUE") or (
+    SHARED_STORE_URL if SHARED_STORE_URL and not SHARED_STORE_URL.startswith("memory:") else None)
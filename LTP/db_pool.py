@@ -0,0 +1,200 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within checkout_timeout."""
+
+
+class ConnectionPool:
+    """Bounded pool of reusable DB connections.
+
+    A caller waiting for a free slot blocks on a condition that ``release`` signals
+    (a green wait once eventlet has patched ``threading``, as in app.py), and
+    connections are closed outside the lock. A connection is only pinged before
+    reuse when it sat idle for more than ``ping_after`` seconds; one that went away
+    sooner fails its query and is discarded on release instead.
+    """
+
+    def __init__(self, connect, max_size=10, idle_timeout=300, checkout_timeout=5.0,
+                 ping_after=30.0, clock=time.monotonic):
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        # idle connections as (conn, returned_at); used as a LIFO stack so the
+        # oldest (first to be evicted) stay at the front
+        self._idle = []
+        self._open = 0
+        self._in_use = 0
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'created': 0,
+            'evicted': 0,
+            'health_checks': 0,
+            'health_check_failures': 0,
+            'checkout_time_total': 0.0,
+            'checkout_time_max': 0.0,
+        }
+
+    # ----------------------------
+    # checkout / return
+    # ----------------------------
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        conn = returned_at = None
+        waited = timed_out = False
+        with self._available:
+            evicted = self._evict_idle_locked(self._clock())
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._open < self.max_size:
+                    # reserve a slot, connect outside the lock
+                    self._open += 1
+                    self._in_use += 1
+                    break
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    timed_out = True
+                    break
+                self._available.wait(remaining)
+        self._close_all(evicted)
+        if timed_out:
+            raise PoolTimeout(f"no DB connection available after {self.checkout_timeout}s "
+                              f"(pool size {self.max_size})")
+
+        if conn is None:
+            conn = self._create()
+        elif self._clock() - returned_at > self.ping_after:
+            conn = self._check_health(conn)
+        self._record_checkout(time.monotonic() - start)
+        return conn
+
+    def release(self, conn, discard=False):
+        if not discard and not getattr(conn, 'open', True):
+            discard = True
+        if discard:
+            self._close(conn)
+            with self._available:
+                self._in_use -= 1
+                self._open -= 1
+                self._available.notify()
+            return
+        now = self._clock()
+        with self._available:
+            self._in_use -= 1
+            self._idle.append((conn, now))
+            evicted = self._evict_idle_locked(now)
+            self._available.notify()
+        self._close_all(evicted)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            # a broken socket must not go back into the pool
+            self.release(conn, discard=not getattr(conn, 'open', True))
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    # ----------------------------
+    # stats
+    # ----------------------------
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['in_use'] = self._in_use
+            s['idle'] = len(self._idle)
+            s['open'] = self._open
+            s['max_size'] = self.max_size
+        total = s.pop('checkout_time_total')
+        s['checkout_latency_avg_ms'] = round(total / s['checkouts'] * 1000, 3) if s['checkouts'] else 0.0
+        s['checkout_latency_max_ms'] = round(s.pop('checkout_time_max') * 1000, 3)
+        return s
+
+    # ----------------------------
+    # internals
+    # ----------------------------
+    def _create(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._available:
+                self._open -= 1
+                self._in_use -= 1
+                self._available.notify()
+            raise
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+    def _check_health(self, conn):
+        with self._lock:
+            self._stats['health_checks'] += 1
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except Exception:
+            self._close(conn)
+            with self._lock:
+                self._stats['health_check_failures'] += 1
+        # the slot stays reserved for the replacement connection
+        return self._create()
+
+    def _evict_idle_locked(self, now):
+        """Take connections idle for longer than idle_timeout out of the pool; the
+        caller closes them once the lock is released."""
+        evicted = []
+        if not self.idle_timeout:
+            return evicted
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._open -= 1
+            self._stats['evicted'] += 1
+            evicted.append(conn)
+        if evicted:
+            # freed slots
+            self._available.notify(len(evicted))
+        return evicted
+
+    def _close_all(self, conns):
+        for conn in conns:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _record_checkout(self, elapsed):
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['checkout_time_total'] += elapsed
+            if elapsed > self._stats['checkout_time_max']:
+                self._stats['checkout_time_max'] = elapsed
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+# value stored for a key whose first request is still being processed
+PENDING = object()
+
+
+class DedupCache:
+    """Bounded TTL + LRU map of idempotency keys to the result of their first request."""
+
+    def __init__(self, max_size=10000, ttl=120.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._items)
+
+    def claim(self, key):
+        """Try to become the first request for ``key``.
+
+        Returns (True, None) when the caller should process the request, otherwise
+        (False, value) where value is the stored result or PENDING if the first
+        request has not finished yet.
+        """
+        now = self._clock()
+        with self._lock:
+            self._expire_locked(now)
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                return False, item[1]
+            self._items[key] = (now + self.ttl, PENDING)
+            self._trim_locked()
+            return True, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (self._clock() + self.ttl, value)
+            self._items.move_to_end(key)
+            self._trim_locked()
+
+    def discard(self, key):
+        """Forget a claimed key (e.g. the request failed and may be retried)."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def _expire_locked(self, now):
+        # entries are kept roughly in insertion/use order, so expired ones sit at the front
+        while self._items:
+            key, (expires_at, _) = next(iter(self._items.items()))
+            if expires_at > now:
+                break
+            self._items.popitem(last=False)
+
+    def _trim_locked(self):
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
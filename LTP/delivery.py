@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+
+import wire
+
+
+class Delivery:
+    """Single path for server-initiated Socket.IO events.
+
+    A logical event addressed to several rooms (e.g. both chat participants) is
+    sent with one emit to the list of rooms: python-socketio resolves that to the
+    distinct set of sockets and encodes the packet once. Events queued for the same
+    set of rooms before the event loop gets a chance to flush (i.e. within one tick)
+    are coalesced into a single ``batch`` frame of ``[event, payload]`` pairs.
+
+    With ``compact=True`` clients may have negotiated the compact wire format
+    (``set_format``, see wire.py): every frame then goes out once per format, to the
+    plain rooms and to their compact variants, encoded for each. ``has_members(room)``
+    lets it skip rooms nobody is in (only knowable without a message queue).
+    """
+
+    def __init__(self, socketio, coalesce=True, flush_delay=0.0, compact=False, has_members=None):
+        self._socketio = socketio
+        self.coalesce = coalesce
+        self.flush_delay = flush_delay
+        self.compact = compact
+        self._has_members = has_members
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # tuple of rooms -> [[event, payload], ...]
+        self._flush_scheduled = False
+        self._counters = {}  # event -> {'events': n, 'emits': n}
+        self._frames = {'single': 0, 'batch': 0, 'batched_events': 0, 'compact': 0}
+        # sid -> wire format of this worker's joined sockets; an event addressed to
+        # one of them goes out in its format only
+        self._formats = {}
+
+    def set_format(self, sid, fmt):
+        self._formats[sid] = fmt
+
+    def client_format(self, sid):
+        return self._formats.get(sid, wire.JSON)
+
+    def forget(self, sid):
+        self._formats.pop(sid, None)
+
+    def send(self, event, payload, to):
+        """Queue one logical event for a room, a sid, or a list of them."""
+        rooms = (to,) if isinstance(to, str) else tuple(OrderedDict.fromkeys(to))
+        if not rooms:
+            return
+        with self._lock:
+            c = self._counters.setdefault(event, {'events': 0, 'emits': 0})
+            c['events'] += 1
+            if not self.coalesce:
+                c['emits'] += 1
+                self._frames['single'] += 1
+            else:
+                self._pending.setdefault(rooms, []).append([event, payload])
+                if self._flush_scheduled:
+                    return
+                self._flush_scheduled = True
+        if not self.coalesce:
+            self._emit(event, payload, rooms)
+            return
+        self._socketio.start_background_task(self._flush_soon)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            self._flush_scheduled = False
+            for frames in pending.values():
+                # every event in a frame went out in exactly one emit
+                for event, _ in frames:
+                    self._counters[event]['emits'] += 1
+                if len(frames) == 1:
+                    self._frames['single'] += 1
+                else:
+                    self._frames['batch'] += 1
+                    self._frames['batched_events'] += len(frames)
+        for rooms, frames in pending.items():
+            if len(frames) == 1:
+                self._emit(frames[0][0], frames[0][1], rooms)
+            else:
+                self._emit_batch(frames, rooms)
+
+    def stats(self):
+        with self._lock:
+            events = {}
+            for name, c in self._counters.items():
+                events[name] = {
+                    'events': c['events'],
+                    'emits': c['emits'],
+                    'emits_per_event': round(c['emits'] / c['events'], 3) if c['events'] else 0.0,
+                }
+            return {'events': events, 'frames': dict(self._frames)}
+
+    def _flush_soon(self):
+        # let the current handler finish queueing before the frame goes out
+        self._socketio.sleep(self.flush_delay)
+        self.flush()
+
+    def _targets(self, rooms):
+        """[(wire format, rooms)]: who receives a frame for ``rooms``, per format."""
+        if not self.compact:
+            return [(wire.JSON, list(rooms))]
+        by_format = {}
+        for r in rooms:
+            fmt = self._formats.get(r)
+            if fmt is not None:
+                # a sid of this worker
+                by_format.setdefault(fmt, []).append(r)
+                continue
+            by_format.setdefault(wire.JSON, []).append(r)
+            for fmt in wire.FORMATS[1:]:
+                by_format.setdefault(fmt, []).append(wire.room(r, fmt))
+        if self._has_members is not None:
+            by_format = {fmt: [r for r in targets if self._has_members(r)] for fmt, targets in by_format.items()}
+        return [(fmt, targets) for fmt, targets in by_format.items() if targets]
+
+    def _emit(self, event, payload, rooms):
+        for fmt, targets in self._targets(rooms):
+            self._send(event, wire.encode(event, payload, fmt), targets, fmt)
+
+    def _emit_batch(self, frames, rooms):
+        for fmt, targets in self._targets(rooms):
+            self._send('batch', [[event, wire.encode(event, payload, fmt)] for event, payload in frames], targets, fmt)
+
+    def _send(self, event, data, targets, fmt):
+        if fmt != wire.JSON:
+            self._frames['compact'] += 1
+        try:
+            self._socketio.emit(event, data, to=targets if len(targets) > 1 else targets[0])
+        except Exception as e:
+            print(f"[delivery] emit {event} failed", e)
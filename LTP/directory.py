@@ -0,0 +1,108 @@
+import threading
+import time
+
+
+class UserDirectory:
+    """In-process cache of who the users are: id -> (username, role), username -> id, admins.
+
+    Identity columns change far less often than they are read (every chat line needs
+    the sender's name and role and, for users, an admin to talk to), so the whole set
+    is loaded in one query and served from memory. Code that creates or changes a
+    user calls ``invalidate()``; that bumps a counter in the shared store so the
+    other workers reload as well.
+    """
+
+    VERSION_KEY = "netcafe:users:version"
+
+    def __init__(self, connection, store=None, check_interval=1.0, min_reload_interval=1.0,
+                 clock=time.monotonic):
+        # connection: callable returning a context manager that yields a DB connection
+        self._connection = connection
+        self._store = store
+        self.check_interval = check_interval
+        self.min_reload_interval = min_reload_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (id -> (username, role), username -> id, sorted admin ids); None until loaded
+        self._state = None
+        self._version = None
+        self._next_version_check = 0.0
+        self._loaded_at = float('-inf')
+        self._counters = {'hits': 0, 'misses': 0, 'loads': 0, 'invalidations': 0}
+
+    def get(self, user_id):
+        """(username, role) for a user id, or None if there is no such user."""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        return self._lookup(lambda state: state[0].get(user_id))
+
+    def id_for(self, username):
+        return self._lookup(lambda state: state[1].get(username))
+
+    def role(self, user_id):
+        u = self.get(user_id)
+        return u[1] if u else None
+
+    def admin_id(self):
+        """The admin that users chat with (the lowest admin id), or None."""
+        admins = self._ensure_fresh()[2]
+        return admins[0] if admins else None
+
+    def users(self, role=None):
+        """[{'id', 'username'}] ordered by id, optionally only one role."""
+        by_id = self._ensure_fresh()[0]
+        return [{'id': uid, 'username': name} for uid, (name, r) in sorted(by_id.items())
+                if role is None or r == role]
+
+    def invalidate(self):
+        """Drop the cache here and tell the other workers to drop theirs."""
+        with self._lock:
+            self._state = None
+            self._counters['invalidations'] += 1
+        if self._store is not None:
+            # we already dropped ours, no need to reload again when we see the new version
+            self._version = self._store.incr(self.VERSION_KEY)
+
+    def stats(self):
+        state = self._state
+        return dict(self._counters, users=len(state[0]) if state else 0, admins=len(state[2]) if state else 0)
+
+    def _lookup(self, find):
+        found = find(self._ensure_fresh())
+        if found is not None:
+            self._counters['hits'] += 1
+            return found
+        self._counters['misses'] += 1
+        # unknown key: the user may have been created on another worker just now;
+        # reload, but not more than once per min_reload_interval
+        if self._clock() - self._loaded_at >= self.min_reload_interval:
+            return find(self._load())
+        return None
+
+    def _ensure_fresh(self):
+        now = self._clock()
+        if self._store is not None and now >= self._next_version_check:
+            self._next_version_check = now + self.check_interval
+            version = self._store.get_int(self.VERSION_KEY)
+            if version != self._version:
+                self._version = version
+                with self._lock:
+                    self._state = None
+        state = self._state
+        return state if state is not None else self._load()
+
+    def _load(self):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id, username, role FROM users")
+            rows = cur.fetchall()
+        by_id = {r['id']: (r['username'], r['role']) for r in rows}
+        state = (by_id,
+                 {name: uid for uid, (name, _) in by_id.items()},
+                 sorted(uid for uid, (_, role) in by_id.items() if role == 'admin'))
+        with self._lock:
+            self._state = state
+            self._loaded_at = self._clock()
+            self._counters['loads'] += 1
+        return state
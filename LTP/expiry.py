@@ -0,0 +1,70 @@
+import heapq
+import itertools
+import threading
+
+
+class ExpiryScheduler:
+    """Min-heap of per-key deadlines.
+
+    Each key has at most one live deadline. Rescheduling pushes a new heap entry
+    (O(log n)) and leaves the old one behind as stale; stale entries are skipped
+    when they reach the top and the heap is compacted when they pile up. A key
+    that comes due is removed, so it fires exactly once until scheduled again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []  # (deadline, seq, key)
+        self._live = {}  # key -> seq of its current heap entry
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, key):
+        return key in self._live
+
+    def schedule(self, key, deadline):
+        """Set (or move) the deadline for ``key``."""
+        with self._lock:
+            seq = next(self._seq)
+            self._live[key] = seq
+            heapq.heappush(self._heap, (deadline, seq, key))
+            if len(self._heap) > 64 and len(self._heap) > 2 * len(self._live):
+                self._compact_locked()
+
+    def keys(self):
+        with self._lock:
+            return list(self._live)
+
+    def cancel(self, key):
+        with self._lock:
+            self._live.pop(key, None)
+
+    def next_deadline(self):
+        """Earliest live deadline, or None when nothing is scheduled."""
+        with self._lock:
+            self._drop_stale_locked()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return every key whose deadline is <= now."""
+        due = []
+        with self._lock:
+            while True:
+                self._drop_stale_locked()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, _, key = heapq.heappop(self._heap)
+                del self._live[key]
+                due.append(key)
+        return due
+
+    def _drop_stale_locked(self):
+        heap = self._heap
+        while heap and self._live.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+
+    def _compact_locked(self):
+        self._heap = [e for e in self._heap if self._live.get(e[2]) == e[1]]
+        heapq.heapify(self._heap)
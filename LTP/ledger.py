@@ -0,0 +1,127 @@
+import threading
+import time
+
+
+class Session:
+    __slots__ = ('user_id', 'started_at', 'balance_at_start', 'rate')
+
+    def __init__(self, user_id, started_at, balance_at_start, rate):
+        self.user_id = user_id
+        self.started_at = started_at
+        self.balance_at_start = balance_at_start
+        self.rate = rate
+
+    def balance(self, now):
+        elapsed = max(0.0, now - self.started_at)
+        return max(0.0, self.balance_at_start - elapsed * self.rate)
+
+    def seconds_left(self, now):
+        if not self.rate:
+            return 0
+        return int(self.balance(now) / self.rate)
+
+    def settle(self, now):
+        """Whole seconds and whole-đồng charge of the stretch since started_at.
+
+        The charge is rounded to the nearest đồng and never exceeds the balance, so
+        a session cut off at its deadline ends at exactly 0.
+        """
+        elapsed = max(0.0, now - self.started_at)
+        return int(round(elapsed)), min(int(self.balance_at_start), int(round(elapsed * self.rate)))
+
+    def expires_at(self):
+        """Wall-clock time at which the balance reaches zero."""
+        if not self.rate:
+            return None
+        return self.started_at + self.balance_at_start / self.rate
+
+
+class SessionLedger:
+    """Authoritative in-process record of active (billed) sessions.
+
+    Each session only stores when it started, the balance at that moment (whole
+    đồng) and the per-second rate; the current balance is derived on demand, so
+    nothing has to be written while a seat is simply in use. ``stop`` and ``credit``
+    settle the stretch since the session (re)started into a whole-đồng charge;
+    recording those charges (usage.UsageLedger) is left to the caller.
+
+    ``sessions`` is a dict by default; several workers share one ledger by passing
+    a store-backed table (cluster.SharedSessionTable) and a lock that spans them.
+    """
+
+    def __init__(self, rate, clock=time.time, sessions=None, lock=None):
+        self.rate = rate
+        self._clock = clock
+        self._lock = lock if lock is not None else threading.Lock()
+        self._sessions = sessions if sessions is not None else {}
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def now(self):
+        return self._clock()
+
+    def start(self, user_id, balance, started_at=None):
+        """Open a session (no-op if one is already running) and return it."""
+        with self._lock:
+            s = self._sessions.get(user_id)
+            if s is None:
+                s = Session(user_id, started_at if started_at is not None else self._clock(),
+                            int(balance or 0), self.rate)
+                self._sessions[user_id] = s
+            return s
+
+    def stop(self, user_id, now=None):
+        """Close a session; returns (final balance, seconds, charge) or None if it was not running."""
+        now = now if now is not None else self._clock()
+        with self._lock:
+            s = self._sessions.pop(user_id, None)
+        if s is None:
+            return None
+        seconds, charge = s.settle(now)
+        return int(s.balance_at_start) - charge, seconds, charge
+
+    def credit(self, user_id, amount, now=None):
+        """Add money to a running session; returns (new balance, seconds, charge) or None.
+
+        The stretch used so far is charged first (seconds, charge) and the session is
+        rebased at ``now``, so later reads stay a single subtraction.
+        """
+        now = now if now is not None else self._clock()
+        with self._lock:
+            s = self._sessions.get(user_id)
+            if s is None:
+                return None
+            seconds, charge = s.settle(now)
+            s.balance_at_start = int(s.balance_at_start) - charge + int(amount)
+            s.started_at = now
+            self._sessions[user_id] = s
+            return s.balance_at_start, seconds, charge
+
+    def get(self, user_id):
+        return self._sessions.get(user_id)
+
+    def balance(self, user_id, now=None):
+        s = self._sessions.get(user_id)
+        if s is None:
+            return None
+        return s.balance(now if now is not None else self._clock())
+
+    def snapshot(self, user_ids=None, now=None):
+        """Return [(user_id, balance)] for the given users (or all sessions) at ``now``."""
+        now = now if now is not None else self._clock()
+        with self._lock:
+            if user_ids is None:
+                sessions = list(self._sessions.values())
+            else:
+                sessions = [s for s in map(self._sessions.get, user_ids) if s is not None]
+        return [(s.user_id, s.balance(now)) for s in sessions]
+
+    def deadlines(self):
+        """Return [(user_id, expires_at)] for every session."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return [(s.user_id, s.expires_at()) for s in sessions]
@@ -0,0 +1,116 @@
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+
+class LoopMonitor:
+    """Measures event-loop scheduling lag and catches whatever blocks the loop.
+
+    A background task sleeps ``interval`` over and over; how much later than asked
+    it wakes up is the lag every other task and handler saw at that moment.
+
+    With ``watchdog=True`` (eventlet) a real OS thread also checks that the task
+    keeps waking up. When it has been silent for ``threshold`` seconds, the hub's
+    OS thread is stuck in one green thread (a blocking call, a long loop), and the
+    watchdog records that thread's current stack, which points at the code
+    responsible. Pass the unpatched ``threading`` module and ``time.sleep``
+    (eventlet.patcher.original) as ``os_threading`` / ``os_sleep`` so the watchdog
+    really runs outside the hub.
+    """
+
+    def __init__(self, sleep, start_task, interval=0.1, threshold=0.25, keep=6000, keep_stalls=20,
+                 watchdog=False, os_threading=threading, os_sleep=time.sleep, observe=None,
+                 clock=time.monotonic):
+        self.interval = interval
+        self.threshold = threshold
+        self._sleep = sleep
+        self._start_task = start_task
+        self._watchdog = watchdog
+        self._os_threading = os_threading
+        self._os_sleep = os_sleep
+        # e.g. a metrics histogram's observe(seconds)
+        self._observe = observe
+        self._clock = clock
+        self._lags = deque(maxlen=keep)
+        self._stalls = deque(maxlen=keep_stalls)
+        self._started = False
+        self._hub_ident = None
+        self._last_beat = None
+        self._pending_stall = None
+        self._counters = {'samples': 0, 'stalls': 0, 'max_lag_ms': 0.0}
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        self._start_task(self._run)
+
+    def stats(self):
+        lags = sorted(self._lags)
+        return dict(self._counters,
+                    interval_ms=self.interval * 1000,
+                    threshold_ms=self.threshold * 1000,
+                    watchdog=self._watchdog,
+                    lag_ms=_percentiles(lags),
+                    recent_stalls=list(reversed(self._stalls)))
+
+    def _run(self):
+        self._hub_ident = self._os_threading.get_ident()
+        self._last_beat = self._clock()
+        if self._watchdog:
+            self._os_threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            beat = self._last_beat
+            self._sleep(self.interval)
+            now = self._clock()
+            lag = max(0.0, now - beat - self.interval)
+            self._last_beat = now
+            self._record(lag)
+
+    def _record(self, lag):
+        lag_ms = lag * 1000
+        self._lags.append(lag_ms)
+        self._counters['samples'] += 1
+        if lag_ms > self._counters['max_lag_ms']:
+            self._counters['max_lag_ms'] = round(lag_ms, 3)
+        if self._observe is not None:
+            self._observe(lag)
+        stall = self._pending_stall
+        if stall is not None:
+            # the loop is running again: now we know how long it was blocked
+            self._pending_stall = None
+            stall['lag_ms'] = round(lag_ms, 3)
+
+    def _watch(self):
+        captured_beat = None
+        while True:
+            self._os_sleep(self.interval)
+            beat = self._last_beat
+            if beat == captured_beat or self._clock() - beat < self.interval + self.threshold:
+                continue
+            captured_beat = beat
+            frame = sys._current_frames().get(self._hub_ident)
+            if frame is None:
+                continue
+            stall = {
+                'at': datetime.now().isoformat(timespec='milliseconds'),
+                'blocked_ms_at_capture': round((self._clock() - beat - self.interval) * 1000, 3),
+                'lag_ms': None,
+                'stack': [line.rstrip() for line in traceback.format_stack(frame)],
+            }
+            self._counters['stalls'] += 1
+            self._stalls.append(stall)
+            self._pending_stall = stall
+
+
+def _percentiles(values):
+    if not values:
+        return {'count': 0}
+
+    def pct(p):
+        return round(values[min(len(values) - 1, int(p / 100.0 * len(values)))], 3)
+
+    return {'count': len(values), 'p50': pct(50), 'p95': pct(95), 'p99': pct(99), 'max': round(values[-1], 3)}
@@ -0,0 +1,268 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from itertools import islice
+
+from storage import MYSQL
+
+
+_COLUMNS = ("id", "from_user_id", "to_user_id", "content", "client_msg_id", "created_at")
+
+
+class QueueFull(Exception):
+    """Raised when a message could not be queued within put_timeout (the DB is falling behind)."""
+
+
+class IdAllocator:
+    """Hands out message ids before the row is written, from a (shared) store counter.
+
+    ``floor`` is the highest id known to exist; if the counter ever comes back below
+    it (e.g. the store was wiped) it is moved past it instead of reusing ids.
+    """
+
+    def __init__(self, store, key="netcafe:messages:last_id"):
+        self._store = store
+        self.key = key
+        self.floor = 0
+
+    def seed(self, max_id):
+        self.floor = max(self.floor, max_id)
+        current = self._store.get_int(self.key)
+        if current < max_id:
+            self._store.incr(self.key, max_id - current)
+
+    def current(self):
+        """Highest id handed out so far (by any worker sharing the counter)."""
+        return max(self.floor, self._store.get_int(self.key))
+
+    def next(self):
+        new_id = self._store.incr(self.key)
+        if new_id <= self.floor:
+            new_id = self._store.incr(self.key, self.floor - new_id + 1)
+        self.floor = new_id
+        return new_id
+
+
+class MessageWriter:
+    """Group-commit queue for chat message inserts.
+
+    ``submit`` gives the message its id and timestamp right away and returns the row,
+    so the caller can broadcast it without waiting for the database. A background task
+    writes queued rows with one multi-row INSERT per ``max_batch`` rows, every
+    ``flush_interval`` seconds or as soon as a full batch is waiting. Rows stay in the
+    queue until their INSERT succeeded, so a DB outage delays them instead of losing
+    them; the queue is bounded, and once ``max_pending`` rows are waiting ``submit``
+    blocks (yielding through ``sleep``) for up to ``put_timeout`` and then raises
+    QueueFull. Call ``close()`` on shutdown to write whatever is left.
+
+    Only transient errors (see the dialect's ``transient``) keep a batch queued. When
+    the database rejects the batch itself, it is written row by row and the rows it
+    still rejects are moved to ``dead_letters()`` (the last ``dead_letter_size``), so
+    one bad row cannot hold up every message behind it.
+    """
+
+    def __init__(self, connection, next_id, max_batch=200, flush_interval=0.05, max_pending=10000,
+                 put_timeout=2.0, retry_interval=1.0, sleep=time.sleep, create_event=threading.Event,
+                 start_task=None, wait_interval=0.005, dialect=MYSQL, dead_letter_size=1000):
+        # connection: callable returning a context manager that yields a DB connection
+        self._connection = connection
+        self._dialect = dialect
+        self._next_id = next_id
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.retry_interval = retry_interval
+        self._sleep = sleep
+        self._wait_interval = wait_interval
+        self._start_task = start_task
+        self._wakeup = create_event()
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._queue = deque()  # rows in id order
+        self._dead_letters = deque(maxlen=dead_letter_size)
+        self._task_started = False
+        self._failing = False
+        self._closed = False
+        self._stats = {
+            'submitted': 0,
+            'written': 0,
+            'duplicates': 0,
+            'dead_lettered': 0,
+            'batches': 0,
+            'failures': 0,
+            'rejected': 0,
+            'backpressure_waits': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+        }
+
+    def submit(self, from_user_id, to_user_id, content, client_msg_id=None):
+        """Queue a message and return its row (id and created_at already assigned)."""
+        if len(self._queue) >= self.max_pending:
+            self._wait_for_room()
+        row = {
+            'from_user_id': from_user_id,
+            'to_user_id': to_user_id,
+            'content': content,
+            'client_msg_id': client_msg_id,
+        }
+        # allocate under the lock so the queue stays in id order
+        with self._lock:
+            row['id'] = self._next_id()
+            # created_at is a second-precision TIMESTAMP
+            row['created_at'] = datetime.now().replace(microsecond=0)
+            self._queue.append(row)
+            self._stats['submitted'] += 1
+            full = len(self._queue) >= self.max_batch
+        self._ensure_task()
+        if full:
+            self._wakeup.set()
+        return dict(row)
+
+    def pending_between(self, a, b):
+        """Queued (not yet written) messages between two users, oldest first."""
+        pair = {(a, b), (b, a)}
+        with self._lock:
+            return [dict(r) for r in self._queue if (r['from_user_id'], r['to_user_id']) in pair]
+
+    def flush(self):
+        """Write everything queued so far; returns the number of rows written."""
+        # one flush at a time keeps rows in id order; wait by yielding, never by
+        # blocking the hub on the lock
+        while not self._flushing.acquire(blocking=False):
+            self._sleep(self._wait_interval)
+        try:
+            written = 0
+            while True:
+                with self._lock:
+                    batch = list(islice(self._queue, self.max_batch))
+                if not batch:
+                    break
+                started = time.monotonic()
+                try:
+                    stored = self._write(batch)
+                    done = len(batch)
+                except Exception as e:
+                    if self._dialect.transient(e):
+                        # keep the rows; the next flush retries them
+                        self._retry_later(e)
+                        break
+                    # the database refuses the batch itself (a value it cannot store,
+                    # an id already taken): find the rows at fault one by one
+                    done, stored = self._write_each(batch)
+                with self._lock:
+                    for _ in range(done):
+                        self._queue.popleft()
+                elapsed = (time.monotonic() - started) * 1000
+                self._stats['written'] += stored
+                self._stats['batches'] += 1
+                self._stats['last_flush_ms'] = elapsed
+                self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed)
+                written += stored
+                if done < len(batch):
+                    # a transient error part way through: retry the rest later
+                    break
+                self._failing = False
+            return written
+        finally:
+            self._flushing.release()
+
+    def close(self):
+        """Stop the background task and write the remaining rows."""
+        self._closed = True
+        self._wakeup.set()
+        return self.flush()
+
+    def stats(self):
+        s = dict(self._stats)
+        s['pending'] = len(self._queue)
+        s['max_pending'] = self.max_pending
+        s['avg_batch'] = round(s['written'] / s['batches'], 1) if s['batches'] else 0.0
+        s['last_flush_ms'] = round(s['last_flush_ms'], 3)
+        s['max_flush_ms'] = round(s['max_flush_ms'], 3)
+        return s
+
+    def dead_letters(self):
+        """Rows the database rejected, oldest first, with the error: [(row, message)]."""
+        return list(self._dead_letters)
+
+    def _write(self, batch):
+        """INSERT the rows of ``batch`` not stored yet; returns how many were inserted."""
+        with self._connection() as conn, conn.cursor() as cur:
+            # a row whose (from_user_id, client_msg_id) is already stored is a retry of
+            # a message written before a restart or by another worker: skip it. Any
+            # other clash (e.g. on the id) is an error, not a duplicate
+            stored = self._stored_keys(cur, batch)
+            rows = [r for r in batch if (r['from_user_id'], r['client_msg_id']) not in stored]
+            if rows:
+                params = []
+                for r in rows:
+                    params.extend(r[c] for c in _COLUMNS)
+                cur.execute(self._dialect.insert("messages", _COLUMNS, len(rows)), params)
+        self._stats['duplicates'] += len(batch) - len(rows)
+        return len(rows)
+
+    @staticmethod
+    def _stored_keys(cur, batch):
+        keys = [(r['from_user_id'], r['client_msg_id']) for r in batch if r['client_msg_id']]
+        if not keys:
+            return set()
+        where = " OR ".join(["(from_user_id = %s AND client_msg_id = %s)"] * len(keys))
+        cur.execute(f"SELECT from_user_id, client_msg_id FROM messages WHERE {where}",
+                    [v for key in keys for v in key])
+        return {(r['from_user_id'], r['client_msg_id']) for r in cur.fetchall()}
+
+    def _write_each(self, batch):
+        """Write ``batch`` one row at a time, setting aside the rows the database rejects.
+
+        Returns (rows settled from the front of the batch, rows inserted); stops early
+        on a transient error, leaving the rest queued.
+        """
+        stored = 0
+        for i, row in enumerate(batch):
+            try:
+                stored += self._write([row])
+            except Exception as e:
+                if self._dialect.transient(e):
+                    self._retry_later(e)
+                    return i, stored
+                self._stats['dead_lettered'] += 1
+                self._dead_letters.append((dict(row), str(e)))
+                print('[chat] message', row['id'], 'rejected by the database, set aside:', e)
+        return len(batch), stored
+
+    def _retry_later(self, e):
+        self._stats['failures'] += 1
+        self._failing = True
+        print('[chat] message flush failed, will retry', e)
+
+    def _wait_for_room(self):
+        self._stats['backpressure_waits'] += 1
+        self._wakeup.set()
+        deadline = time.monotonic() + self.put_timeout
+        while len(self._queue) >= self.max_pending:
+            if time.monotonic() >= deadline:
+                self._stats['rejected'] += 1
+                raise QueueFull(f"{len(self._queue)} messages waiting to be written")
+            self._sleep(self._wait_interval)
+
+    def _ensure_task(self):
+        if self._task_started or self._start_task is None or self._closed:
+            return
+        with self._lock:
+            if self._task_started:
+                return
+            self._task_started = True
+        self._start_task(self._run)
+
+    def _run(self):
+        while not self._closed:
+            # back off while the DB is failing instead of retrying every interval
+            self._wakeup.wait(self.retry_interval if self._failing else self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print('[chat] message flush failed', e)
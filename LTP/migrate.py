@@ -0,0 +1,174 @@
+"""Versioned schema migrations for the netcafe database.
+
+Migrations are the ``NNNN_name.sql`` files in ``migrations/`` (``migrations/sqlite/``
+for the SQLite backend, see storage.py), applied in order and recorded in the
+``schema_migrations`` table. Statements that only fail because the
+column or index already exists are skipped, so a migration can safely run against
+a database that already has part of it (e.g. one imported from netcafe.sql).
+
+Usage:
+    python migrate.py              # apply pending migrations
+    python migrate.py --dry-run    # show what would be applied
+    python migrate.py --check      # EXPLAIN the hot queries, fail on full scans
+"""
+import os
+import re
+import sys
+
+import repositories
+from config import DB_CONFIG, DB_URL
+from storage import MYSQL, make_backend
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Queries on the request/socket hot paths, as repositories.py runs them; each must be able
+# to use an index.
+HOT_QUERIES = [
+    ("login", repositories.LOGIN_SQL, ("admin", "x")),
+    ("user list", repositories.USER_LIST_SQL, ("user",)),
+    ("user topups", repositories.USER_TOPUPS_SQL, (1,)),
+    ("topups page", *repositories.topup_page_query(50)),
+    ("pending topups", *repositories.topup_page_query(50, status="pending")),
+    ("older topups", *repositories.topup_page_query(50, before_id=1000000)),
+    ("chat page", *repositories.conversation_query(1, 2, 51)),
+    ("older chat page", *repositories.conversation_query(1, 2, 51, before_id=1000000)),
+]
+# Hot queries that walk a table in primary key order and stop at their LIMIT (MySQL's
+# "index" access type, a plain SCAN to SQLite): query name -> tables (aliases) read so.
+# Every other full scan of a table fails the check, LIMIT or not.
+PK_ORDER_SCANS = {
+    "topups page": {"tr"},
+}
+
+# ALTER TABLE t ADD UNIQUE KEY k (cols) / CREATE UNIQUE INDEX k ON t (cols)
+_ADD_UNIQUE = re.compile(r"ALTER\s+TABLE\s+(\w+)\s+ADD\s+UNIQUE\s+(?:KEY|INDEX)\s+\w+\s*\(([^)]+)\)"
+                         r"|CREATE\s+UNIQUE\s+INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?\w+\s+ON\s+(\w+)\s*\(([^)]+)\)",
+                         re.IGNORECASE)
+
+_MIGRATION_FILE = re.compile(r"^(\d+)_([\w\-]+)\.sql$")
+
+
+def split_statements(sql):
+    """Split a migration file into statements (``--`` comments, ``;`` terminated)."""
+    lines = [l for l in sql.splitlines() if not l.strip().startswith("--")]
+    return [st.strip() for st in "\n".join(lines).split(";") if st.strip()]
+
+
+class MigrationRunner:
+    def __init__(self, connection, directory=None, log=print, dialect=MYSQL):
+        # connection: callable returning a context manager that yields a DB connection
+        self._connection = connection
+        self.directory = directory or os.path.join(MIGRATIONS_DIR, dialect.migrations)
+        self._dialect = dialect
+        self._log = log
+
+    def discover(self):
+        """Return [(version, name, path)] sorted by version."""
+        found = []
+        for fname in os.listdir(self.directory):
+            m = _MIGRATION_FILE.match(fname)
+            if m:
+                found.append((int(m.group(1)), m.group(2), os.path.join(self.directory, fname)))
+        found.sort()
+        versions = [v for v, _, _ in found]
+        if len(versions) != len(set(versions)):
+            raise RuntimeError(f"duplicate migration version in {self.directory}")
+        return found
+
+    def applied_versions(self, cur):
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT NOT NULL PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("SELECT version FROM schema_migrations")
+        return {r['version'] for r in cur.fetchall()}
+
+    def pending(self):
+        with self._connection() as conn, conn.cursor() as cur:
+            done = self.applied_versions(cur)
+        return [m for m in self.discover() if m[0] not in done]
+
+    def run(self, dry_run=False):
+        """Apply pending migrations in order; returns the list of (version, name) handled."""
+        handled = []
+        with self._connection() as conn, conn.cursor() as cur:
+            done = self.applied_versions(cur)
+            for version, name, path in self.discover():
+                if version in done:
+                    continue
+                with open(path, encoding="utf-8") as f:
+                    statements = split_statements(f.read())
+                if dry_run:
+                    self._log(f"[migrate] would apply {version:04d}_{name}")
+                    for st in statements:
+                        self._log(f"    {st};")
+                else:
+                    for st in statements:
+                        try:
+                            cur.execute(st)
+                        except Exception as e:
+                            if self._dialect.already_applied(e):
+                                self._log(f"[migrate] {version:04d}_{name}: already present, skipped: {e}")
+                                continue
+                            if self._dialect.duplicate_key(e):
+                                raise RuntimeError(_duplicates_report(cur, st, f"{version:04d}_{name}", e)) from e
+                            raise
+                    cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                    self._log(f"[migrate] applied {version:04d}_{name}")
+                handled.append((version, name))
+        return handled
+
+
+def _duplicates_report(cur, statement, migration, exc):
+    """Why a unique key could not be added, with the values that are taken twice."""
+    lines = [f"migration {migration} cannot add a unique key: {exc}"]
+    m = _ADD_UNIQUE.search(statement)
+    if m:
+        table, cols = (m.group(1), m.group(2)) if m.group(1) else (m.group(3), m.group(4))
+        cur.execute(f"SELECT {cols}, COUNT(*) AS n FROM {table} GROUP BY {cols} "
+                    "HAVING COUNT(*) > 1 ORDER BY n DESC LIMIT 20")
+        lines.append(f"duplicate ({cols}) in {table}, merge or rename them and start again:")
+        lines += [f"    {row}" for row in cur.fetchall()]
+    return "\n".join(lines)
+
+
+def check_hot_queries(cur, queries=HOT_QUERIES, dialect=MYSQL, pk_order_scans=PK_ORDER_SCANS):
+    """EXPLAIN every hot query; return a list of problems (empty when all use an index).
+
+    A query fails when it reads a base table with a full scan, which is what happens
+    when an index is dropped or a query is changed so it can no longer use one; only
+    the scans listed in ``pk_order_scans`` are expected. On MySQL, check a database
+    with real row counts: for a nearly empty table the optimizer may prefer a scan.
+    """
+    problems = []
+    for name, sql, params in queries:
+        for table in dialect.full_scans(cur, sql, params):
+            if table not in pk_order_scans.get(name, ()):
+                problems.append(f"{name}: full scan of {table}")
+    return problems
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # the database the app is configured for (NETCAFE_DB_URL)
+    backend = make_backend(DB_URL, DB_CONFIG)
+    if "--check" in argv:
+        with backend.connection() as conn, conn.cursor() as cur:
+            problems = check_hot_queries(cur, dialect=backend.dialect)
+        for p in problems:
+            print(f"[migrate] {p}")
+        print("[migrate] hot queries OK" if not problems else "[migrate] hot query check FAILED")
+        return 1 if problems else 0
+
+    runner = MigrationRunner(backend.connection, dialect=backend.dialect)
+    handled = runner.run(dry_run="--dry-run" in argv)
+    if not handled:
+        print("[migrate] database is up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2 @@
+-- Thông báo cho user khi yêu cầu nạp tiền được duyệt
+ALTER TABLE topup_requests ADD COLUMN user_notified TINYINT(1) DEFAULT 0;
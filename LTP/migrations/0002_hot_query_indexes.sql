@@ -0,0 +1,16 @@
+-- Index cho các truy vấn chạy thường xuyên
+
+-- đăng nhập / tạo user: tìm theo username (và không cho trùng username)
+ALTER TABLE users ADD UNIQUE KEY uq_users_username (username);
+
+-- tìm admin, danh sách user
+ALTER TABLE users ADD KEY idx_users_role (role);
+
+-- lịch sử yêu cầu nạp tiền của 1 user
+ALTER TABLE topup_requests ADD KEY idx_topup_user_created (user_id, created_at);
+
+-- lọc yêu cầu theo trạng thái (pending / approved)
+ALTER TABLE topup_requests ADD KEY idx_topup_status (status);
+
+-- lịch sử chat giữa 2 người, phân trang theo id
+ALTER TABLE messages ADD KEY idx_messages_pair (from_user_id, to_user_id, id);
@@ -0,0 +1,5 @@
+-- Khoá idempotency do client gửi kèm mỗi tin nhắn (chống gửi trùng khi double-click / gửi lại)
+ALTER TABLE messages ADD COLUMN client_msg_id VARCHAR(64) DEFAULT NULL;
+
+-- mỗi người gửi chỉ lưu 1 tin cho mỗi khoá (NULL = tin cũ / không có khoá, không bị ràng buộc)
+ALTER TABLE messages ADD UNIQUE KEY uq_messages_client_msg (from_user_id, client_msg_id);
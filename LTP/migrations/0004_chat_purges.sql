@@ -0,0 +1,15 @@
+-- Xoá chat khi logout chạy nền: logout chỉ ghi 1 yêu cầu, janitor xoá dần theo lô
+CREATE TABLE IF NOT EXISTS chat_purges (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    -- chỉ xoá tin có id <= upto_id (tin của phiên đăng nhập sau được giữ lại)
+    upto_id INT NOT NULL,
+    requested_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP NULL DEFAULT NULL,
+    deleted INT NOT NULL DEFAULT 0,
+    archive_path VARCHAR(255) DEFAULT NULL,
+    KEY idx_chat_purges_pending (finished_at, id)
+);
+
+-- tin gửi tới 1 user, theo id (phía "to" của cuộc trò chuyện khi dọn chat)
+ALTER TABLE messages ADD KEY idx_messages_to (to_user_id, id);
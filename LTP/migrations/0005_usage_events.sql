@@ -0,0 +1,27 @@
+-- Sổ cái sử dụng (chỉ ghi thêm): mọi thay đổi số dư là 1 sự kiện, số tiền tính bằng đồng (số nguyên)
+CREATE TABLE IF NOT EXISTS usage_events (
+    id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    -- opening / start / usage / stop / topup
+    kind VARCHAR(16) NOT NULL,
+    -- đồng, âm khi trừ tiền giờ chơi
+    amount BIGINT NOT NULL,
+    balance_after BIGINT NOT NULL,
+    -- số giây đã tính tiền (usage / stop)
+    seconds INT NOT NULL DEFAULT 0,
+    -- id yêu cầu nạp tiền (topup được duyệt)
+    ref_id INT DEFAULT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_usage_user (user_id, id),
+    KEY idx_usage_created (created_at)
+);
+
+-- số dư hiện có trở thành sự kiện mở sổ, để SUM(amount) của mỗi user = users.balance
+-- (MySQL không rollback được DDL: nếu migration lỗi giữa chừng và chạy lại thì không mở sổ 2 lần)
+UPDATE users SET balance = 0 WHERE balance IS NULL;
+INSERT INTO usage_events (user_id, kind, amount, balance_after)
+    SELECT u.id, 'opening', ROUND(u.balance), ROUND(u.balance) FROM users u
+    WHERE NOT EXISTS (SELECT 1 FROM usage_events e WHERE e.user_id = u.id AND e.kind = 'opening');
+
+-- users.balance là số dư tổng hợp từ usage_events, tính bằng đồng
+ALTER TABLE users MODIFY balance BIGINT NOT NULL DEFAULT 0;
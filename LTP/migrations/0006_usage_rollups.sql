@@ -0,0 +1,14 @@
+-- Báo cáo tổng hợp theo giờ / ngày, cập nhật dần theo sổ cái sử dụng (xem reports.py)
+CREATE TABLE IF NOT EXISTS usage_rollups (
+    -- 'hour' hoặc 'day'
+    period VARCHAR(8) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    seat_seconds BIGINT NOT NULL DEFAULT 0,
+    -- tiền giờ chơi đã trừ (đồng)
+    revenue BIGINT NOT NULL DEFAULT 0,
+    topups INT NOT NULL DEFAULT 0,
+    topup_amount BIGINT NOT NULL DEFAULT 0,
+    -- số máy chơi cùng lúc cao nhất
+    peak_seats INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, bucket_start)
+);
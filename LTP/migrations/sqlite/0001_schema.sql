@@ -0,0 +1,82 @@
+-- Toàn bộ lược đồ cho SQLite (tương đương netcafe.sql + các migration MySQL 0001-0006)
+-- Thời gian lưu theo giờ địa phương, đến từng giây như TIMESTAMP của MySQL
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    -- không phân biệt hoa thường khi đăng nhập, như collation utf8mb4_general_ci
+    username VARCHAR(50) COLLATE NOCASE UNIQUE,
+    password VARCHAR(50),
+    role VARCHAR(10),
+    -- đồng, tổng hợp từ usage_events
+    balance BIGINT NOT NULL DEFAULT 0,
+    is_online TINYINT DEFAULT 0,
+    last_active TIMESTAMP NULL DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_role ON users (role);
+
+CREATE TABLE IF NOT EXISTS topup_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INT,
+    amount INT,
+    status VARCHAR(20) DEFAULT 'pending',
+    user_notified TINYINT DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_topup_user_created ON topup_requests (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_topup_status ON topup_requests (status);
+
+-- id do ứng dụng cấp (IdAllocator), không tự tăng
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    from_user_id INT,
+    to_user_id INT,
+    content TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    client_msg_id VARCHAR(64) DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages (from_user_id, to_user_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_to ON messages (to_user_id, id);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_client_msg ON messages (from_user_id, client_msg_id);
+
+CREATE TABLE IF NOT EXISTS chat_purges (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INT NOT NULL,
+    upto_id INT NOT NULL,
+    requested_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+    finished_at TIMESTAMP NULL DEFAULT NULL,
+    deleted INT NOT NULL DEFAULT 0,
+    archive_path VARCHAR(255) DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_purges_pending ON chat_purges (finished_at, id);
+
+CREATE TABLE IF NOT EXISTS usage_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INT NOT NULL,
+    kind VARCHAR(16) NOT NULL,
+    amount BIGINT NOT NULL,
+    balance_after BIGINT NOT NULL,
+    seconds INT NOT NULL DEFAULT 0,
+    ref_id INT DEFAULT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_usage_user ON usage_events (user_id, id);
+CREATE INDEX IF NOT EXISTS idx_usage_created ON usage_events (created_at);
+
+CREATE TABLE IF NOT EXISTS usage_rollups (
+    period VARCHAR(8) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    seat_seconds BIGINT NOT NULL DEFAULT 0,
+    revenue BIGINT NOT NULL DEFAULT 0,
+    topups INT NOT NULL DEFAULT 0,
+    topup_amount BIGINT NOT NULL DEFAULT 0,
+    peak_seats INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, bucket_start)
+);
+
+-- tài khoản mặc định như netcafe.sql (mật khẩu 123456), số dư mở sổ qua usage_events
+INSERT INTO users (id, username, password, role, balance, is_online) VALUES
+    (1, 'admin', '123456', 'admin', 0, 0),
+    (2, 'user', '123456', 'user', 60000, 0);
+INSERT INTO usage_events (user_id, kind, amount, balance_after) VALUES
+    (1, 'opening', 0, 0),
+    (2, 'opening', 60000, 60000);
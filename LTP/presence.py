@@ -0,0 +1,113 @@
+class PresenceRegistry:
+    """Which sockets belong to which user, indexed both ways in the shared store.
+
+    sid -> user and user -> sids are kept side by side, so connecting, disconnecting
+    and noticing that a user's last socket is gone each cost a constant number of
+    store operations instead of a scan over every online user.
+
+    Keys:
+        <prefix>:sid_user           hash  sid -> user id
+        <prefix>:user_sids:<uid>    set   socket ids of the user
+        <prefix>:online_users       set   user ids with at least one socket
+        <prefix>:admin_targets      hash  admin sid -> user id being chatted with
+        <prefix>:workers            set   worker ids that have had sockets
+        <prefix>:worker_sids:<w>    set   socket ids connected to worker w
+
+    A worker that crashes never sees its sockets disconnect; the billing leader calls
+    ``reap`` to forget the sockets of workers whose liveness lease ran out.
+
+    connect and disconnect read before they write, so both run under one store lock;
+    otherwise sockets of one user racing each other could leave online_users wrong.
+    """
+
+    def __init__(self, store, prefix="netcafe", worker_id="local"):
+        self._store = store
+        self.worker_id = worker_id
+        self.workers_key = f"{prefix}:workers"
+        self._worker_sids_prefix = f"{prefix}:worker_sids:"
+        self.sid_user_key = f"{prefix}:sid_user"
+        self.online_key = f"{prefix}:online_users"
+        self.admin_targets_key = f"{prefix}:admin_targets"
+        self._user_sids_prefix = f"{prefix}:user_sids:"
+        self._lock = store.lock(f"{prefix}:presence")
+
+    def _user_sids_key(self, user_id):
+        return f"{self._user_sids_prefix}{user_id}"
+
+    def _worker_sids_key(self, worker_id):
+        return f"{self._worker_sids_prefix}{worker_id}"
+
+    def connect(self, sid, user_id):
+        """Attach a socket to a user.
+
+        Returns (user_id, went_offline) for the user the socket belonged to before, if
+        it re-joined as someone else (went_offline: that was their last socket), or
+        (None, False).
+        """
+        left = (None, False)
+        with self._lock:
+            previous = self._store.hget(self.sid_user_key, sid)
+            if previous is not None and previous != str(user_id):
+                # the socket re-joined as someone else
+                left = (int(previous), self._detach(sid, previous))
+            self._store.hset(self.sid_user_key, sid, user_id)
+            self._store.sadd(self._worker_sids_key(self.worker_id), sid)
+            self._store.sadd(self.workers_key, self.worker_id)
+            self._store.sadd(self._user_sids_key(user_id), sid)
+            self._store.sadd(self.online_key, user_id)
+        return left
+
+    def disconnect(self, sid):
+        """Forget a socket; returns the user id if that was the user's last socket."""
+        with self._lock:
+            return self._forget(sid, self.worker_id)
+
+    def reap(self, is_alive):
+        """Forget the sockets of other workers for which ``is_alive(worker_id)`` is False.
+
+        Returns the user ids that have no socket left.
+        """
+        offline = []
+        for worker in self._store.smembers(self.workers_key):
+            if worker == self.worker_id or is_alive(worker):
+                continue
+            with self._lock:
+                for sid in self._store.smembers(self._worker_sids_key(worker)):
+                    uid = self._forget(sid, worker)
+                    if uid is not None:
+                        offline.append(uid)
+                self._store.srem(self.workers_key, worker)
+        return offline
+
+    def _forget(self, sid, worker):
+        self._store.hdel(self.admin_targets_key, sid)
+        self._store.srem(self._worker_sids_key(worker), sid)
+        uid = self._store.hget(self.sid_user_key, sid)
+        if uid is None:
+            return None
+        self._store.hdel(self.sid_user_key, sid)
+        return int(uid) if self._detach(sid, uid) else None
+
+    def _detach(self, sid, user_id):
+        key = self._user_sids_key(user_id)
+        self._store.srem(key, sid)
+        if self._store.scard(key):
+            return False
+        self._store.srem(self.online_key, user_id)
+        return True
+
+    def is_online(self, user_id):
+        return self._store.scard(self._user_sids_key(user_id)) > 0
+
+    def sids(self, user_id):
+        return self._store.smembers(self._user_sids_key(user_id))
+
+    def online_count(self):
+        return self._store.scard(self.online_key)
+
+    def set_admin_target(self, sid, user_id):
+        self._store.hset(self.admin_targets_key, sid, user_id)
+
+    def admin_target(self, sid):
+        tgt = self._store.hget(self.admin_targets_key, sid)
+        return int(tgt) if tgt is not None else None
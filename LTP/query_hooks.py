@@ -0,0 +1,82 @@
+import re
+import time
+
+_WS = re.compile(r"\s+")
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM = re.compile(r"%s|%\(\w+\)s")
+_PARAM_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_IN_LIST = re.compile(r"\bIN \(\?\+?\)", re.IGNORECASE)
+_ROW_LIST = re.compile(r"\bVALUES \(\?\+?\)(?:\s*,\s*\(\?\+?\))*", re.IGNORECASE)
+_CASE_LIST = re.compile(r"(?:WHEN \? THEN \? ?)+", re.IGNORECASE)
+
+# normalizing is a handful of regexes; the app only has a few dozen distinct
+# statements, so remember the result per statement text
+_SHAPE_CACHE_SIZE = 2048
+_shape_cache = {}
+
+
+def query_shape(sql):
+    """Statement with literals and placeholders folded, so every call of the same
+    query maps to one key whatever its arguments or IN-list length.
+
+    ``WHERE id IN (%s, %s, %s)`` -> ``WHERE id IN (?+)``; multi-row VALUES lists and
+    ``CASE id WHEN .. THEN ..`` chains are folded the same way.
+    """
+    shape = _shape_cache.get(sql)
+    if shape is not None:
+        return shape
+    shape = _WS.sub(" ", sql).strip()
+    shape = _STRING.sub("?", shape)
+    shape = _PARAM.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = _PARAM_LIST.sub("?+", shape)
+    shape = _IN_LIST.sub("IN (?+)", shape)
+    shape = _ROW_LIST.sub("VALUES (?+)+", shape)
+    shape = _CASE_LIST.sub("WHEN ? THEN ? ... ", shape)
+    if len(_shape_cache) >= _SHAPE_CACHE_SIZE:
+        _shape_cache.clear()
+    _shape_cache[sql] = shape
+    return shape
+
+
+class QueryHooks:
+    """Callbacks run after every statement executed through a hooked cursor.
+
+    Each hook is called as ``hook(shape, seconds, rows)``: the normalized statement,
+    how long ``execute`` took and ``cursor.rowcount`` (rows returned for a SELECT,
+    rows affected otherwise). A failing hook is reported and otherwise ignored; it
+    must never break the query it observed.
+    """
+
+    def __init__(self):
+        self._hooks = []
+
+    def add(self, hook):
+        self._hooks.append(hook)
+        return hook
+
+    def cursor_class(self, base):
+        """Subclass of a DB-API cursor class (e.g. pymysql's DictCursor) that reports to the hooks."""
+        hooks = self
+
+        class HookedCursor(base):
+            def execute(self, query, args=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, args)
+                finally:
+                    hooks.fire(query, time.perf_counter() - started, self.rowcount)
+
+        HookedCursor.__name__ = "Hooked" + base.__name__
+        return HookedCursor
+
+    def fire(self, sql, seconds, rows):
+        if not self._hooks:
+            return
+        shape = query_shape(sql)
+        for hook in self._hooks:
+            try:
+                hook(shape, seconds, rows)
+            except Exception as e:
+                print('[db] query hook failed', e)
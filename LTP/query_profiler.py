@@ -0,0 +1,100 @@
+import json
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+
+# profile of the HTTP request / socket event running in this (green) thread
+_current = ContextVar('netcafe_query_profile', default=None)
+
+
+class QueryProfiler:
+    """Per-request breakdown of the queries an HTTP request or socket event ran.
+
+    ``begin(label)`` starts a profile for the current request, ``record`` (a
+    QueryHooks hook) adds every statement to it and ``end()`` closes it and returns
+    the summary: queries per normalized shape with count, time and rows, plus the
+    shapes run ``n_plus_one_threshold`` or more times in the same request (usually a
+    query issued in a loop). The last ``keep`` profiles are kept for the admin page.
+
+    Any statement slower than ``slow_query_seconds`` is appended to ``slow_log_path``
+    as one JSON line, whether or not a request is being profiled.
+    """
+
+    def __init__(self, slow_query_seconds=0.1, n_plus_one_threshold=3, slow_log_path=None, keep=50):
+        self.slow_query_seconds = slow_query_seconds
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.slow_log_path = slow_log_path
+        self._recent = deque(maxlen=keep)
+        self._stats = {'profiles': 0, 'queries': 0, 'slow_queries': 0, 'n_plus_one': 0}
+
+    def begin(self, label):
+        return _current.set({'label': label, 'started': time.perf_counter(), 'queries': []})
+
+    def end(self, token=None):
+        """Close the current profile and return its summary (None if none was running)."""
+        profile = _current.get()
+        try:
+            _current.reset(token)
+        except (TypeError, ValueError):
+            # no token, or it was created in another context
+            _current.set(None)
+        if profile is None:
+            return None
+        summary = self._summarize(profile)
+        self._recent.append(summary)
+        self._stats['profiles'] += 1
+        if summary['n_plus_one']:
+            self._stats['n_plus_one'] += 1
+        return summary
+
+    def record(self, shape, seconds, rows):
+        self._stats['queries'] += 1
+        profile = _current.get()
+        if profile is not None:
+            profile['queries'].append((shape, seconds, rows))
+        if seconds >= self.slow_query_seconds:
+            self._stats['slow_queries'] += 1
+            self._log_slow(profile['label'] if profile else None, shape, seconds, rows)
+
+    def recent(self, n_plus_one_only=False):
+        """Latest profiles, newest first."""
+        return [p for p in reversed(self._recent) if p['n_plus_one'] or not n_plus_one_only]
+
+    def stats(self):
+        return dict(self._stats, kept=len(self._recent))
+
+    def _summarize(self, profile):
+        shapes = {}
+        for shape, seconds, rows in profile['queries']:
+            s = shapes.get(shape)
+            if s is None:
+                s = shapes[shape] = {'shape': shape, 'count': 0, 'ms': 0.0, 'rows': 0}
+            s['count'] += 1
+            s['ms'] += seconds * 1000
+            s['rows'] += max(rows or 0, 0)
+        by_time = sorted(shapes.values(), key=lambda s: s['ms'], reverse=True)
+        for s in by_time:
+            s['ms'] = round(s['ms'], 3)
+        return {
+            'label': profile['label'],
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'total_ms': round((time.perf_counter() - profile['started']) * 1000, 3),
+            'queries': len(profile['queries']),
+            'db_ms': round(sum(q[1] for q in profile['queries']) * 1000, 3),
+            'shapes': by_time,
+            'n_plus_one': [s['shape'] for s in by_time if s['count'] >= self.n_plus_one_threshold],
+        }
+
+    def _log_slow(self, label, shape, seconds, rows):
+        if not self.slow_log_path:
+            print(f"[db] slow query {seconds * 1000:.1f} ms ({label or 'background'}): {shape}")
+            return
+        entry = {'at': datetime.now().isoformat(timespec='seconds'), 'request': label,
+                 'ms': round(seconds * 1000, 3), 'rows': rows, 'shape': shape}
+        try:
+            with open(self.slow_log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False))
+                f.write("\n")
+        except OSError as e:
+            print('[db] writing slow query log failed', e)
@@ -0,0 +1,231 @@
+"""Hourly and daily usage / revenue rollups for admin reports.
+
+``usage_rollups`` holds one row per hour and one per day: seat-seconds used, revenue
+(đồng charged for play time), topups (count and amount) and the peak number of
+seats in session at once. The rows are kept up to date as usage events are
+recorded (``UsageRollups.apply`` runs inside UsageLedger.record's transaction), so
+a report over a range reads one row per bucket instead of scanning the raw tables.
+
+The rollups can be rebuilt from ``usage_events`` at any time:
+
+    python reports.py --backfill                     # everything
+    python reports.py --backfill --since 2024-06-01  # only buckets from that day on
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from config import DB_CONFIG, DB_URL
+from storage import MYSQL, make_backend
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+PERIODS = {'hour': HOUR, 'day': DAY}
+COUNTERS = ('seat_seconds', 'revenue', 'topups', 'topup_amount')
+_COLUMNS = ('period', 'bucket_start') + COUNTERS + ('peak_seats',)
+
+
+def bucket_start(t, period):
+    t = t.replace(minute=0, second=0, microsecond=0)
+    return t.replace(hour=0) if period == 'day' else t
+
+
+def split_stretch(end, seconds, charge):
+    """Spread a billed stretch ending at ``end`` over the hours it covers.
+
+    Returns [(hour start, seconds, charge)]; the charge is split in proportion to
+    the seconds, with the rounding remainder on the last hour.
+    """
+    if seconds <= 0:
+        return [(bucket_start(end, 'hour'), 0, charge)]
+    t = end - timedelta(seconds=seconds)
+    pieces = []
+    left_seconds, left_charge = seconds, charge
+    while left_seconds > 0:
+        hour = bucket_start(t, 'hour')
+        sec = min(left_seconds, int((hour + HOUR - t).total_seconds()) or left_seconds)
+        part = left_charge if sec == left_seconds else charge * sec // seconds
+        pieces.append((hour, sec, part))
+        left_seconds -= sec
+        left_charge -= part
+        t = hour + HOUR
+    return pieces
+
+
+def _empty():
+    return {'seat_seconds': 0, 'revenue': 0, 'topups': 0, 'topup_amount': 0, 'peak_seats': 0}
+
+
+class UsageRollups:
+    def __init__(self, connection, dialect=MYSQL):
+        # connection: callable returning a context manager that yields a DB connection
+        self._connection = connection
+        self._dialect = dialect
+        # highest seat count already written per hour bucket, so sampling only writes new peaks
+        self._peak_written = {}
+        self._stats = {'upserts': 0, 'peak_writes': 0, 'backfills': 0}
+
+    # ----------------------------
+    # incremental maintenance
+    # ----------------------------
+    def apply(self, cur, events):
+        """Add usage events (UsageLedger.event dicts) to the hourly and daily rows."""
+        deltas = {}
+        for e in events:
+            self._add(deltas, e)
+        self._upsert(cur, deltas)
+
+    def note_seats(self, seats, at=None):
+        """Record the current number of seats in session; only writes when it is a new peak."""
+        at = at or datetime.now()
+        hour = bucket_start(at, 'hour')
+        if seats <= self._peak_written.get(hour, 0):
+            return
+        if len(self._peak_written) > 48:
+            self._peak_written = {h: n for h, n in self._peak_written.items() if h >= hour - DAY}
+        deltas = {(period, bucket_start(at, period)): dict(_empty(), peak_seats=seats) for period in PERIODS}
+        with self._connection() as conn, conn.cursor() as cur:
+            self._upsert(cur, deltas)
+        self._peak_written[hour] = seats
+        self._stats['peak_writes'] += 1
+
+    def _upsert(self, cur, deltas):
+        if not deltas:
+            return
+        rows = [(period, start, d['seat_seconds'], d['revenue'], d['topups'], d['topup_amount'], d['peak_seats'])
+                for (period, start), d in sorted(deltas.items())]
+        cur.execute(self._dialect.upsert("usage_rollups", _COLUMNS, ('period', 'bucket_start'), len(rows),
+                                         add=COUNTERS, greatest=('peak_seats',)),
+                    [v for r in rows for v in r])
+        self._stats['upserts'] += 1
+
+    # ----------------------------
+    # queries
+    # ----------------------------
+    def range(self, period, start, end):
+        """Buckets in [start, end) (missing ones as zeros) and their totals; one row read per bucket."""
+        step = PERIODS[period]
+        first = bucket_start(start, period)
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT bucket_start, seat_seconds, revenue, topups, topup_amount, peak_seats "
+                        "FROM usage_rollups WHERE period=%s AND bucket_start >= %s AND bucket_start < %s "
+                        "ORDER BY bucket_start", (period, first, end))
+            stored = {r['bucket_start']: r for r in cur.fetchall()}
+        buckets = []
+        totals = _empty()
+        t = first
+        while t < end:
+            r = stored.get(t)
+            b = {k: int(r[k]) for k in _empty()} if r else _empty()
+            for k in COUNTERS:
+                totals[k] += b[k]
+            totals['peak_seats'] = max(totals['peak_seats'], b['peak_seats'])
+            b['seat_hours'] = round(b['seat_seconds'] / 3600, 2)
+            b['start'] = t.isoformat(timespec='minutes')
+            buckets.append(b)
+            t += step
+        totals['seat_hours'] = round(totals['seat_seconds'] / 3600, 2)
+        return {'period': period, 'buckets': buckets, 'totals': totals}
+
+    def stats(self):
+        return dict(self._stats)
+
+    # ----------------------------
+    # rebuild from raw history
+    # ----------------------------
+    def backfill(self, since=None, page_size=5000, log=print):
+        """Recompute the rollups from usage_events; only buckets from ``since`` (a day) on are replaced.
+
+        Every event is read (in id pages) so that the seats in session at ``since``
+        are known; peaks are replayed from start/stop events.
+        """
+        since = bucket_start(since, 'day') if since else None
+        deltas = {}
+        open_seats = set()
+        last_hour = None
+        last_id = 0
+        scanned = 0
+        while True:
+            with self._connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT id, user_id, kind, amount, seconds, created_at FROM usage_events "
+                            "WHERE id > %s ORDER BY id LIMIT %s", (last_id, page_size))
+                page = cur.fetchall()
+            if not page:
+                break
+            last_id = page[-1]['id']
+            scanned += len(page)
+            for e in page:
+                hour = bucket_start(e['created_at'], 'hour')
+                if since is not None and last_hour is not None and last_hour < since - HOUR:
+                    # buckets before since are not rewritten
+                    last_hour = since - HOUR
+                # hours without events still had the seats that were open through them
+                while open_seats and last_hour is not None and last_hour + HOUR < hour:
+                    last_hour += HOUR
+                    self._peak(deltas, last_hour, len(open_seats))
+                last_hour = hour
+                before = len(open_seats)
+                if e['kind'] == 'start':
+                    open_seats.add(e['user_id'])
+                elif e['kind'] == 'stop':
+                    open_seats.discard(e['user_id'])
+                if since is not None and e['created_at'] < since:
+                    continue
+                self._peak(deltas, hour, max(before, len(open_seats)))
+                self._add(deltas, {'kind': e['kind'], 'amount': int(e['amount']), 'seconds': int(e['seconds']),
+                                   'created_at': e['created_at']})
+        replace = {k: v for k, v in deltas.items() if since is None or k[1] >= since}
+        with self._connection() as conn:
+            conn.begin()
+            try:
+                with conn.cursor() as cur:
+                    if since is None:
+                        cur.execute("DELETE FROM usage_rollups")
+                    else:
+                        cur.execute("DELETE FROM usage_rollups WHERE bucket_start >= %s", (since,))
+                    self._upsert(cur, replace)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self._peak_written = {}
+        self._stats['backfills'] += 1
+        log(f"[reports] backfilled {len(replace)} buckets from {scanned} events")
+        return len(replace)
+
+    def _peak(self, deltas, hour, seats):
+        for period in PERIODS:
+            d = deltas.setdefault((period, bucket_start(hour, period)), _empty())
+            d['peak_seats'] = max(d['peak_seats'], seats)
+
+    def _add(self, deltas, e):
+        if e['kind'] in ('usage', 'stop'):
+            for hour, sec, charge in split_stretch(e['created_at'], e['seconds'], -e['amount']):
+                for period in PERIODS:
+                    d = deltas.setdefault((period, bucket_start(hour, period)), _empty())
+                    d['seat_seconds'] += sec
+                    d['revenue'] += charge
+        elif e['kind'] == 'topup':
+            for period in PERIODS:
+                d = deltas.setdefault((period, bucket_start(e['created_at'], period)), _empty())
+                d['topups'] += 1
+                d['topup_amount'] += e['amount']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the usage / revenue rollups.")
+    parser.add_argument("--backfill", action="store_true", help="rebuild the rollups from usage_events")
+    parser.add_argument("--since", type=lambda s: datetime.strptime(s, "%Y-%m-%d"),
+                        help="only rebuild buckets from this day (YYYY-MM-DD) on")
+    args = parser.parse_args(argv)
+    if not args.backfill:
+        parser.print_help()
+        return 1
+    # the database the app is configured for (NETCAFE_DB_URL)
+    backend = make_backend(DB_URL, DB_CONFIG)
+    UsageRollups(backend.connection, dialect=backend.dialect).backfill(since=args.since)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
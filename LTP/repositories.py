@@ -0,0 +1,219 @@
+"""The SQL behind the routes and socket handlers, grouped by what it reads and writes.
+
+Every repository takes ``connection`` (a callable returning a context manager that
+yields a DB connection) and checks one out per call, like the other DB classes.
+The statements run unchanged on both backends in storage.py. The ones on hot paths
+are module constants or built by ``*_query`` functions, so migrate.py EXPLAINs
+exactly what runs here.
+"""
+
+LOGIN_SQL = "SELECT * FROM users WHERE username=%s AND password=%s"
+USER_LIST_SQL = "SELECT id, username, balance, is_online FROM users WHERE role=%s"
+USER_TOPUPS_SQL = "SELECT * FROM topup_requests WHERE user_id=%s ORDER BY created_at DESC"
+
+
+def topup_page_query(limit, status=None, before_id=None, since=None, until=None):
+    """(sql, params) of one page of TopupRepository.page (limit + 1 rows)."""
+    where = []
+    params = []
+    if status:
+        where.append("tr.status=%s")
+        params.append(status)
+    if before_id:
+        where.append("tr.id < %s")
+        params.append(before_id)
+    if since:
+        where.append("tr.created_at >= %s")
+        params.append(since)
+    if until:
+        where.append("tr.created_at < %s")
+        params.append(until)
+    sql = ("SELECT tr.id, tr.user_id, tr.amount, tr.status, tr.created_at, u.username "
+           "FROM topup_requests tr JOIN users u ON tr.user_id = u.id")
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY tr.id DESC LIMIT %s"
+    params.append(limit + 1)
+    return sql, params
+
+
+def conversation_query(a, b, limit, before_id=None):
+    """(sql, params) of MessageRepository.latest.
+
+    Each direction of the conversation is a range scan on the
+    (from_user_id, to_user_id, id) index limited to one page, so the cost depends on
+    the page size and not on how many messages the table holds.
+    """
+    cond = " AND id < %s" if before_id else ""
+    branch = ("SELECT id FROM (SELECT id FROM messages WHERE from_user_id=%s AND to_user_id=%s"
+              f"{cond} ORDER BY id DESC LIMIT %s) {{alias}}")
+    params = []
+    for x, y in ((a, b), (b, a)):
+        params.extend([x, y] + ([before_id] if before_id else []) + [limit])
+    params.append(limit)
+    sql = ("SELECT m.id, m.from_user_id, m.to_user_id, m.content, m.created_at, "
+           "u.username AS sender_name, u.role AS sender_role "
+           f"FROM ({branch.format(alias='f')} UNION ALL {branch.format(alias='t')}) page "
+           "JOIN messages m ON m.id = page.id "
+           "LEFT JOIN users u ON u.id = m.from_user_id "
+           "ORDER BY m.id DESC LIMIT %s")
+    return sql, params
+
+
+class UserRepository:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def authenticate(self, username, password):
+        """The user row for these credentials, or None."""
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(LOGIN_SQL, (username, password))
+            return cur.fetchone()
+
+    def get(self, user_id):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT * FROM users WHERE id=%s", (user_id,))
+            return cur.fetchone()
+
+    def balance(self, user_id):
+        """Stored balance (as of the user's latest usage event); None for an unknown user."""
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT balance FROM users WHERE id=%s", (user_id,))
+            row = cur.fetchone()
+        return row['balance'] if row else None
+
+    def list(self, role='user'):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(USER_LIST_SQL, (role,))
+            return cur.fetchall()
+
+    def create(self, username, password):
+        """Add an offline user with no balance; returns its id, or None if the username is taken."""
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id FROM users WHERE username=%s", (username,))
+            if cur.fetchone():
+                return None
+            cur.execute("INSERT INTO users (username, password, role, balance, is_online, last_active) "
+                        "VALUES (%s, %s, 'user', 0, 0, NULL)", (username, password))
+            return cur.lastrowid
+
+    def mark_online(self, user_id, at):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("UPDATE users SET is_online=1, last_active=%s WHERE id=%s", (at, user_id))
+
+
+class SessionRepository:
+    """What is persisted of running sessions: users.is_online / last_active.
+
+    Balances are not written here, they only change through usage events
+    (usage.UsageLedger).
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def checkpoint(self, user_ids, at):
+        """Mark users online with ``last_active`` = at, in one UPDATE."""
+        if not user_ids:
+            return
+        placeholders = ", ".join(["%s"] * len(user_ids))
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(f"UPDATE users SET last_active=%s, is_online=1 WHERE id IN ({placeholders})",
+                        [at] + list(user_ids))
+
+    def close(self, ended, others=()):
+        """Mark users offline: ``ended`` maps user ids to when their session ended (their
+        last_active), ``others`` had no running session."""
+        with self._connection() as conn, conn.cursor() as cur:
+            if ended:
+                cases = " ".join(["WHEN %s THEN %s"] * len(ended))
+                placeholders = ", ".join(["%s"] * len(ended))
+                params = []
+                for uid, t in ended.items():
+                    params.extend((uid, t))
+                params.extend(ended)
+                cur.execute(f"UPDATE users SET last_active = CASE id {cases} END, is_online=0 "
+                            f"WHERE id IN ({placeholders})", params)
+            if others:
+                placeholders = ", ".join(["%s"] * len(others))
+                cur.execute(f"UPDATE users SET is_online=0 WHERE id IN ({placeholders})", list(others))
+
+    def running(self):
+        """Users still marked online (sessions to resume after a restart).
+
+        Rows have id, balance, last_active (the last checkpoint) and ``since``: the
+        time of the user's latest usage event, from which the session was billed.
+        """
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id, balance, last_active FROM users WHERE role='user' AND is_online=1")
+            rows = cur.fetchall()
+            if not rows:
+                return []
+            placeholders = ", ".join(["%s"] * len(rows))
+            cur.execute("SELECT e.user_id, e.created_at FROM usage_events e JOIN "
+                        f"(SELECT MAX(id) AS id FROM usage_events WHERE user_id IN ({placeholders}) "
+                        "GROUP BY user_id) latest ON latest.id = e.id", [r['id'] for r in rows])
+            since = {r['user_id']: r['created_at'] for r in cur.fetchall()}
+        for r in rows:
+            r['since'] = since.get(r['id'])
+        return rows
+
+
+class TopupRepository:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def create(self, user_id, amount):
+        """Store a pending request; returns it as the admin list shows it (with username)."""
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("INSERT INTO topup_requests (user_id, amount, status, user_notified) "
+                        "VALUES (%s, %s, 'pending', 0)", (user_id, amount))
+            cur.execute("SELECT tr.id, tr.user_id, tr.amount, tr.status, tr.created_at, u.username "
+                        "FROM topup_requests tr JOIN users u ON tr.user_id=u.id WHERE tr.id=%s", (cur.lastrowid,))
+            return cur.fetchone()
+
+    def for_user(self, user_id):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(USER_TOPUPS_SQL, (user_id,))
+            return cur.fetchall()
+
+    def page(self, limit, status=None, before_id=None, since=None, until=None):
+        """Return (requests, has_more): newest topup requests first, keyset-paginated by id."""
+        sql, params = topup_page_query(limit, status, before_id, since, until)
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        return rows[:limit], len(rows) > limit
+
+    def approve(self, req_id):
+        """Approve a pending request; returns it, or None if it is unknown or was not pending.
+
+        Only the first approval of a request succeeds, so only one caller credits the user.
+        """
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT * FROM topup_requests WHERE id=%s", (req_id,))
+            req = cur.fetchone()
+            if not req or req["status"] != "pending":
+                return None
+            # user_notified=0 so the user is notified on the next dashboard load
+            cur.execute("UPDATE topup_requests SET status='approved', user_notified=0 WHERE id=%s AND status='pending'",
+                        (req_id,))
+            return req if cur.rowcount == 1 else None
+
+
+class MessageRepository:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def max_id(self):
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM messages")
+            return cur.fetchone()['max_id']
+
+    def latest(self, a, b, limit, before_id=None):
+        """The newest ``limit`` stored messages between a and b older than before_id, newest first
+        (see conversation_query)."""
+        sql, params = conversation_query(a, b, limit, before_id)
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
@@ -0,0 +1,50 @@
+class SeatGrid:
+    """The admins' view of the running seats, kept up to date with one delta frame per tick.
+
+    A running session only changes when it starts, is topped up or stops, and in
+    between it is fully described by the time its balance runs out. Admin pages
+    count every seat down from that deadline themselves (balance = time left x
+    rate), so ``delta`` diffs the current deadlines against the ones in the last
+    frame and lists only the seats that started or changed, plus the ones that
+    stopped. A frame's size follows the number of changes, not the number of seats,
+    and a tick where nothing changed sends nothing.
+
+    Frames: ``{'server_time': ms, 'seats': [[user_id, expires_at ms], ...],
+    'stopped': [user_id, ...], 'full': bool}``. A ``full`` frame lists every running
+    seat and replaces whatever the page had (sent to an admin socket on join).
+    """
+
+    def __init__(self):
+        # user_id -> expires_at (epoch ms) as of the last delta
+        self._deadlines = {}
+        self._counters = {'ticks': 0, 'frames': 0, 'seats_sent': 0, 'stopped_sent': 0, 'full_frames': 0}
+
+    def delta(self, deadlines, now):
+        """Frame for the seats that changed since the previous delta, or None.
+
+        ``deadlines`` is [(user_id, expires_at)] of every running session (epoch seconds).
+        """
+        current = {uid: _ms(t) for uid, t in deadlines}
+        previous, self._deadlines = self._deadlines, current
+        self._counters['ticks'] += 1
+        seats = [[uid, t] for uid, t in current.items() if previous.get(uid, -1) != t]
+        stopped = [uid for uid in previous if uid not in current]
+        if not seats and not stopped:
+            return None
+        self._counters['frames'] += 1
+        self._counters['seats_sent'] += len(seats)
+        self._counters['stopped_sent'] += len(stopped)
+        return {'server_time': _ms(now), 'seats': seats, 'stopped': stopped, 'full': False}
+
+    def full(self, deadlines, now):
+        """Frame with every running seat, for a page that (re)joined."""
+        self._counters['full_frames'] += 1
+        return {'server_time': _ms(now), 'seats': [[uid, _ms(t)] for uid, t in deadlines], 'stopped': [],
+                'full': True}
+
+    def stats(self):
+        return dict(self._counters, seats=len(self._deadlines))
+
+
+def _ms(t):
+    return int(round(t * 1000)) if t is not None else None
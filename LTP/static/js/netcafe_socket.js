@@ -0,0 +1,67 @@
+// Socket.IO client shared by all pages.
+// The server may coalesce several events for the same recipients into one
+// "batch" frame of [event, payload] pairs; unpack it and dispatch each pair to
+// the handlers registered with socket.on(event, ...).
+//
+// Pages join with {wire: socket.wire}. That is 'json' unless the server enabled the
+// compact wire format (NETCAFE_COMPACT_WIRE, set as window.NETCAFE_WIRE by base.html):
+// then the frequent events arrive as positional arrays (see wire.py) and are decoded
+// here back into the objects the handlers expect. Keep these field lists in sync with wire.py.
+const NETCAFE_MESSAGE_FIELDS = ['id', 'from_user_id', 'to_user_id', 'content', 'created_at', 'sender_name', 'sender_role'];
+const NETCAFE_WIRE_FIELDS = {
+  time_update: ['user_id', 'balance', 'seconds_left', 'status', 'server_time'],
+  session_deadline: ['user_id', 'balance', 'expires_at', 'server_time', 'status', 'hourly_rate'],
+  seat_grid: ['server_time', 'seats', 'stopped', 'full'],
+  new_message: NETCAFE_MESSAGE_FIELDS
+};
+const NETCAFE_MESSAGE_LISTS = ['messages', 'older_messages'];
+
+function netcafeTime(epochSeconds){
+  // same "YYYY-MM-DD HH:MM:SS" local time the json format sends
+  const d = new Date(epochSeconds * 1000);
+  const pad = function(n){ return String(n).padStart(2, '0'); };
+  return d.getFullYear() + '-' + pad(d.getMonth() + 1) + '-' + pad(d.getDate()) + ' ' +
+    pad(d.getHours()) + ':' + pad(d.getMinutes()) + ':' + pad(d.getSeconds());
+}
+
+function netcafeRow(fields, values){
+  const obj = {};
+  fields.forEach(function(f, i){
+    if(values[i] !== null && values[i] !== undefined) obj[f] = values[i];
+  });
+  if(typeof obj.created_at === 'number') obj.created_at = netcafeTime(obj.created_at);
+  return obj;
+}
+
+function netcafeDecode(event, data){
+  if(!Array.isArray(data)) return data;
+  if(NETCAFE_WIRE_FIELDS[event]) return netcafeRow(NETCAFE_WIRE_FIELDS[event], data);
+  if(NETCAFE_MESSAGE_LISTS.indexOf(event) !== -1){
+    return {
+      messages: data[0].map(function(r){ return netcafeRow(NETCAFE_MESSAGE_FIELDS, r); }),
+      has_more: data[1],
+      other_id: data[2]
+    };
+  }
+  return data;
+}
+
+function netcafeSocket(){
+  const socket = io();
+  socket.wire = window.NETCAFE_WIRE || 'json';
+  // handlers receive decoded payloads whichever format the server sent
+  const on = socket.on.bind(socket);
+  socket.on = function(event, fn){
+    if(!NETCAFE_WIRE_FIELDS[event] && NETCAFE_MESSAGE_LISTS.indexOf(event) === -1) return on(event, fn);
+    return on(event, function(data){ fn(netcafeDecode(event, data)); });
+  };
+  socket.on('batch', function(frames){
+    (frames || []).forEach(function(frame){
+      const event = frame[0], payload = frame[1];
+      socket.listeners(event).forEach(function(fn){
+        try{ fn(payload); }catch(e){ console.error(e); }
+      });
+    });
+  });
+  return socket;
+}
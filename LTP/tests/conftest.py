@@ -0,0 +1,25 @@
+import os
+import sys
+
+# the app modules import each other by name from LTP/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# tests run against an SQLite database that lives in the test process, and on the
+# in-process stand-in for a shared store so the multi-worker code paths run too
+os.environ.setdefault("NETCAFE_DB_URL", "sqlite://")
+os.environ.setdefault("NETCAFE_SHARED_STORE_URL", "memory://")
+
+
+import pytest  # noqa: E402
+
+from migrate import MigrationRunner  # noqa: E402
+from storage import make_backend  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """A fresh in-memory SQLite database with every migration applied."""
+    backend = make_backend("sqlite://")
+    MigrationRunner(backend.connection, dialect=backend.dialect, log=lambda *a: None).run()
+    yield backend
+    backend.close()
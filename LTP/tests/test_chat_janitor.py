@@ -0,0 +1,64 @@
+"""Background chat purge after logout (user-015) on SQLite."""
+import gzip
+import json
+
+from chat_janitor import ChatJanitor
+
+USER, ADMIN, OTHER = 2, 1, 3
+
+
+def _messages(db, rows):
+    with db.connection() as conn, conn.cursor() as cur:
+        for row in rows:
+            cur.execute("INSERT INTO messages (id, from_user_id, to_user_id, content) VALUES (%s, %s, %s, %s)", row)
+
+
+def _ids(db):
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id FROM messages ORDER BY id")
+        return [r['id'] for r in cur.fetchall()]
+
+
+def _purges(db):
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT * FROM chat_purges ORDER BY id")
+        return cur.fetchall()
+
+
+def test_purge_removes_the_users_chat_up_to_upto_id_in_batches(db, tmp_path):
+    _messages(db, [(1, USER, ADMIN, "a"), (2, ADMIN, USER, "b"), (3, OTHER, ADMIN, "other"),
+                   (4, USER, ADMIN, "c"), (5, ADMIN, USER, "d"), (6, USER, ADMIN, "new session")])
+    janitor = ChatJanitor(db.connection, batch_size=2, archive_dir=str(tmp_path), sleep=lambda s: None)
+    janitor.request(USER, upto_id=5)
+
+    assert janitor.run_pending() == 1
+    # another user's chat and messages after the logout stay
+    assert _ids(db) == [3, 6]
+    [purge] = _purges(db)
+    assert purge['finished_at'] is not None and purge['deleted'] == 4
+    with gzip.open(purge['archive_path'], "rt", encoding="utf-8") as f:
+        archived = [json.loads(line) for line in f]
+    assert [(m['id'], m['content']) for m in archived] == [(1, "a"), (2, "b"), (4, "c"), (5, "d")]
+    stats = janitor.stats()
+    assert (stats['batches'], stats['deleted'], stats['archived']) == (2, 4, 4)
+    assert janitor.run_pending() == 0
+
+
+def test_queued_messages_are_written_before_the_purge(db):
+    janitor = ChatJanitor(db.connection, before_purge=lambda: _messages(db, [(1, USER, ADMIN, "queued")]),
+                          sleep=lambda s: None)
+    janitor.request(USER, upto_id=1)
+    janitor.run_pending()
+    assert _ids(db) == []
+
+
+def test_a_failed_purge_stays_pending(db, tmp_path):
+    _messages(db, [(1, USER, ADMIN, "a")])
+    blocked = tmp_path / "archive"
+    blocked.write_text("not a directory")
+    janitor = ChatJanitor(db.connection, archive_dir=str(blocked), sleep=lambda s: None)
+    janitor.request(USER, upto_id=1)
+
+    assert janitor.run_pending() == 0
+    assert janitor.stats()['failures'] == 1
+    assert _ids(db) == [1] and _purges(db)[0]['finished_at'] is None
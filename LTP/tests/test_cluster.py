@@ -0,0 +1,156 @@
+"""Several workers on one shared store (user-011), with MemoryStore standing in for Redis."""
+from cluster import Cluster, MemoryStore, SharedSessionTable
+from ledger import SessionLedger
+from presence import PresenceRegistry
+
+RATE = 5000 / 3600.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _worker(store, name, clock):
+    """A worker's cluster view and ledger, as app.py builds them for a shared store."""
+    ledger = SessionLedger(RATE, clock=clock, sessions=SharedSessionTable(store),
+                           lock=store.lock("netcafe:ledger"))
+    return Cluster(store, worker_id=name, lease_ttl=10.0, clock=clock), ledger
+
+
+def test_lease_moves_to_the_other_worker_when_the_leader_stops():
+    clock = Clock()
+    store = MemoryStore(clock=clock, shared=True)
+    (a, _), (b, _) = _worker(store, "a", clock), _worker(store, "b", clock)
+
+    assert a.heartbeat() == (True, True)
+    assert b.heartbeat() == (False, False)
+    # a keeps renewing: b never gets the lease
+    for _ in range(30):
+        clock.now += 1.0
+        a.heartbeat()
+        b.heartbeat()
+        assert a.is_leader() and not b.is_leader()
+
+    # a stops (crashed, or cut off from the store); b takes over once the lease ran
+    # out, and there is never a moment with two leaders
+    took_over = None
+    for _ in range(30):
+        clock.now += 0.5
+        b.heartbeat()
+        assert not (a.is_leader() and b.is_leader())
+        if b.is_leader() and took_over is None:
+            took_over = clock.now
+    assert took_over is not None
+    assert not a.is_leader()
+    assert b.elections == 1
+
+
+def test_resign_hands_over_immediately():
+    clock = Clock()
+    store = MemoryStore(clock=clock, shared=True)
+    (a, _), (b, _) = _worker(store, "a", clock), _worker(store, "b", clock)
+    a.heartbeat()
+    a.resign()
+    assert b.heartbeat(force=True) == (True, True)
+    assert not a.is_leader()
+
+
+def test_a_session_is_settled_once_whichever_worker_stops_it():
+    clock = Clock()
+    store = MemoryStore(clock=clock, shared=True)
+    (_, ledger_a), (_, ledger_b) = _worker(store, "a", clock), _worker(store, "b", clock)
+    table = SharedSessionTable(store)
+
+    ledger_a.start(7, 10000)
+    version = table.version()
+    clock.now += 360
+    # both workers see the same running session and balance
+    assert 7 in ledger_b
+    assert ledger_b.balance(7) == ledger_a.balance(7) == 10000 - 360 * RATE
+
+    # a topup on b rebases the session for everyone and bumps the version the
+    # billing leader watches
+    assert ledger_b.credit(7, 5000) == (15000 - 500, 360, 500)
+    assert table.version() > version
+
+    clock.now += 720
+    final, seconds, charge = ledger_a.stop(7)
+    assert (seconds, charge) == (720, 1000)
+    assert final == 15000 - 500 - 1000
+    # the other worker cannot charge it a second time
+    assert ledger_b.stop(7) is None
+    assert 7 not in ledger_a and 7 not in ledger_b
+
+
+def test_leader_reconciles_sessions_started_on_other_workers():
+    import app as netcafe
+
+    assert netcafe.session_table is not None
+    other = SessionLedger(netcafe.COST_PER_SECOND, sessions=SharedSessionTable(netcafe.store),
+                          lock=netcafe.store.lock("netcafe:ledger"))
+    other.start(9999, 5000)
+    try:
+        netcafe._reconcile_expiry()
+        assert 9999 in netcafe.expiry
+        assert netcafe.ledger.get(9999).expires_at() == other.get(9999).expires_at()
+    finally:
+        other.stop(9999)
+    netcafe._reconcile_expiry()
+    assert 9999 not in netcafe.expiry
+
+
+def test_presence_spans_workers():
+    store = MemoryStore(shared=True)
+    a, b = PresenceRegistry(store), PresenceRegistry(store)
+
+    assert a.connect("sid-a", 7) == (None, False)
+    assert b.connect("sid-b", 7) == (None, False)
+    assert a.online_count() == 1
+    # the last socket to go reports the user offline, whichever worker it was on
+    assert b.disconnect("sid-a") is None
+    assert a.disconnect("sid-b") == 7
+    assert not b.is_online(7) and b.online_count() == 0
+
+
+def test_the_sockets_of_a_stopped_worker_are_reaped():
+    clock = Clock()
+    store = MemoryStore(clock=clock, shared=True)
+    (a, _), (b, _) = _worker(store, "a", clock), _worker(store, "b", clock)
+    on_a = PresenceRegistry(store, worker_id="a")
+    on_b = PresenceRegistry(store, worker_id="b")
+    a.heartbeat()
+    b.heartbeat()
+    on_a.connect("sid-a", 7)
+    on_b.connect("sid-b", 7)
+    on_b.connect("sid-c", 8)
+
+    # b is still renewing its lease
+    clock.now += 5
+    b.heartbeat()
+    assert on_a.reap(a.is_alive) == []
+
+    # b is killed: its sockets never disconnect, and only go once its lease ran out
+    clock.now += b.lease_ttl * 2
+    a.heartbeat()
+    assert on_a.reap(a.is_alive) == []
+    clock.now += b.lease_ttl
+    a.heartbeat()
+    assert on_a.reap(a.is_alive) == [8]
+    assert on_a.is_online(7) and not on_a.is_online(8)
+    assert on_a.sids(7) == {"sid-a"}
+    assert on_a.reap(a.is_alive) == []
+
+
+def test_a_socket_rejoining_as_someone_else_leaves_the_first_user():
+    store = MemoryStore(shared=True)
+    a, b = PresenceRegistry(store, worker_id="a"), PresenceRegistry(store, worker_id="b")
+    a.connect("sid-a", 7)
+    b.connect("sid-b", 7)
+
+    assert a.connect("sid-a", 8) == (7, False)
+    assert b.connect("sid-b", 9) == (7, True)
+    assert not a.is_online(7) and a.online_count() == 2
@@ -0,0 +1,106 @@
+"""Connection pool checkout, health checks and eviction (user-001)."""
+import threading
+import time
+
+import pytest
+
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self, n):
+        self.n = n
+        self.open = True
+        self.alive = True
+        self.pings = 0
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if not self.alive:
+            raise ConnectionError("server has gone away")
+
+    def close(self):
+        self.open = False
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _pool(**kwargs):
+    made = []
+
+    def connect():
+        made.append(FakeConnection(len(made) + 1))
+        return made[-1]
+
+    return ConnectionPool(connect, **kwargs), made
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted():
+    pool, _ = _pool(max_size=1, checkout_timeout=0.1)
+    held = pool.acquire()
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert time.monotonic() - started >= 0.1
+    stats = pool.stats()
+    assert (stats['waits'], stats['timeouts'], stats['in_use']) == (1, 1, 1)
+    pool.release(held)
+    assert pool.acquire() is held
+
+
+def test_a_waiter_gets_the_connection_as_soon_as_it_is_released():
+    pool, made = _pool(max_size=1, checkout_timeout=5.0)
+    held = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append((pool.acquire(), time.monotonic())))
+    waiter.start()
+    time.sleep(0.05)
+    released = time.monotonic()
+    pool.release(held)
+    waiter.join(1.0)
+
+    [(conn, at)] = got
+    assert conn is held and len(made) == 1
+    assert at - released < 0.05
+
+
+def test_only_a_connection_idle_for_a_while_is_pinged_and_a_dead_one_replaced():
+    clock = Clock()
+    pool, made = _pool(ping_after=30.0, idle_timeout=0, clock=clock)
+    first = pool.acquire()
+    pool.release(first)
+
+    # reused right away: no round trip before the query
+    clock.now += 5
+    assert pool.acquire() is first and first.pings == 0
+    pool.release(first)
+
+    # idle for longer than ping_after, and the server closed it meanwhile
+    first.alive = False
+    clock.now += 60
+    second = pool.acquire()
+    assert second is made[1] and not first.open
+    stats = pool.stats()
+    assert (stats['health_checks'], stats['health_check_failures'], stats['open']) == (1, 1, 1)
+
+
+def test_idle_connections_are_evicted():
+    clock = Clock()
+    pool, made = _pool(idle_timeout=300, clock=clock)
+    a, b = pool.acquire(), pool.acquire()
+    pool.release(a)
+    clock.now += 200
+    pool.release(b)
+
+    clock.now += 150
+    # a has been idle for 350 s, b for 150 s
+    assert pool.acquire() is b
+    assert not a.open and b.open
+    stats = pool.stats()
+    assert (stats['evicted'], stats['open'], stats['idle']) == (1, 1, 0)
@@ -0,0 +1,55 @@
+"""In-memory billing sessions and their expiry (user-003, user-005)."""
+from expiry import ExpiryScheduler
+from ledger import SessionLedger
+
+RATE = 5000 / 3600.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_a_session_is_charged_by_the_second_and_stops_at_zero():
+    clock = Clock()
+    ledger = SessionLedger(RATE, clock=clock)
+    ledger.start(7, 5000)
+    assert ledger.get(7).expires_at() == 1000.0 + 3600
+
+    clock.now += 720
+    assert round(ledger.balance(7)) == 4000
+    assert ledger.get(7).seconds_left(clock.now) == 2880
+    # past the deadline: never below zero, and the charge is the whole balance
+    assert ledger.stop(7, now=clock.now + 7200) == (0, 7920, 5000)
+    assert 7 not in ledger and ledger.stop(7) is None
+
+
+def test_a_topup_settles_the_stretch_used_so_far():
+    clock = Clock()
+    ledger = SessionLedger(RATE, clock=clock)
+    ledger.start(7, 5000)
+    clock.now += 360
+
+    assert ledger.credit(7, 2000) == (6500, 360, 500)
+    assert ledger.get(7).expires_at() == clock.now + 6500 / RATE
+    clock.now += 36
+    assert ledger.stop(7) == (6450, 36, 50)
+    assert ledger.credit(7, 2000) is None
+
+
+def test_expiry_fires_each_key_once_at_its_latest_deadline():
+    expiry = ExpiryScheduler()
+    expiry.schedule(1, 10.0)
+    expiry.schedule(2, 20.0)
+    expiry.schedule(1, 30.0)
+    expiry.schedule(3, 15.0)
+    expiry.cancel(3)
+
+    assert expiry.next_deadline() == 20.0
+    assert expiry.pop_due(25.0) == [2]
+    assert expiry.pop_due(25.0) == []
+    assert expiry.pop_due(30.0) == [1]
+    assert len(expiry) == 0 and expiry.next_deadline() is None
@@ -0,0 +1,79 @@
+"""Group-commit chat writes (user-014) against an in-memory SQLite database."""
+import itertools
+import sqlite3
+from contextlib import contextmanager
+
+from message_writer import MessageWriter
+from storage import SQLITE
+
+
+def _writer(db, **kwargs):
+    ids = itertools.count(1)
+    return MessageWriter(db.connection, lambda: next(ids), dialect=SQLITE, **kwargs)
+
+
+def _stored(db):
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id, from_user_id, content FROM messages ORDER BY id")
+        return [(r['id'], r['from_user_id'], r['content']) for r in cur.fetchall()]
+
+
+def test_rows_are_written_in_batches(db):
+    writer = _writer(db, max_batch=2)
+    rows = [writer.submit(1, 2, f"m{i}", f"k{i}") for i in range(5)]
+
+    assert [r['id'] for r in rows] == [1, 2, 3, 4, 5]
+    assert writer.pending_between(2, 1)[0]['content'] == "m0"
+    assert writer.flush() == 5
+    assert _stored(db) == [(i + 1, 1, f"m{i}") for i in range(5)]
+    stats = writer.stats()
+    assert (stats['batches'], stats['pending']) == (3, 0)
+
+
+def test_a_stored_client_msg_id_is_skipped(db):
+    first = _writer(db)
+    first.submit(1, 2, "hi", "k1")
+    first.flush()
+    # a retry written by another worker after a restart, with a new id
+    again = MessageWriter(db.connection, iter([10, 11]).__next__, dialect=SQLITE)
+    again.submit(1, 2, "hi", "k1")
+    again.submit(1, 2, "next", "k2")
+
+    assert again.flush() == 1
+    assert _stored(db) == [(1, 1, "hi"), (11, 1, "next")]
+    assert again.stats()['duplicates'] == 1
+
+
+def test_a_row_the_database_rejects_is_set_aside(db):
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("INSERT INTO messages (id, from_user_id, to_user_id, content) VALUES (2, 9, 9, 'old')")
+    writer = _writer(db)
+    for i in range(3):
+        writer.submit(1, 2, f"m{i}", f"k{i}")
+
+    # id 2 is taken: that is not a duplicate message, and must not stop ids 1 and 3
+    assert writer.flush() == 2
+    assert _stored(db) == [(1, 1, "m0"), (2, 9, "old"), (3, 1, "m2")]
+    [(row, error)] = writer.dead_letters()
+    assert row['id'] == 2 and "UNIQUE" in error
+    assert writer.stats()['pending'] == 0
+
+
+def test_a_transient_error_keeps_the_rows_queued(db):
+    down = [True]
+
+    @contextmanager
+    def connection():
+        if down[0]:
+            raise sqlite3.OperationalError("database is locked")
+        with db.connection() as conn:
+            yield conn
+
+    writer = MessageWriter(connection, itertools.count(1).__next__, dialect=SQLITE)
+    writer.submit(1, 2, "hi", "k1")
+
+    assert writer.flush() == 0
+    assert writer.stats()['pending'] == 1 and writer.dead_letters() == []
+    down[0] = False
+    assert writer.flush() == 1
+    assert _stored(db) == [(1, 1, "hi")]
@@ -0,0 +1,38 @@
+"""Migrations and the hot query check (user-007) on SQLite."""
+import pytest
+
+from migrate import MigrationRunner, check_hot_queries
+from storage import make_backend
+
+
+def test_hot_queries_use_their_indexes(db):
+    with db.connection() as conn, conn.cursor() as cur:
+        assert check_hot_queries(cur, dialect=db.dialect) == []
+
+
+@pytest.mark.parametrize("index, problem", [
+    ("idx_topup_status", "pending topups: full scan of tr"),
+    ("idx_users_role", "user list: full scan of users"),
+    ("idx_topup_user_created", "user topups: full scan of topup_requests"),
+])
+def test_a_dropped_index_is_reported(db, index, problem):
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute(f"DROP INDEX {index}")
+        assert problem in check_hot_queries(cur, dialect=db.dialect)
+
+
+def test_duplicates_blocking_a_unique_key_are_reported(tmp_path):
+    (tmp_path / "0001_people.sql").write_text(
+        "CREATE TABLE people (name VARCHAR(50));\n"
+        "INSERT INTO people (name) VALUES ('an'), ('binh'), ('an');\n")
+    (tmp_path / "0002_unique_name.sql").write_text(
+        "CREATE UNIQUE INDEX uq_people_name ON people (name);\n")
+    db = make_backend("sqlite://")
+    runner = MigrationRunner(db.connection, directory=str(tmp_path), dialect=db.dialect, log=lambda *a: None)
+
+    with pytest.raises(RuntimeError) as info:
+        runner.run()
+    assert "0002_unique_name cannot add a unique key" in str(info.value)
+    assert "'name': 'an', 'n': 2" in str(info.value)
+    # 0001 stays applied, 0002 is retried on the next start
+    assert [v for v, _, _ in runner.pending()] == [2]
@@ -0,0 +1,31 @@
+"""Sessions resumed after a restart (user-003)."""
+import time
+
+import app as netcafe
+
+
+def _is_online(user_id):
+    with netcafe.db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT is_online FROM users WHERE id = %s", (user_id,))
+        return cur.fetchone()['is_online']
+
+
+def test_recovered_session_without_a_socket_is_closed(monkeypatch):
+    monkeypatch.setattr(netcafe, "PRESENCE_GRACE_SECONDS", 0.05)
+    uid = netcafe.directory.id_for("user")
+    netcafe._credit_user(uid, 10000)
+    netcafe._start_session(uid, netcafe.user_repo.balance(uid))
+    # the process is killed: the session is open in the database, but no worker
+    # holds it and the browser never reconnects
+    netcafe.ledger.stop(uid)
+    assert _is_online(uid) == 1 and not netcafe.presence.is_online(uid)
+
+    netcafe._recover_sessions()
+    assert uid in netcafe.ledger
+    assert uid in netcafe.offline_pending['users']
+
+    deadline = time.monotonic() + 5
+    while _is_online(uid) and time.monotonic() < deadline:
+        netcafe.socketio.sleep(0.01)
+    assert _is_online(uid) == 0
+    assert uid not in netcafe.ledger
@@ -0,0 +1,84 @@
+"""One slow DB call must only hold up its own socket event (user-021)."""
+import time
+
+import pytest
+
+import app as netcafe
+from loop_monitor import LoopMonitor
+
+# a recursive CTE that keeps SQLite busy for a second or two: a statement that is
+# slow in the database itself, not a sleep standing in for one
+SLOW_SQL = ("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < %s) "
+            "SELECT count(*) AS n FROM c")
+SLOW_ROWS = 3000000
+
+
+def _login(username):
+    http = netcafe.app.test_client()
+    assert http.post("/", data={'username': username, 'password': '123456'}).status_code == 302
+    sock = netcafe.socketio.test_client(netcafe.app, flask_test_client=http)
+    sock.get_received()
+    return sock
+
+
+def _wait_for(sock, event, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for pkt in sock.get_received():
+            if pkt['name'] == event:
+                return pkt['args'][0]
+        netcafe.socketio.sleep(0.005)
+    return None
+
+
+@pytest.fixture
+def slow_next_query(monkeypatch):
+    """Run SLOW_SQL on a pooled connection in front of the next conversation query;
+    yields the list to arm it with, which then receives how long SLOW_SQL took."""
+    armed = []
+    latest = netcafe.message_repo.latest
+
+    def slow_latest(*args, **kwargs):
+        if armed:
+            armed.pop()
+            started = time.monotonic()
+            with netcafe.db_connection() as conn, conn.cursor() as cur:
+                cur.execute(SLOW_SQL, (SLOW_ROWS,))
+            armed.append(time.monotonic() - started)
+        return latest(*args, **kwargs)
+
+    monkeypatch.setattr(netcafe.message_repo, "latest", slow_latest)
+    yield armed
+
+
+def test_slow_query_does_not_block_the_event_loop(slow_next_query):
+    assert netcafe.ASYNC_MODE == "eventlet"
+    admin = _login("admin")
+    user = _login("user")
+    admin_id = netcafe.directory.admin_id()
+    user_id = netcafe.user_repo.authenticate("user", "123456")['id']
+    monitor = LoopMonitor(netcafe.socketio.sleep, netcafe.socketio.start_background_task, interval=0.02)
+    monitor.start()
+
+    # the admin's history load runs the slow statement; the test client runs handlers
+    # inline, so it gets its own green thread as every event does on the real server
+    slow_next_query.append(True)
+    netcafe.socketio.start_background_task(admin.emit, 'load_messages',
+                                           {'user_id': admin_id, 'other_id': user_id})
+    netcafe.socketio.sleep(0.05)
+    assert not slow_next_query, "the admin's query did not start"
+
+    # ...while the user's own load, on another pooled connection, answers right away
+    started = time.monotonic()
+    user.emit('load_messages', {'user_id': user_id, 'other_id': admin_id})
+    assert _wait_for(user, 'messages', timeout=0.5) is not None
+    assert time.monotonic() - started < 0.25
+    assert not slow_next_query, "the slow statement was already over"
+
+    assert _wait_for(admin, 'messages', timeout=30) is not None
+    [slow_seconds] = slow_next_query
+    assert slow_seconds >= 0.5
+    # the hub kept running its other green threads the whole time
+    stats = monitor.stats()
+    assert stats['samples'] >= slow_seconds / 0.02 / 2
+    assert stats['max_lag_ms'] < 100
@@ -0,0 +1,61 @@
+"""usage_events as the source of users.balance (user-019) on SQLite."""
+from datetime import datetime
+
+import pytest
+
+from storage import SQLITE
+from usage import UsageLedger
+
+USER = 2  # seeded with an opening event of 60000
+
+
+def _balance(db, user_id):
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT balance FROM users WHERE id = %s", (user_id,))
+        return cur.fetchone()['balance']
+
+
+def test_events_are_applied_to_the_balance_in_order(db):
+    usage = UsageLedger(db.connection, dialect=SQLITE)
+    at = datetime(2026, 10, 1, 9, 30)
+    result = usage.record([
+        UsageLedger.event(USER, 'start', at=at),
+        UsageLedger.event(USER, 'usage', -1500, 1080, at=at),
+        UsageLedger.event(USER, 'topup', 20000, ref_id=7, at=at),
+        UsageLedger.event(USER, 'stop', -500, 360, at=at),
+    ])
+
+    assert result == {USER: 78000}
+    assert _balance(db, USER) == 78000
+    history = usage.history(USER)
+    assert [(e['kind'], e['amount'], e['balance_after']) for e in history] == [
+        ('stop', -500, 78000), ('topup', 20000, 78500), ('usage', -1500, 58500),
+        ('start', 0, 60000), ('opening', 60000, 60000)]
+    assert history[1]['ref_id'] == 7 and history[0]['seconds'] == 360
+    assert [e['kind'] for e in usage.history(USER, limit=2, before_id=history[1]['id'])] == ['usage', 'start']
+    assert usage.audit() == []
+
+
+def test_events_of_an_unknown_user_are_skipped(db):
+    usage = UsageLedger(db.connection, dialect=SQLITE)
+    assert usage.record([UsageLedger.event(99, 'topup', 1000), UsageLedger.event(USER, 'topup', 1000)]) == {USER: 61000}
+    assert usage.stats() == {'batches': 1, 'events': 1}
+
+
+def test_a_failure_in_on_record_rolls_the_events_back(db):
+    def broken_rollup(cur, events):
+        raise RuntimeError("rollup failed")
+
+    usage = UsageLedger(db.connection, on_record=broken_rollup, dialect=SQLITE)
+    with pytest.raises(RuntimeError):
+        usage.record([UsageLedger.event(USER, 'topup', 5000)])
+    assert _balance(db, USER) == 60000
+    assert [e['kind'] for e in usage.history(USER)] == ['opening']
+
+
+def test_audit_finds_a_balance_changed_behind_the_ledger(db):
+    usage = UsageLedger(db.connection, dialect=SQLITE)
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE users SET balance = balance + 1 WHERE id = %s", (USER,))
+    [row] = usage.audit()
+    assert (row['id'], row['balance'], row['events_total']) == (USER, 60001, 60000)
@@ -0,0 +1,52 @@
+"""Compact wire format and message idempotency keys (user-024, user-009)."""
+from datetime import datetime
+
+import wire
+from dedup import PENDING, DedupCache
+
+
+def test_compact_payloads_decode_back_to_the_json_fields():
+    at = datetime(2026, 10, 1, 9, 30, 5)
+    message = {'id': 5, 'from_user_id': 2, 'to_user_id': 1, 'content': 'hi', 'created_at': at,
+               'sender_name': 'user', 'sender_role': 'user'}
+
+    assert wire.encode('new_message', message, wire.JSON)['created_at'] == '2026-10-01 09:30:05'
+    compact = wire.encode('new_message', message, wire.COMPACT)
+    assert compact == [5, 2, 1, 'hi', int(at.timestamp()), 'user', 'user']
+    assert wire.decode('new_message', compact) == dict(message, created_at=int(at.timestamp()))
+
+    deadline = {'user_id': 2, 'balance': 4999.6, 'expires_at': 123, 'server_time': 100, 'status': 'OK',
+                'hourly_rate': 5000.0}
+    assert wire.decode('session_deadline', wire.encode('session_deadline', deadline, wire.COMPACT)) == \
+        dict(deadline, balance=5000, hourly_rate=5000)
+
+    page = {'messages': [message], 'has_more': True, 'other_id': 1}
+    rows, has_more, other_id = wire.encode('messages', page, wire.COMPACT)
+    assert (has_more, other_id, rows[0][0]) == (True, 1, 5)
+    # events without a compact layout go out as they are
+    assert wire.encode('admin_delta', {'a': 1}, wire.COMPACT) == {'a': 1}
+    assert wire.room('admins', wire.COMPACT) != wire.room('admins', wire.JSON) == 'admins'
+
+
+def test_a_key_is_processed_once_until_it_expires():
+    now = [0.0]
+    cache = DedupCache(max_size=2, ttl=60, clock=lambda: now[0])
+
+    assert cache.claim('a') == (True, None)
+    assert cache.claim('a') == (False, PENDING)
+    cache.put('a', {'id': 1})
+    assert cache.claim('a') == (False, {'id': 1})
+    # a failed first request may be retried
+    cache.claim('b')
+    cache.discard('b')
+    assert cache.claim('b') == (True, None)
+
+    now[0] += 61
+    assert cache.claim('a') == (True, None)
+    # bounded: the least recently used key goes first
+    cache.claim('c')
+    cache.claim('a')
+    cache.claim('d')
+    assert len(cache) == 2
+    assert cache.claim('a') == (False, PENDING)
+    assert cache.claim('c') == (True, None)
@@ -0,0 +1,101 @@
+from datetime import datetime
+
+from storage import MYSQL
+
+
+class UsageLedger:
+    """Append-only record of what changed each user's balance, in whole đồng.
+
+    Every change is an event in ``usage_events``: a session ``start`` (amount 0),
+    ``usage`` for a billed stretch of a session that is still running (written when
+    the session is topped up), ``stop`` for the last stretch, and
+    ``topup``. ``users.balance`` is the materialized sum of a user's events: each
+    ``record`` appends the events and applies their amounts to it in the same
+    transaction, and stores the resulting balance on every event, so
+    ``SUM(amount)`` per user always equals the balance and any balance can be
+    traced back event by event (see ``audit``).
+
+    A session therefore costs a handful of writes (start, stop, one pair per topup)
+    instead of a balance rewrite per checkpoint.
+    """
+
+    KINDS = ('opening', 'start', 'usage', 'stop', 'topup')
+
+    def __init__(self, connection, on_record=None, dialect=MYSQL):
+        # connection: callable returning a context manager that yields a DB connection
+        self._connection = connection
+        self._dialect = dialect
+        # on_record(cur, events): runs in the same transaction after events were
+        # appended, for data derived from them (reports.UsageRollups.apply)
+        self._on_record = on_record
+        self._stats = {'batches': 0, 'events': 0}
+
+    @staticmethod
+    def event(user_id, kind, amount=0, seconds=0, ref_id=None, at=None):
+        return {'user_id': user_id, 'kind': kind, 'amount': int(amount), 'seconds': int(seconds),
+                'ref_id': ref_id, 'created_at': (at or datetime.now()).replace(microsecond=0)}
+
+    def record(self, events):
+        """Append events and apply them to users.balance; returns {user_id: new balance}."""
+        if not events:
+            return {}
+        user_ids = sorted({e['user_id'] for e in events})
+        placeholders = ", ".join(["%s"] * len(user_ids))
+        with self._connection() as conn:
+            conn.begin()
+            try:
+                with conn.cursor() as cur:
+                    # lock the rows so concurrent records for a user are serialized
+                    cur.execute(f"SELECT id, balance FROM users WHERE id IN ({placeholders})"
+                                f"{self._dialect.for_update}", user_ids)
+                    balances = {r['id']: int(r['balance'] or 0) for r in cur.fetchall()}
+                    rows = []
+                    recorded = []
+                    for e in events:
+                        if e['user_id'] not in balances:
+                            continue
+                        recorded.append(e)
+                        balances[e['user_id']] += e['amount']
+                        rows.append((e['user_id'], e['kind'], e['amount'], balances[e['user_id']],
+                                     e['seconds'], e['ref_id'], e['created_at']))
+                    if rows:
+                        values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(rows))
+                        cur.execute("INSERT INTO usage_events (user_id, kind, amount, balance_after, seconds, "
+                                    f"ref_id, created_at) VALUES {values}", [v for r in rows for v in r])
+                        changed = sorted({r[0] for r in rows})
+                        cases = " ".join(["WHEN %s THEN %s"] * len(changed))
+                        params = [v for uid in changed for v in (uid, balances[uid])]
+                        params.extend(changed)
+                        cur.execute(f"UPDATE users SET balance = CASE id {cases} END "
+                                    f"WHERE id IN ({', '.join(['%s'] * len(changed))})", params)
+                        if self._on_record is not None:
+                            self._on_record(cur, recorded)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self._stats['batches'] += 1
+        self._stats['events'] += len(rows)
+        return {r[0]: balances[r[0]] for r in rows}
+
+    def history(self, user_id, limit=100, before_id=None):
+        """A user's latest events, newest first."""
+        with self._connection() as conn, conn.cursor() as cur:
+            if before_id:
+                cur.execute("SELECT * FROM usage_events WHERE user_id=%s AND id < %s ORDER BY id DESC LIMIT %s",
+                            (user_id, before_id, limit))
+            else:
+                cur.execute("SELECT * FROM usage_events WHERE user_id=%s ORDER BY id DESC LIMIT %s",
+                            (user_id, limit))
+            return cur.fetchall()
+
+    def audit(self):
+        """Users whose materialized balance differs from the sum of their events."""
+        with self._connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT u.id, u.balance, COALESCE(SUM(e.amount), 0) AS events_total FROM users u "
+                        "LEFT JOIN usage_events e ON e.user_id = u.id GROUP BY u.id, u.balance "
+                        "HAVING u.balance <> COALESCE(SUM(e.amount), 0)")
+            return cur.fetchall()
+
+    def stats(self):
+        return dict(self._stats)
@@ -0,0 +1,72 @@
+"""Wire formats for server-initiated socket events.
+
+``json`` (the default) sends payloads as dicts. When the server enables the compact
+format (NETCAFE_COMPACT_WIRE=1), a client that joins with ``{'wire': 'compact'}``
+gets the high-frequency events in FIELDS as positional arrays in that field order
+instead: no repeated keys, datetimes as integer epoch seconds, balances as whole đồng. ``messages`` / ``older_messages`` become
+``[[message, ...], has_more, other_id]`` with every message an array of
+MESSAGE_FIELDS. Other events are sent as in ``json``.
+
+A compact client joins ``room(name, 'compact')`` instead of ``name``, so an event
+for a room goes out as one emit per format (Delivery does the routing).
+static/js/netcafe_socket.js decodes the arrays back into the usual objects; keep
+the field lists there in sync with this file.
+"""
+from datetime import datetime
+
+JSON = 'json'
+COMPACT = 'compact'
+FORMATS = (JSON, COMPACT)
+
+MESSAGE_FIELDS = ('id', 'from_user_id', 'to_user_id', 'content', 'created_at', 'sender_name', 'sender_role')
+FIELDS = {
+    'time_update': ('user_id', 'balance', 'seconds_left', 'status', 'server_time'),
+    'session_deadline': ('user_id', 'balance', 'expires_at', 'server_time', 'status', 'hourly_rate'),
+    'seat_grid': ('server_time', 'seats', 'stopped', 'full'),
+    'new_message': MESSAGE_FIELDS,
+}
+MESSAGE_LISTS = ('messages', 'older_messages')
+
+
+def room(name, fmt):
+    """Room that the clients of a wire format join for ``name``."""
+    return name if fmt == JSON else f"{name}~{fmt[0]}"
+
+
+def _compact(value):
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    if isinstance(value, float):
+        # balances are shown rounded to the đồng
+        return int(round(value))
+    return value
+
+
+def _message_row(m):
+    return [_compact(m.get(f)) for f in MESSAGE_FIELDS]
+
+
+def encode(event, payload, fmt):
+    """The payload as clients of ``fmt`` receive it."""
+    if fmt == COMPACT and isinstance(payload, dict):
+        fields = FIELDS.get(event)
+        if fields is not None:
+            return [_compact(payload.get(f)) for f in fields]
+        if event in MESSAGE_LISTS:
+            return [[_message_row(m) for m in payload['messages']], payload['has_more'], payload['other_id']]
+    if isinstance(payload, dict) and isinstance(payload.get('created_at'), datetime):
+        return dict(payload, created_at=str(payload['created_at']))
+    return payload
+
+
+def decode(event, data):
+    """Inverse of ``encode`` for a compact payload (times stay epoch seconds); others pass through."""
+    if not isinstance(data, list):
+        return data
+    if event in FIELDS:
+        return {f: v for f, v in zip(FIELDS[event], data) if v is not None}
+    if event in MESSAGE_LISTS:
+        rows, has_more, other_id = data
+        return {'messages': [dict(zip(MESSAGE_FIELDS, r)) for r in rows], 'has_more': has_more,
+                'other_id': other_id}
+    return data